@@ -0,0 +1,97 @@
+"""
+Reports Python heap bytes per idle connection (a Sock that's connected
+but hasn't received anything plus its record in Net.inbound) using
+tracemalloc. "before" rebuilds Sock and RecvBuffer from the same code
+without __slots__ and uses the original dict records (with an eagerly
+allocated receive buffer) for comparison.
+
+Usage (from the repository root): python -m benchmarks.con_memory
+"""
+
+import socket
+import tracemalloc
+
+import pyp2p.sock
+from pyp2p.net import PeerRecord
+from pyp2p.sock import Sock, RecvBuffer
+
+
+def without_slots(cls):
+    # Same methods, but instances get a __dict__ like before.
+    attrs = dict(cls.__dict__)
+    for name in attrs.pop("__slots__", []):
+        attrs.pop(name, None)
+
+    return type("Legacy" + cls.__name__, cls.__bases__, attrs)
+
+
+LegacySock = without_slots(Sock)
+LegacyRecvBuffer = without_slots(RecvBuffer)
+
+
+class EagerRecvBuffer(LegacyRecvBuffer):
+    # Receive buffers used to be allocated up front.
+    def __init__(self, size=1024 * 4):
+        LegacyRecvBuffer.__init__(self, size)
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+
+
+def dict_record(con, node_type, ip, port):
+    return {
+        "con": con,
+        "type": node_type,
+        "ip": ip,
+        "port": port
+    }
+
+
+def bytes_per_con(sock_class, record, n, listener):
+    addr = listener.getsockname()
+    nodes = []
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(0, n):
+        con = sock_class(addr[0], addr[1], blocking=0)
+        nodes.append(record(con, "passive", addr[0], addr[1]))
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    ignore = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>")
+    ]
+    stats = after.filter_traces(ignore).compare_to(
+        before.filter_traces(ignore), "filename"
+    )
+    total = sum(stat.size_diff for stat in stats)
+
+    # Connections are made from the listen backlog.
+    for i in range(0, n):
+        listener.accept()[0].close()
+    for node in nodes:
+        node["con"].close()
+
+    return total / float(n)
+
+
+if __name__ == "__main__":
+    n = 1000
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(n)
+
+    pyp2p.sock.RecvBuffer = EagerRecvBuffer
+    try:
+        before = bytes_per_con(LegacySock, dict_record, n, listener)
+    finally:
+        pyp2p.sock.RecvBuffer = RecvBuffer
+
+    after = bytes_per_con(Sock, PeerRecord, n, listener)
+    listener.close()
+
+    print("%-8s %12s" % ("", "bytes/con"))
+    print("%-8s %12.0f" % ("before", before))
+    print("%-8s %12.0f" % ("after", after))
+    print("%-8s %11.1fx" % ("smaller", before / after))
@@ -0,0 +1,80 @@
+"""
+Compares the DHT message envelope (pack_message / unpack_message) with
+the original encoding - hexlified msgpack in the query string, decoded
+with literal_eval for strings - for a few typical messages. Reports the
+bytes each puts on the wire (URL encoded as they're sent) and encode +
+decode round trips per second.
+
+Usage (from the repository root): python -m benchmarks.dht_envelope
+"""
+
+import binascii
+import os
+import time
+from ast import literal_eval
+
+import umsgpack
+from future.moves.urllib.parse import urlencode
+
+from pyp2p.dht_msg import pack_message, unpack_message
+
+
+def legacy_pack(msg):
+    return binascii.hexlify(umsgpack.packb(msg))
+
+
+def legacy_unpack(data):
+    # Original DHT.build_dht_response kept for comparison.
+    msg = umsgpack.unpackb(binascii.unhexlify(data))
+    try:
+        if type(msg) in [type(u""), type(b"")]:
+            msg = literal_eval(msg)
+    except:
+        msg = str(msg)
+
+    return msg
+
+
+def build_messages():
+    unl = binascii.hexlify(os.urandom(48)).decode("ascii")
+    status = {
+        u"status": u"SYN",
+        u"data_id": binascii.hexlify(os.urandom(32)).decode("ascii"),
+        u"file_size": 1024 * 1024 * 32,
+        u"contract_id": binascii.hexlify(os.urandom(32)).decode("ascii"),
+        u"src_unl": unl,
+        u"dest_unl": unl
+    }
+
+    return [
+        ("reverse", u"REVERSE_CONNECT:" + unl),
+        ("status", status),
+        ("status repr", str(status)),
+        ("4 KB text", u"chunk of a repetitive log line\n" * 132),
+        ("4 KB random", os.urandom(4096)),
+        ("20 statuses", [status] * 20)
+    ]
+
+
+def bench(pack, unpack, msg, n):
+    t = time.time()
+    for i in range(0, n):
+        unpack(pack(msg))
+
+    return n / (time.time() - t)
+
+
+if __name__ == "__main__":
+    n = 2000
+    print("%-12s %12s %12s %14s %14s" % ("message", "legacy (B)",
+                                         "current (B)", "legacy (rt/s)",
+                                         "current (rt/s)"))
+    for name, msg in build_messages():
+        legacy_size = len(urlencode({"msg": legacy_pack(msg)}))
+        current_size = len(urlencode({"msg": pack_message(msg)}))
+        legacy = bench(legacy_pack, legacy_unpack, msg, n)
+        current = bench(pack_message, lambda data: unpack_message(data)[0],
+                        msg, n)
+        print("%-12s %12d %12d %14.0f %14.0f" % (name, legacy_size,
+                                                 current_size, legacy,
+                                                 current))
@@ -0,0 +1,84 @@
+"""
+Compares the line framer in Sock.parse_buf against the original
+byte-at-a-time implementation for a range of buffer sizes.
+
+Usage (from the repository root): python -m benchmarks.parse_buf
+"""
+
+import timeit
+
+from pyp2p.lib import encode_str
+from pyp2p.sock import Sock
+
+
+def legacy_parse_buf(buf, encoding="unicode"):
+    # Original implementation kept for comparison.
+    # Returns the replies and the unparsed remainder of buf.
+    replies = []
+    reply = b""
+    chop = 0
+    skip = 0
+    buf_len = len(buf)
+    for i in range(0, buf_len):
+        ch = buf[i:i + 1]
+        if skip:
+            skip -= 1
+            continue
+
+        nxt = i + 1
+        if nxt < buf_len:
+            if ch == b"\r" and buf[nxt:nxt + 1] == b"\n":
+                if reply != b"":
+                    if encoding == "unicode":
+                        replies.append(encode_str(reply, encoding))
+                    else:
+                        replies.append(reply)
+                    reply = b""
+
+                chop = nxt + 1
+                skip = 1
+                continue
+
+        reply += ch
+
+    return replies, buf[chop:]
+
+
+def build_buf(size, line_len=100):
+    line = b"x" * (line_len - 2) + b"\r\n"
+    buf = line * (size // line_len)
+    return buf + b"y" * (size - len(buf))
+
+
+def bench_legacy(buf, number):
+    elapsed = timeit.timeit(lambda: legacy_parse_buf(buf), number=number)
+    return elapsed / number
+
+
+def bench_current(buf, number):
+    sock = Sock()
+
+    def run():
+        sock.buf = buf
+        sock.parse_buf()
+
+    elapsed = timeit.timeit(run, number=number)
+    sock.close()
+    return elapsed / number
+
+
+if __name__ == "__main__":
+    sizes = [
+        ("1 KB", 1024, 1000),
+        ("64 KB", 64 * 1024, 50),
+        ("1 MB", 1024 * 1024, 3)
+    ]
+
+    print("%-8s %14s %14s %10s" % ("size", "legacy (s)", "current (s)",
+                                   "speed up"))
+    for name, size, number in sizes:
+        buf = build_buf(size)
+        legacy = bench_legacy(buf, number)
+        current = bench_current(buf, number)
+        print("%-8s %14.6f %14.6f %9.1fx" % (name, legacy, current,
+                                             legacy / current))
@@ -0,0 +1,101 @@
+"""
+Drives an in-process RendezvousFactory with synthetic clients (each on
+its own IP with a twisted StringTransport) and reports lines/second and
+p99 latency through RendezvousProtocol.lineReceived. Each client
+registers as a passive or simultaneous node and then sends a mix of
+BOOTSTRAP, SOURCE, CANDIDATE, ACCEPT, invalid and CLEAR lines.
+
+Usage (from the repository root): python -m benchmarks.rendezvous
+"""
+
+import random
+import time
+
+from twisted.internet.address import IPv4Address
+try:
+    from twisted.internet.testing import StringTransport
+except ImportError:
+    from twisted.test.proto_helpers import StringTransport
+
+import pyp2p.rendezvous_server
+from pyp2p.rendezvous_server import RendezvousFactory
+
+
+def client_ip(i):
+    return "10.%d.%d.%d" % ((i >> 16) & 255, (i >> 8) & 255, i & 255)
+
+
+def build_clients(factory, n):
+    clients = []
+    for i in range(0, n):
+        ip_addr = client_ip(i + 1)
+        proto = factory.buildProtocol(IPv4Address("TCP", ip_addr, 50500))
+        proto.makeConnection(StringTransport(
+            peerAddress=IPv4Address("TCP", ip_addr, 50500)
+        ))
+        clients.append((ip_addr, proto))
+
+    return clients
+
+
+def build_lines(clients):
+    # (proto, line) pairs in the order they're sent.
+    sims = [ip_addr for i, (ip_addr, proto) in enumerate(clients) if i % 2]
+    lines = []
+    for i, (ip_addr, proto) in enumerate(clients):
+        node_type = ["PASSIVE", "SIMULTANEOUS"][i % 2]
+        lines.append((proto, node_type + " READY 50500 10"))
+
+    ntp = str(time.time())
+    for i, (ip_addr, proto) in enumerate(clients):
+        sim = sims[i % len(sims)]
+        lines += [
+            (proto, "BOOTSTRAP 10"),
+            (proto, "SOURCE TCP"),
+            (proto, "CANDIDATE %s TCP 50500 50501 50502" % sim),
+            (proto, "NOT A COMMAND"),
+        ]
+        if i % 2:
+            lines.append((proto, "ACCEPT %s 50500 TCP %s" % (
+                clients[i - 1][0], ntp
+            )))
+
+    for ip_addr, proto in clients:
+        lines.append((proto, "CLEAR"))
+
+    return [(proto, line.encode("ascii") + b"\r\n")
+            for proto, line in lines]
+
+
+def bench(n, repeat=3):
+    # Best of repeat runs, each against a fresh factory.
+    best = None
+    for i in range(0, repeat):
+        random.seed(0)
+        factory = RendezvousFactory()
+        clients = build_clients(factory, n)
+        lines = build_lines(clients)
+
+        latencies = []
+        t = time.time()
+        for proto, line in lines:
+            start = time.time()
+            proto.dataReceived(line)
+            latencies.append(time.time() - start)
+        elapsed = time.time() - t
+
+        latencies.sort()
+        p99 = latencies[int(len(latencies) * 0.99)]
+        result = (len(lines) / elapsed, p99)
+        if best is None or result[0] > best[0]:
+            best = result
+
+    return best
+
+
+if __name__ == "__main__":
+    pyp2p.rendezvous_server.debug = 0
+    print("%-8s %14s %12s" % ("clients", "lines/s", "p99 (us)"))
+    for n in [100, 1000, 10000]:
+        lines_per_sec, p99 = bench(n)
+        print("%-8d %14.0f %12.1f" % (n, lines_per_sec, p99 * 1000000))
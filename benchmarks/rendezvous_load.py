@@ -0,0 +1,323 @@
+"""
+Load tests the rendezvous server over loopback. The server runs in its
+own process (serve(), optionally with several workers) and thousands of
+asyncio clients connect to it, each from its own 127.x.y.z address since
+the server tells nodes apart by IP. Every client runs one of these flows,
+picked at random in the ratios given by --mix:
+
+passive       SOURCE TCP, PASSIVE READY, BOOTSTRAP
+bootstrap     BOOTSTRAP, SOURCE TCP
+candidate     SOURCE TCP, CANDIDATE (PREDICTION SET) and waits for FIGHT
+simultaneous  SIMULTANEOUS READY then ACCEPTs every CHALLENGE (held open
+              for the whole run; connected before the other clients)
+
+Reports connections/s, commands/s, the server's RSS growth and latency
+percentiles per command (FIGHT is CANDIDATE -> CHALLENGE -> ACCEPT ->
+FIGHT.) Linux only.
+
+Usage (from the repository root):
+python -m benchmarks.rendezvous_load --clients 5000 [--workers 2]
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import time
+
+from pyp2p.rendezvous_server import serve
+
+flows = ["passive", "bootstrap", "candidate", "simultaneous"]
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+
+    return port
+
+
+def source_ip(net, i):
+    # Distinct loopback addresses from 127.net.0.1 (no .0 or .255.)
+    i, host = divmod(i, 254)
+    return "127.%d.%d.%d" % (net + (i >> 8), i & 255, host + 1)
+
+
+def run_server(port, workers):
+    serve(port=port, interface="127.0.0.1", workers=workers,
+          log_level=logging.WARNING)
+
+
+def rss(pid):
+    # Resident KB of pid and its children (workers, store manager.)
+    total = 0
+    try:
+        with open("/proc/%d/status" % pid) as fp:
+            for line in fp:
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1])
+        for task in os.listdir("/proc/%d/task" % pid):
+            with open("/proc/%d/task/%s/children" % (pid, task)) as fp:
+                for child in fp.read().split():
+                    total += rss(int(child))
+    except (IOError, OSError):
+        pass
+
+    return total
+
+
+def parse_mix(mix):
+    weights = dict((flow, 0) for flow in flows)
+    for part in mix.split(","):
+        flow, weight = part.split(":")
+        if flow not in weights:
+            raise ValueError("Unknown flow " + flow)
+        weights[flow] = float(weight)
+
+    return weights
+
+
+class Stats(object):
+    def __init__(self):
+        self.commands = 0
+        self.connections = 0
+        self.errors = 0
+        self.latency = {}
+
+    def observe(self, command, elapsed):
+        self.latency.setdefault(command, []).append(elapsed)
+
+    def report(self):
+        print("%-10s %8s %10s %10s %11s %10s" % (
+            "command", "count", "p50 (ms)", "p99 (ms)", "p99.9 (ms)",
+            "max (ms)"
+        ))
+        for command in sorted(self.latency):
+            latencies = sorted(self.latency[command])
+
+            def at(q):
+                i = min(int(len(latencies) * q), len(latencies) - 1)
+                return latencies[i] * 1000
+
+            print("%-10s %8d %10.2f %10.2f %11.2f %10.2f" % (
+                command, len(latencies), at(0.5), at(0.99), at(0.999),
+                latencies[-1] * 1000
+            ))
+
+
+class Client(object):
+    def __init__(self, stats, port, ip_addr, timeout):
+        self.stats = stats
+        self.port = port
+        self.ip_addr = ip_addr
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        t = time.perf_counter()
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection("127.0.0.1", self.port,
+                                    local_addr=(self.ip_addr, 0)),
+            self.timeout
+        )
+        self.stats.observe("connect", time.perf_counter() - t)
+        self.stats.connections += 1
+
+    def send(self, line):
+        self.writer.write(line.encode("ascii") + b"\r\n")
+        self.stats.commands += 1
+
+    async def recv(self):
+        line = await self.reader.readline()
+        if not line:
+            raise EOFError("Server closed the connection.")
+
+        return line.decode("ascii").strip()
+
+    async def expect(self, prefix):
+        # Skips lines that aren't the reply (e.g. RECONNECT.)
+        while True:
+            line = await asyncio.wait_for(self.recv(), self.timeout)
+            if line.startswith(prefix):
+                return line
+
+    async def request(self, command, line, prefix):
+        t = time.perf_counter()
+        self.send(line)
+        reply = await self.expect(prefix)
+        self.stats.observe(command, time.perf_counter() - t)
+
+        return reply
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def passive(client, targets):
+    await client.request("SOURCE", "SOURCE TCP", "REMOTE")
+    client.send("PASSIVE READY 50500 10")
+    await client.request("BOOTSTRAP", "BOOTSTRAP 10", "NODES")
+
+
+async def bootstrap(client, targets):
+    await client.request("BOOTSTRAP", "BOOTSTRAP 10", "NODES")
+    await client.request("SOURCE", "SOURCE TCP", "REMOTE")
+
+
+async def candidate(client, targets):
+    await client.request("SOURCE", "SOURCE TCP", "REMOTE")
+    t = time.perf_counter()
+    await client.request(
+        "CANDIDATE", "CANDIDATE %s TCP 50501 50502" % random.choice(targets),
+        "PREDICTION SET"
+    )
+    await client.expect("FIGHT")
+    client.stats.observe("FIGHT", time.perf_counter() - t)
+
+
+async def simultaneous(client):
+    # Accepts challenges until the connection is closed.
+    while True:
+        try:
+            line = await client.recv()
+        except (EOFError, ConnectionError, asyncio.CancelledError):
+            return
+        if line.startswith("CHALLENGE"):
+            client.send("ACCEPT %s 50503 TCP %f" % (
+                line.split(" ")[1], time.time()
+            ))
+
+
+runners = {
+    "passive": passive,
+    "bootstrap": bootstrap,
+    "candidate": candidate
+}
+
+
+async def run_client(stats, port, ip_addr, flow, targets, limit, timeout):
+    async with limit:
+        client = Client(stats, port, ip_addr, timeout)
+        try:
+            await client.connect()
+            await runners[flow](client, targets)
+        except (asyncio.TimeoutError, EOFError, OSError):
+            stats.errors += 1
+        finally:
+            client.close()
+
+
+async def load(port, n, weights, concurrency, timeout, pid):
+    stats = Stats()
+    random.seed(0)
+    total = sum(weights.values())
+    sim_count = int(n * weights["simultaneous"] / total)
+    if weights["candidate"] and not sim_count:
+        sim_count = 1
+
+    # Simultaneous nodes stay connected for the candidates and are
+    # registered (SOURCE TCP is answered after READY) before they come.
+    sims = []
+    targets = []
+    for i in range(0, sim_count):
+        ip_addr = source_ip(20, i)
+        client = Client(stats, port, ip_addr, timeout)
+        await client.connect()
+        client.send("SIMULTANEOUS READY 50500 10")
+        await client.request("SOURCE", "SOURCE TCP", "REMOTE")
+        sims.append(client)
+        targets.append(ip_addr)
+    tasks = [asyncio.ensure_future(simultaneous(client)) for client in sims]
+
+    others = [flow for flow in flows if flow != "simultaneous"]
+    picks = random.choices(others, [weights[flow] for flow in others],
+                           k=n - sim_count)
+    limit = asyncio.Semaphore(concurrency)
+    rss_before = rss(pid)
+    connections, commands = stats.connections, stats.commands
+    t = time.perf_counter()
+    await asyncio.gather(*[
+        run_client(stats, port, source_ip(40, i), flow,
+                   targets, limit, timeout)
+        for i, flow in enumerate(picks)
+    ])
+    elapsed = time.perf_counter() - t
+    rss_after = rss(pid)
+
+    for client, task in zip(sims, tasks):
+        client.close()
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    counts = dict((flow, picks.count(flow)) for flow in others)
+    counts["simultaneous"] = sim_count
+    print("clients %d (%s)" % (n, ", ".join(
+        "%s %d" % (flow, counts[flow]) for flow in flows
+    )))
+    print("elapsed        %10.2f s" % elapsed)
+    print("connections/s  %10.0f" % (
+        (stats.connections - connections) / elapsed
+    ))
+    print("commands/s     %10.0f" % ((stats.commands - commands) / elapsed))
+    print("errors         %10d" % stats.errors)
+    print("server RSS     %10.1f MB -> %.1f MB (%+.2f KB/client)" % (
+        rss_before / 1024.0, rss_after / 1024.0,
+        (rss_after - rss_before) / float(max(n - sim_count, 1))
+    ))
+    stats.report()
+
+
+def wait_for_server(port, timeout=10):
+    t = time.time()
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), 1).close()
+            return
+        except socket.error:
+            if time.time() - t > timeout:
+                raise
+            time.sleep(0.1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--mix", default="passive:4,bootstrap:3,"
+                                         "candidate:2,simultaneous:1",
+                        help="flow:weight,... (default: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=200,
+                        help="clients connected at once")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=10,
+                        help="seconds to wait for each reply")
+    args = parser.parse_args()
+    weights = parse_mix(args.mix)
+
+    # Simultaneous nodes are held open on top of the concurrent clients.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    want = args.concurrency * 2 + args.clients + 1024
+    if hard != resource.RLIM_INFINITY:
+        want = min(want, hard)
+    if soft != resource.RLIM_INFINITY and soft < want:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (want, hard))
+
+    port = free_port()
+    server = multiprocessing.get_context("spawn").Process(
+        target=run_server, args=(port, args.workers)
+    )
+    server.start()
+    try:
+        wait_for_server(port)
+        asyncio.run(load(port, args.clients, weights, args.concurrency,
+                         args.timeout, server.pid))
+    finally:
+        server.terminate()
+        server.join()
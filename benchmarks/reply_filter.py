@@ -0,0 +1,106 @@
+"""
+Measures replies/second through Sock.update() with the duplicate
+message filter installed by Net.add_node (duplicates disabled, so every
+reply is checked and recorded.) The original filter - which hashed each
+reply two or three times with SHA-256 and kept hex digests in a dict -
+is included for comparison.
+
+Usage (from the repository root): python -m benchmarks.reply_filter
+"""
+
+import hashlib
+import time
+
+from pyp2p.net import SeenMessages, min_retransmit_interval,\
+    max_retransmissions
+from pyp2p.sock import Sock
+
+
+class LegacySeenMessages(object):
+    # Original implementation kept for comparison.
+    def __init__(self):
+        self.seen_messages = {}
+
+    def is_msg_old(self, msg, record_seen=0):
+        if type(msg) == str:
+            msg = msg.encode("ascii")
+
+        response_hash = hashlib.sha256(msg).hexdigest()
+        if response_hash in self.seen_messages:
+            seen = self.seen_messages[response_hash]
+            elapsed = int(time.time()) - seen["last"]
+            if elapsed < min_retransmit_interval:
+                return 1
+
+            if seen["times"] >= max_retransmissions:
+                return 1
+
+        if record_seen:
+            self.record_msg_hash(msg)
+
+        return 0
+
+    def record_msg_hash(self, msg):
+        if type(msg) == str:
+            msg = msg.encode("ascii")
+        response_hash = hashlib.sha256(msg).hexdigest()
+
+        if not self.is_msg_old(msg):
+            timestamp = int(time.time())
+            if response_hash in self.seen_messages:
+                seen = self.seen_messages[response_hash]
+                seen["times"] += 1
+                seen["last"] = timestamp
+            else:
+                self.seen_messages[response_hash] = {
+                    "times": 1,
+                    "last": timestamp
+                }
+
+            return 1
+        else:
+            return 0
+
+    check = is_msg_old
+
+
+def build_buf(n, line_len=100):
+    lines = []
+    for i in range(0, n):
+        line = str(i).encode("ascii")
+        lines.append(line + b"x" * (line_len - 2 - len(line)) + b"\r\n")
+
+    return b"".join(lines)
+
+
+def bench(cache_class, buf, n, repeat=3):
+    # Best of repeat runs, each with an empty cache.
+    best = None
+    for i in range(0, repeat):
+        check = cache_class().check
+        sock = Sock()
+        sock.event_driven = 1
+        sock.reply_filter = lambda msg: not check(msg, 1)
+        sock.buf = buf
+
+        t = time.time()
+        sock.update()
+        elapsed = time.time() - t
+
+        assert(len([x for x in sock.replies if x]) == n)
+        sock.close()
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return n / best
+
+
+if __name__ == "__main__":
+    print("%-10s %16s %16s %10s" % ("replies", "legacy (r/s)",
+                                    "current (r/s)", "speed up"))
+    for n in [1000, 10000, 100000]:
+        buf = build_buf(n)
+        legacy = bench(LegacySeenMessages, buf, n)
+        current = bench(SeenMessages, buf, n)
+        print("%-10d %16.0f %16.0f %9.1fx" % (n, legacy, current,
+                                              current / legacy))
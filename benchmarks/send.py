@@ -0,0 +1,87 @@
+"""
+Measures Sock.send throughput over loopback for payloads from 1 KB to
+16 MB, plus small line batches sent with send_line vs send_lines.
+
+Usage (from the repository root): python -m benchmarks.send
+"""
+
+import socket
+import time
+from threading import Thread
+
+from pyp2p.sock import Sock
+
+
+def drain(listen, totals):
+    # Read everything the client sends until it disconnects.
+    client, address = listen.accept()
+    buf = bytearray(1024 * 256)
+    total = 0
+    while True:
+        n = client.recv_into(buf)
+        if not n:
+            break
+        total += n
+    totals.append(total)
+    client.close()
+
+
+def connect():
+    listen = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen.bind(("127.0.0.1", 0))
+    listen.listen(1)
+    totals = []
+    t = Thread(target=drain, args=(listen, totals))
+    t.start()
+    con = Sock("127.0.0.1", listen.getsockname()[1], blocking=0)
+    return con, listen, t, totals
+
+
+def bench_payload(size, rounds):
+    con, listen, t, totals = connect()
+    payload = b"x" * size
+    start = time.time()
+    for i in range(0, rounds):
+        sent = con.send(payload, send_all=1, timeout=60)
+        assert(sent == size)
+    elapsed = time.time() - start
+    con.close()
+    t.join()
+    listen.close()
+    assert(totals[0] == size * rounds)
+    return (size * rounds) / elapsed / (1024 * 1024)
+
+
+def bench_lines(n, batch):
+    con, listen, t, totals = connect()
+    line = b"x" * 62
+    start = time.time()
+    if batch:
+        for i in range(0, n // batch):
+            con.send_lines([line] * batch)
+    else:
+        for i in range(0, n):
+            con.send_line(line)
+    elapsed = time.time() - start
+    con.close()
+    t.join()
+    listen.close()
+    return n / elapsed
+
+
+if __name__ == "__main__":
+    sizes = [
+        ("1 KB", 1024, 5000),
+        ("64 KB", 64 * 1024, 500),
+        ("1 MB", 1024 * 1024, 50),
+        ("16 MB", 16 * 1024 * 1024, 5)
+    ]
+
+    print("%-8s %12s" % ("payload", "MB/s"))
+    for name, size, rounds in sizes:
+        print("%-8s %12.1f" % (name, bench_payload(size, rounds)))
+
+    print("")
+    print("%-20s %12s" % ("64 byte lines", "lines/s"))
+    print("%-20s %12.0f" % ("send_line", bench_lines(100000, 0)))
+    print("%-20s %12.0f" % ("send_lines (x64)", bench_lines(100000, 64)))
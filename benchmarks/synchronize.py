@@ -0,0 +1,104 @@
+"""
+Measures the cost of one Net.synchronize() call with 10 to 10,000
+connections where 10% of them have just disconnected. The original
+connection bookkeeping - eval() to get each list, list.remove() per dead
+node and full scans to flush send queues and read nonces - is included
+for comparison.
+
+Usage (from the repository root): python -m benchmarks.synchronize
+"""
+
+import time
+
+from pyp2p.net import Net, PeerRecord
+from pyp2p.sock import Sock
+
+
+def legacy_synchronize(self):
+    # Original connection bookkeeping kept for comparison.
+    for node_list_name in ["self.inbound", "self.outbound"]:
+        node_list = eval(node_list_name)[:]
+        for node in node_list:
+            if not node["con"].connected:
+                self.debug_print("\a")
+                self.debug_print("Removing disconnected: " + str(node))
+                eval(node_list_name).remove(node)
+                self.registry.remove(node)
+
+    for node in self.inbound + self.outbound:
+        if len(node["con"].send_queue):
+            node["con"].flush()
+
+    self.expire_reverse_queries()
+    self.seen_messages.expire()
+
+    if self.net_type == "direct":
+        for node in self.inbound + self.outbound:
+            if node["con"].nonce is not None:
+                continue
+
+    self.process_dht_messages()
+
+
+def build_net(n):
+    net = Net(
+        net_type="direct",
+        node_type="passive",
+        nat_type="preserving",
+        passive_bind="127.0.0.1",
+        passive_port=0,
+        wan_ip="8.8.8.8",
+        max_outbound=n,
+        max_inbound=n + 1
+    )
+    net.disable_advertise()
+    net.disable_bootstrap()
+
+    # Idle cons that have sent their nonce.
+    for i in range(0, n):
+        con = Sock(blocking=0)
+        con.connected = 1
+        con.nonce = "%064x" % i
+        node_type = ["passive", "accept"][i % 2]
+        node = PeerRecord(con, node_type, "10.%d.%d.%d" % (
+            (i >> 16) & 255, (i >> 8) & 255, i & 255
+        ), 50500)
+        if node_type == "accept":
+            net.inbound.append(node)
+        else:
+            net.outbound.append(node)
+        net.registry.add(node)
+
+    return net
+
+
+def bench(sync, n, repeat=3):
+    # Best of repeat runs, each with 10% of cons just closed.
+    best = None
+    for i in range(0, repeat):
+        net = build_net(n)
+        nodes = net.inbound + net.outbound
+        for node in nodes[::10]:
+            node["con"].close()
+
+        t = time.time()
+        sync(net)
+        elapsed = time.time() - t
+
+        assert(len(net.inbound + net.outbound) == n - len(nodes[::10]))
+        net.close_cons()
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+if __name__ == "__main__":
+    print("%-8s %14s %14s %10s" % ("cons", "legacy (ms)", "current (ms)",
+                                   "speed up"))
+    for n in [10, 100, 1000, 10000]:
+        legacy = bench(legacy_synchronize, n)
+        current = bench(Net.synchronize, n)
+        print("%-8d %14.3f %14.3f %9.1fx" % (n, legacy * 1000,
+                                             current * 1000,
+                                             legacy / current))
@@ -0,0 +1,1075 @@
+"""
+asyncio versions of Sock, UNL and Net for running large numbers of
+connections on a single event loop (Python 3.5+ only.)
+
+The line protocol, passive server, bootstrap, advertise and UNL
+connect logic are the same as the blocking classes - the difference
+is that nothing sleeps while waiting on the network. Connections are
+awaited instead of polled so a UNL connect doesn't need its own
+thread:
+
+    net = AsyncNet(net_type="direct", dht_node=dht_node)
+    await net.start()
+
+    con = await net.unl.connect(their_unl)
+    if con is not None:
+        await con.send_line("test")
+        async for reply in con:
+            print(reply)
+
+Parts of the network code that are inherently blocking (NAT type
+detection, port forwarding and TCP hole punching) still use the
+blocking implementations but are run in the loop's default executor.
+"""
+
+import asyncio
+import binascii
+
+from .net import *
+from .sock import error_log_path
+from .unl import UNL
+
+
+# Runs blocking code in the default executor.
+async def run_blocking(func, *args):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, func, *args)
+
+
+class AsyncSock(object):
+    __slots__ = [
+        "reader", "writer", "timeout", "debug", "delimiter", "registry",
+        "con_id", "_nonce", "_unl", "reply_filter", "alive", "connected",
+        "addr", "port"
+    ]
+
+    def __init__(self, reader, writer, timeout=5, debug=0):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.debug = debug
+        self.delimiter = b"\r\n"
+        self.registry = None
+        self.con_id = None
+        self.nonce = None
+        self.unl = None
+        self.reply_filter = None
+        self.alive = time.time()
+        self.connected = 1
+
+        # Save addr + port.
+        try:
+            self.addr, self.port = writer.get_extra_info("peername")[:2]
+        except:
+            self.addr, self.port = None, None
+            self.connected = 0
+
+    @classmethod
+    async def connect(cls, addr, port, timeout=5, interface="default",
+                      max_buf=1024 * 1024):
+        # Make connection from custom interface.
+        local_addr = None
+        if interface != "default":
+            local_addr = (get_lan_ip(interface), 0)
+
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                addr, int(port), local_addr=local_addr, limit=max_buf
+            ),
+            timeout
+        )
+
+        return cls(reader, writer, timeout)
+
+    @classmethod
+    async def from_sock(cls, sock):
+        """
+        Takes over the socket of a connected Sock (e.g. one made by TCP
+        hole punching.) Anything already in its receive buffer is kept.
+        """
+        s = sock.s
+        s.setblocking(0)
+        reader, writer = await asyncio.open_connection(sock=s)
+        if len(sock.recv_buf):
+            reader.feed_data(sock.recv_buf.read())
+
+        con = cls(reader, writer, sock.timeout)
+        con.nonce = sock.nonce
+        con.unl = sock.unl
+
+        # The old object no longer owns the socket.
+        sock.s = None
+        sock.connected = 0
+
+        return con
+
+    @property
+    def nonce(self):
+        return self._nonce
+
+    @nonce.setter
+    def nonce(self, value):
+        self._nonce = value
+        if self.registry is not None:
+            self.registry.reindex(self)
+
+    @property
+    def unl(self):
+        return self._unl
+
+    @unl.setter
+    def unl(self, value):
+        self._unl = value
+        if self.registry is not None:
+            self.registry.reindex(self)
+
+    # Underlying socket (used for getpeername in Net.)
+    @property
+    def s(self):
+        return self.writer.get_extra_info("socket")
+
+    def debug_print(self, msg):
+        if self.debug:
+            print(str(msg))
+
+    def close(self):
+        self.connected = 0
+        if self.registry is not None:
+            self.registry.closed(self)
+        try:
+            self.writer.close()
+        except:
+            pass
+
+    async def send(self, msg, send_all=1, timeout=5):
+        """
+        Writes msg and waits until the transport's buffer has drained
+        below its high-water mark. Returns the number of bytes sent or 0
+        if the connection failed. (send_all is accepted for compatibility
+        with Sock - the whole message is always sent.)
+        """
+        if type(msg) == type(u""):
+            msg = encode_str(msg, "ascii")
+
+        return await self.send_buffers([msg], timeout)
+
+    async def send_buffers(self, buffers, timeout=5):
+        # Not connected.
+        if not self.connected:
+            return 0
+
+        try:
+            self.writer.writelines(buffers)
+            await asyncio.wait_for(self.writer.drain(), timeout or None)
+            return sum(len(buf) for buf in buffers)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.debug_print("Send closing " + str(e))
+            error = parse_exception(e)
+            log_exception(error_log_path, error)
+            self.close()
+            return 0
+
+    # Sends a new message delimitered by a new line.
+    async def send_line(self, msg, timeout=5):
+        # Sanity checking.
+        assert (len(msg))
+
+        if type(msg) == type(u""):
+            msg = encode_str(msg, "ascii")
+
+        return await self.send_buffers([msg, self.delimiter], timeout)
+
+    # Sends several lines at once. Returns the number of bytes sent.
+    async def send_lines(self, msgs, timeout=5):
+        buffers = []
+        for msg in msgs:
+            assert (len(msg))
+            if type(msg) == type(u""):
+                msg = encode_str(msg, "ascii")
+            buffers.append(msg)
+            buffers.append(self.delimiter)
+
+        if not len(buffers):
+            return 0
+
+        return await self.send_buffers(buffers, timeout)
+
+    async def recv(self, n, encoding="unicode", timeout=5):
+        """
+        Returns up to n bytes. An empty result means the connection
+        was closed or nothing arrived within timeout.
+        """
+        # Sanity checking.
+        assert n
+
+        ret = b""
+        if self.connected:
+            try:
+                ret = await asyncio.wait_for(self.reader.read(n),
+                                             timeout or None)
+                if not len(ret):
+                    self.close()
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.debug_print("Recv closing " + str(e))
+                self.close()
+
+        if encoding == "unicode":
+            ret = encode_str(ret, encoding)
+
+        return ret
+
+    async def recv_reply(self):
+        """
+        Waits for the next (non-empty) line that passes reply_filter.
+        Lines longer than the reader's limit (max_buf) close the
+        connection. Returns None when the connection is closed.
+        """
+        while self.connected:
+            try:
+                reply = await self.reader.readuntil(self.delimiter)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Includes EOF and lines that exceed the buffer limit.
+                self.debug_print("Recv reply closing " + str(e))
+                self.close()
+                break
+
+            self.alive = time.time()
+            reply = reply[:-len(self.delimiter)]
+
+            # Skip empty lines.
+            if not reply:
+                continue
+
+            reply = encode_str(reply, "unicode")
+            if self.reply_filter is not None:
+                if not self.reply_filter(reply):
+                    continue
+
+            return reply
+
+        return None
+
+    async def recv_line(self, timeout=5):
+        # Socket is disconnected.
+        if not self.connected:
+            return u""
+
+        try:
+            reply = await asyncio.wait_for(self.recv_reply(), timeout or None)
+        except asyncio.TimeoutError:
+            reply = None
+
+        if reply is None:
+            return u""
+
+        return reply
+
+    """
+    Replies are processed with:
+
+    async for reply in con:
+        ...
+
+    Iteration waits for new replies and ends when the connection closes.
+    """
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        reply = await self.recv_reply()
+        if reply is None:
+            raise StopAsyncIteration
+
+        return reply
+
+
+class AsyncUNL(UNL):
+    def __init__(self, *args, **kwargs):
+        UNL.__init__(self, *args, **kwargs)
+
+        # Their UNL -> future set when that connect attempt finishes.
+        self.pending_connects = {}
+
+        # Sim opens are done one at a time.
+        self.sim_open_lock = None
+
+        # How long to wait for a node to connect to us.
+        self.connect_timeout = 60
+
+    async def get_connection(
+        self,
+        our_unl,
+        their_unl,
+        master,
+        nonce,
+        force_master,
+        con_id
+    ):
+        # Attempt to connect.
+        con = None
+        for node_type in ["passive", "simultaneous"]:
+            # Matches for this node type.
+            nodes = []
+            if our_unl["node_type"] == node_type:
+                nodes.append(our_unl)
+
+            if their_unl["node_type"] == node_type:
+                nodes.append(their_unl)
+
+            # Try the next node type.
+            if not len(nodes):
+                continue
+
+            # We only want one connection.
+            if len(nodes) == 2:
+                if not master:
+                    # They will connect to us.
+                    nodes.remove(their_unl)
+                else:
+                    # We will connect to them.
+                    nodes.remove(our_unl)
+
+            # Don't connect to ourself.
+            node = nodes[0]
+            if node == their_unl:
+                # Make connection.
+                self.debug_print("Attempting to add node.")
+                con = await self.net.add_node(
+                    their_unl["wan_ip"], their_unl["listen_port"],
+                    their_unl["node_type"], timeout=60
+                )
+
+                # Configure connection.
+                if con is not None:
+                    con.nonce = nonce
+                    if con.connected:
+                        # Send nonce.
+                        bytes_sent = await con.send(nonce)
+                        if bytes_sent != 64 or not con.connected:
+                            con = None
+                        else:
+                            # Set UNL for sock.
+                            con.unl = their_unl["value"]
+                    else:
+                        self.debug_print("Con is not connected!")
+                        con = None
+                    break
+                else:
+                    self.debug_print("Add node returned None! \a")
+            else:
+                # Tell them to connect to us.
+                if self.dht_node is not None and force_master:
+                    con_request = "REVERSE_CONNECT:%s:%s" % (self.value,
+                                                             nonce)
+                    node_id = their_unl["node_id"]
+                    if int(binascii.hexlify(node_id), 16):
+                        self.pending_reverse_con.append(their_unl["value"])
+                        self.dht_node.repeat_relay_message(node_id,
+                                                           con_request)
+
+                # They will connect to us.
+                self.debug_print("Waiting for connection")
+                con = await self.net.wait_for_con(
+                    con_id=con_id, ip=their_unl["wan_ip"],
+                    timeout=self.connect_timeout
+                )
+                if con is not None:
+                    if con.connected:
+                        # Set UNL for sock.
+                        con.unl = their_unl["value"]
+                        break
+                    else:
+                        self.debug_print("Con is not connected!")
+                        con = None
+                        break
+
+        return con
+
+    async def connect_handler(self, their_unl, events, force_master,
+                              hairpin, nonce):
+        # Figure out who should make the connection.
+        our_unl = self.value.encode("ascii")
+        their_unl = their_unl.encode("ascii")
+        master = self.is_master(their_unl)
+
+        # See UNL.connect_handler.
+        if force_master:
+            master = 1
+
+        # Deconstruct binary UNLs into dicts.
+        our_unl = self.deconstruct(our_unl)
+        their_unl = self.deconstruct(their_unl)
+
+        if our_unl is None:
+            raise Exception("Unable to deconstruct our UNL.")
+
+        if their_unl is None:
+            raise Exception("Unable to deconstruct their UNL.")
+
+        # This means the nodes are behind the same router.
+        if our_unl["wan_ip"] == their_unl["wan_ip"]:
+            # Connect to LAN IP.
+            our_unl["wan_ip"] = our_unl["lan_ip"]
+            their_unl["wan_ip"] = their_unl["lan_ip"]
+
+            # Already behind NAT so no forwarding needed.
+            if hairpin:
+                our_unl["node_type"] = "passive"
+                their_unl["node_type"] = "passive"
+
+        # Generate con ID.
+        if nonce != "0" * 64:
+            # Check nonce length.
+            assert(len(nonce) == 64)
+
+            # Create con ID.
+            con_id = self.net.generate_con_id(
+                nonce,
+                our_unl["wan_ip"],
+                their_unl["wan_ip"]
+            )
+        else:
+            con_id = None
+
+        # Wait for other connects to the same UNL to finish.
+        pending = self.pending_connects.get(their_unl["value"])
+        if pending is not None:
+            # This is an undifferentiated duplicate.
+            if events is None:
+                return None
+
+            self.debug_print("Waiting for other unls to finish")
+            try:
+                await asyncio.wait_for(asyncio.shield(pending),
+                                       self.connect_timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        # Set pending UNL.
+        done = asyncio.get_event_loop().create_future()
+        self.pending_connects[their_unl["value"]] = done
+        if self.sim_open_lock is None:
+            self.sim_open_lock = asyncio.Lock()
+
+        con = None
+        try:
+            args = (our_unl, their_unl, master, nonce, force_master, con_id)
+            if (their_unl["node_type"] == "simultaneous" and
+                    our_unl["node_type"] != "passive"):
+                # Wait for any other hole punches to finish.
+                async with self.sim_open_lock:
+                    con = await self.get_connection(*args)
+            else:
+                con = await self.get_connection(*args)
+        except Exception as e:
+            self.debug_print("EXCEPTION IN UNL.GET_CONNECTION")
+            log_exception(self.net.error_log_path, parse_exception(e))
+        finally:
+            # Undo pending connect state.
+            if self.pending_connects.get(their_unl["value"]) is done:
+                del self.pending_connects[their_unl["value"]]
+            done.set_result(con)
+
+        # Only execute events if this function was called manually.
+        if events is not None:
+            # Success.
+            if con is not None:
+                if "success" in events:
+                    events["success"](con)
+
+            # Failure.
+            if con is None:
+                if "failure" in events:
+                    events["failure"](con)
+
+        return con
+
+    def connect(self, their_unl, events=None, force_master=1, hairpin=1,
+                nonce="0" * 64):
+        """
+        Returns a task that resolves to the connection (or None.) Await
+        it or pass callbacks in events like UNL.connect.
+        """
+        if events is None:
+            events = {}
+
+        return asyncio.ensure_future(
+            self.connect_handler(their_unl, events, force_master, hairpin,
+                                 nonce)
+        )
+
+
+class AsyncNet(Net):
+    def __init__(self, *args, **kwargs):
+        Net.__init__(self, *args, **kwargs)
+
+        # asyncio server for inbound connections.
+        self.server = None
+
+        # Futures waiting for a connection: ("id", con_id) / ("ip", ip).
+        self.con_waiters = {}
+
+        # Background tasks owned by this instance.
+        self.tasks = set()
+
+        # Periodic bootstrap, advertise, reaping etc.
+        self.maintain_task = None
+        self.maintain_interval = 1
+
+        # How long an inbound con has to send its nonce (direct nets.)
+        self.nonce_timeout = 60
+
+        # Set when we've asked to be removed from the bootstrap list.
+        self.left_fight = 0
+
+        # Socks from accepted challenges waiting to be taken over.
+        self.punched_cons = []
+
+        # Persistent rendezvous connection (see RendezvousClient.control.)
+        self.control_con = None
+        self.control_lock = None
+        self.control_checked = 0
+
+    def spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def reply_filter(self, msg):
+        # Allow duplicate replies?
+        record_seen = not self.enable_duplicates
+
+        # Check if message is old.
+        return not self.seen_messages.check(msg, record_seen)
+
+    async def rendezvous_connect(self):
+        for server in self.rendezvous_servers:
+            try:
+                return await AsyncSock.connect(
+                    server["addr"], server["port"], timeout=2,
+                    interface=self.interface
+                )
+            except (OSError, asyncio.TimeoutError) as e:
+                self.debug_print("Error in rendezvous_connect: " + str(e))
+
+        raise Exception("All rendezvous servers are down.")
+
+    async def rendezvous_control(self):
+        # Same as RendezvousClient.control.
+        con = self.control_con
+        if con is not None and con.connected:
+            idle = time.time() - self.control_checked
+            if idle < self.rendezvous.control_check_interval:
+                return con
+
+            if await con.send_line("SOURCE TCP"):
+                reply = await con.recv_line(timeout=2)
+                if reply.startswith("REMOTE TCP"):
+                    self.control_checked = time.time()
+                    return con
+
+        self.close_control()
+        self.control_con = await self.rendezvous_connect()
+        self.control_checked = time.time()
+        return self.control_con
+
+    async def rendezvous_request(self, msgs, replies=0, timeout=2):
+        # Same as RendezvousClient.control_request.
+        if self.control_lock is None:
+            self.control_lock = asyncio.Lock()
+
+        expected = replies
+        if not replies:
+            msgs = list(msgs) + ["SOURCE TCP"]
+            expected = 1
+
+        async with self.control_lock:
+            for attempt in range(0, 2):
+                con = await self.rendezvous_control()
+                lines = []
+                if await con.send_lines(msgs):
+                    while len(lines) < expected:
+                        reply = await con.recv_line(timeout=timeout)
+                        if not reply:
+                            break
+                        lines.append(reply)
+
+                    if len(lines) == expected:
+                        self.control_checked = time.time()
+                        return lines[:replies]
+
+                self.debug_print("Rendezvous request failed.")
+                self.close_control()
+
+            raise Exception("Rendezvous server request failed.")
+
+    def close_control(self):
+        if self.control_con is not None:
+            self.control_con.close()
+            self.control_con = None
+
+    async def leave_fight(self):
+        await self.rendezvous_request(["CLEAR"])
+        return 1
+
+    # Receive inbound connections.
+    async def start_passive_server(self):
+        self.server = await asyncio.start_server(
+            self.accept_con, self.passive_bind, self.passive_port,
+            backlog=self.max_inbound, reuse_address=True
+        )
+
+        # Check bound local port.
+        if not self.passive_port:
+            self.passive_port = self.server.sockets[0].getsockname()[1]
+
+    async def accept_con(self, reader, writer):
+        con = AsyncSock(reader, writer)
+        con.reply_filter = self.reply_filter
+
+        # Reject duplicate connections.
+        if len(self.inbound) >= self.max_inbound or \
+                not self.validate_node(con.addr, con.port):
+            self.debug_print("Validation failure")
+            con.close()
+            return
+
+        node = PeerRecord(con, "accept", con.addr, con.port)
+        self.inbound.append(node)
+        self.registry.add(node)
+        self.debug_print("Accepted new passive connection: " + str(node))
+        await self.recv_nonce(node)
+
+    async def recv_nonce(self, node):
+        """
+        Inbound connections to a direct net start with a 64 byte nonce
+        used to build their con ID. Until it's been received the
+        connection counts towards max_inbound but isn't returned when
+        iterating over the net or by con_by_id and wait_for_con isn't
+        woken up.
+        """
+        con = node["con"]
+        if self.net_type == "direct" and con.nonce is None:
+            try:
+                nonce = await asyncio.wait_for(con.reader.readexactly(64),
+                                               self.nonce_timeout)
+                con.nonce = encode_str(nonce, "unicode")
+            except Exception as e:
+                self.debug_print("Nonce not received: " + str(e))
+                con.close()
+                return
+
+        self.notify_con(node)
+
+    def notify_con(self, node):
+        # Wake up anything waiting for this connection.
+        con = node["con"]
+        keys = [("ip", node["ip"])]
+        if con.con_id is not None:
+            keys.append(("id", con.con_id))
+
+        for key in keys:
+            for future in self.con_waiters.pop(key, []):
+                if not future.done():
+                    future.set_result(con)
+
+    async def wait_for_con(self, con_id=None, ip=None, timeout=60):
+        """
+        Returns the connection with con_id (or from ip if con_id is None)
+        as soon as it's made, or None after timeout seconds.
+        """
+        if con_id is None:
+            con = self.con_by_ip(ip)
+            key = ("ip", ip)
+        else:
+            con = self.con_by_id(con_id)
+            key = ("id", con_id)
+
+        if con is not None:
+            return con
+
+        future = asyncio.get_event_loop().create_future()
+        self.con_waiters.setdefault(key, []).append(future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiters = self.con_waiters.get(key, [])
+            if future in waiters:
+                waiters.remove(future)
+                if not len(waiters):
+                    del self.con_waiters[key]
+
+    # Make an outbound con to a passive or simultaneous node.
+    async def add_node(self, node_ip, node_port, node_type, timeout=5):
+        # Correct type for port.
+        node_port = int(node_port)
+
+        # Debug info.
+        msg = "Attempting to connect to %s:%s:%s" % (
+            node_ip, str(node_port), node_type
+        )
+        self.debug_print(msg)
+
+        # Already connected to them.
+        if not self.enable_duplicate_ip_cons:
+            nodes = self.registry.by_ip.get(node_ip)
+            if nodes:
+                self.debug_print("Already connected.")
+                return nodes[0]["con"]
+
+        # Avoid connecting to ourself.
+        if not self.validate_node(node_ip, node_port):
+            self.debug_print("Validate node failed.")
+            return None
+
+        con = None
+        try:
+            # Make a simultaneous open connection.
+            if node_type == "simultaneous" and self.enable_simultaneous:
+                # Check they've started net first.
+                if not self.is_net_started:
+                    raise Exception("Make sure to start net before you add"
+                                    " node.")
+
+                # The challenge waits on its own (fixed) timeouts.
+                if self.nat_type in self.rendezvous.predictable_nats:
+                    try:
+                        self.debug_print("Attempting simultaneous challenge")
+                        sock = await run_blocking(
+                            self.rendezvous.simultaneous_challenge,
+                            node_ip, node_port, "TCP"
+                        )
+                    finally:
+                        self.rendezvous.simultaneous_cons = []
+
+                    if sock is not None:
+                        con = await AsyncSock.from_sock(sock)
+                        node_port = 0
+
+            # Passive outbound -- easiest to connect to.
+            if node_type == "passive":
+                con = await AsyncSock.connect(
+                    node_ip, node_port, timeout=timeout,
+                    interface=self.interface
+                )
+        except Exception as e:
+            self.debug_print("FAILURE")
+            error = parse_exception(e)
+            self.debug_print(error)
+            log_exception(self.error_log_path, error)
+            return None
+
+        # Record node details and return con.
+        if con is None:
+            self.debug_print("FAILURE")
+            return None
+
+        con.reply_filter = self.reply_filter
+        node = PeerRecord(con, node_type, node_ip, node_port)
+        self.outbound.append(node)
+        self.registry.add(node)
+        self.debug_print("SUCCESS")
+
+        return con
+
+    async def bootstrap(self):
+        """
+        Same as Net.bootstrap except the candidate nodes are connected
+        to concurrently.
+        """
+        # Disable bootstrap.
+        if not self.enable_bootstrap:
+            return None
+
+        # Avoid raping the rendezvous server.
+        t = time.time()
+        if self.last_bootstrap is not None:
+            if t - self.last_bootstrap <= rendezvous_interval:
+                self.debug_print("Bootstrapped recently")
+                return None
+        self.last_bootstrap = t
+        self.debug_print("Searching for nodes to connect to.")
+
+        try:
+            connection_slots = self.max_outbound - (len(self.outbound))
+            if connection_slots > 0:
+                # Retrieve random nodes to bootstrap with.
+                choices = (await self.rendezvous_request([
+                    "BOOTSTRAP " + str(self.max_outbound * 2)
+                ], 1))[0]
+                if choices == "NODES EMPTY":
+                    self.debug_print("Node list is empty.")
+                    return self
+                else:
+                    self.debug_print("Found node list.")
+
+                # Parse node list.
+                choices = re.findall(r"(?:(p|s)[:]([0-9]+[.][0-9]+[.][0-9]+[.][0-9]+)[:]([0-9]+))+\s?", choices)
+                passive_nodes = [node for node in choices if node[0] == "p"]
+
+                # Use passive to make up the remaining cons.
+                i = 0
+                while i < len(passive_nodes) and connection_slots > 0:
+                    batch = passive_nodes[i:i + connection_slots]
+                    cons = await asyncio.gather(*[
+                        self.add_node(node_ip, node_port, "passive")
+                        for node_type, node_ip, node_port in batch
+                    ])
+                    connection_slots -= len([c for c in cons if c])
+                    i += len(batch)
+
+        except Exception as e:
+            self.debug_print("Unknown error in bootstrap()")
+            error = parse_exception(e)
+            log_exception(self.error_log_path, error)
+
+        return self
+
+    async def advertise(self):
+        # Advertise is disabled.
+        if not self.enable_advertise:
+            self.debug_print("Advertise is disbled!")
+            return None
+
+        # Direct net server is reserved for direct connections only.
+        if self.net_type == "direct" and self.node_type == "passive":
+            return None
+
+        # Net isn't started!.
+        if not self.is_net_started:
+            raise Exception("Please call start() before you call advertise()")
+
+        # Avoid raping the rendezvous server with excessive requests.
+        t = time.time()
+        if self.last_advertise is not None:
+            if t - self.last_advertise <= advertise_interval:
+                return None
+
+            if len(self.inbound) >= self.min_connected:
+                return None
+
+        self.last_advertise = t
+
+        # Tell rendezvous server to list us.
+        try:
+            # We're a passive node.
+            if self.node_type == "passive" and\
+                    self.passive_port is not None:
+                await self.rendezvous_request(["PASSIVE READY %s %s" % (
+                    str(self.passive_port), str(self.max_inbound)
+                )])
+
+            # See Net.advertise.
+            if self.node_type == "simultaneous":
+                await run_blocking(self.rendezvous.simultaneous_listen)
+        except Exception as e:
+            error = parse_exception(e)
+            log_exception(self.error_log_path, error)
+
+        return self
+
+    async def accept_simultaneous_cons(self):
+        """
+        Handles hole punching challenges from the rendezvous server using
+        Net.accept_simultaneous_cons in the executor, then takes over the
+        new connections' sockets. Only the event loop adds to inbound.
+        """
+        if self.node_type != "simultaneous":
+            return
+
+        if self.rendezvous.server_con is None:
+            return
+
+        await run_blocking(Net.accept_simultaneous_cons, self)
+        socks, self.punched_cons = self.punched_cons, []
+        for sock in socks:
+            try:
+                con = await AsyncSock.from_sock(sock)
+            except Exception as e:
+                log_exception(self.error_log_path, parse_exception(e))
+                sock.close()
+                continue
+
+            con.reply_filter = self.reply_filter
+            node = PeerRecord(con, "simultaneous", con.addr, con.port)
+            self.inbound.append(node)
+            self.registry.add(node)
+            self.spawn(self.recv_nonce(node))
+
+    def add_simultaneous_con(self, con):
+        # Called from the executor: handed to the loop afterwards.
+        self.punched_cons.append(con)
+
+    async def start(self):
+        """
+        Same as Net.start. Also starts the task that bootstraps,
+        advertises and reaps dead connections in the background.
+        """
+        self.debug_print("Starting networking.")
+
+        # Save WAN IP.
+        self.debug_print("WAN IP = " + str(self.wan_ip))
+
+        # Check rendezvous server is up (kept for later requests.)
+        try:
+            await self.rendezvous_control()
+        except:
+            raise Exception("Unable to connect to rendezvous server.")
+
+        # Started no matter what
+        # since LAN connections are always possible.
+        await self.start_passive_server()
+
+        # Determine NAT type.
+        if self.nat_type == "unknown":
+            self.debug_print("Determining NAT type.")
+            nat_type = await run_blocking(self.rendezvous.determine_nat)
+            if nat_type is not None and nat_type != "unknown":
+                self.nat_type = nat_type
+                self.rendezvous.nat_type = nat_type
+                self.debug_print("NAT type = " + nat_type)
+            else:
+                self.debug_print("Unable to determine NAT type.")
+
+        # Check NAT type if node is simultaneous
+        # is manually specified.
+        if self.node_type == "simultaneous":
+            if self.nat_type not in self.rendezvous.predictable_nats:
+                self.debug_print("Manual setting of simultanous specified but"
+                                 " ignored since NAT does not support it.")
+                self.node_type = "active"
+        else:
+            # Determine node type.
+            if self.node_type == "unknown":
+                self.node_type = await run_blocking(self.determine_node)
+
+        # Prevent P2P nodes from running as simultaneous.
+        if self.net_type == "p2p":
+            if self.node_type == "simultaneous":
+                self.debug_print("Simultaneous is not allowed for P2P")
+                self.node_type = "active"
+                self.disable_simultaneous()
+
+        self.debug_print("Node type = " + self.node_type)
+
+        # Close stray cons from determine_node() tests.
+        self.close_cons()
+
+        # Set net started status.
+        self.is_net_started = 1
+
+        # Initialise our UNL details.
+        self.unl = AsyncUNL(
+            net=self,
+            dht_node=self.dht_node,
+            wan_ip=self.wan_ip
+        )
+
+        # Start background processing.
+        self.maintain_task = asyncio.ensure_future(self.maintain())
+
+        # Nestled calls.
+        return self
+
+    async def stop(self):
+        self.debug_print("Stopping networking.")
+
+        if self.maintain_task is not None:
+            self.maintain_task.cancel()
+            self.maintain_task = None
+
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+        if self.last_advertise is not None:
+            try:
+                await self.leave_fight()
+            except Exception as e:
+                log_exception(self.error_log_path, parse_exception(e))
+        self.close_control()
+
+        for task in list(self.tasks):
+            task.cancel()
+
+        for waiters in self.con_waiters.values():
+            for future in waiters:
+                if not future.done():
+                    future.set_result(None)
+        self.con_waiters = {}
+
+        self.close_cons()
+        self.is_net_started = 0
+
+    def close_cons(self):
+        # Close all connections.
+        for node in self.inbound + self.outbound:
+            node["con"].close()
+
+        # Start from scratch.
+        self.registry.clear()
+        self.inbound = []
+        self.outbound = []
+
+    # Send a message to all currently established connections.
+    async def broadcast(self, msg, source_con=None):
+        await asyncio.gather(*[
+            node["con"].send_line(msg)
+            for node in self.outbound + self.inbound
+            if node["con"] != source_con
+        ])
+
+    def synchronize(self):
+        # Clean up dead connections.
+        self.reap_cons()
+
+        # Timeout connections that haven't responded to reverse query.
+        self.expire_reverse_queries()
+
+        # Forget old message hashes.
+        self.seen_messages.expire()
+
+    async def maintain(self):
+        # Everything Net.synchronize does that isn't I/O driven.
+        while 1:
+            try:
+                self.synchronize()
+
+                # Check for reverse connect requests.
+                self.process_dht_messages()
+
+                # Accept hole punching challenges.
+                if len(self.inbound) < self.max_inbound:
+                    await self.accept_simultaneous_cons()
+
+                # QUIT - remove us from bootstrapping server.
+                if len(self.inbound) >= self.max_inbound:
+                    if not self.left_fight:
+                        self.left_fight = 1
+                        await self.leave_fight()
+                else:
+                    self.left_fight = 0
+
+                # Bootstrap again if needed.
+                await self.bootstrap()
+
+                # Relist node again if needed.
+                await self.advertise()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log_exception(self.error_log_path, parse_exception(e))
+
+            await asyncio.sleep(self.maintain_interval)
@@ -1,25 +1,36 @@
 import sys
+import base64
+import heapq
+import itertools
 import random
 import requests
 import binascii
+from requests.adapters import HTTPAdapter
 import umsgpack
 from ast import literal_eval
 from future.moves.urllib.parse import urlencode
 #from multiprocessing import Process as Thread, Event
-from threading import Thread, Event
+from threading import Thread, Event, Condition
+from collections import OrderedDict
 from storjkademlia.node import Node as KadNode
 from pyp2p.lib import is_ip_valid, is_valid_port
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 
 import json
 import string
-import binascii
+import struct
+import zlib
 
 try:
     from Queue import Queue  # py2
 except ImportError:
     from queue import Queue  # py3
 
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry
+
 import time
 import logging
 
@@ -33,6 +44,144 @@ RESERVATION_TIMEOUT = (10 * 60) - 5
 MUTEX_TIMEOUT = RESERVATION_TIMEOUT
 ALIVE_TIMEOUT = (60 * 10) - 5
 
+# msgpack extension type for several messages sent in one put.
+BATCH_EXT = 0x50
+
+# Messages are sent in a POST body (False: in the query string.) Needs
+# a dht_msg.php that reads msg from $_POST.
+POST_MESSAGES = False
+
+# Message envelope (see pack_message.)
+ENVELOPE_MARKER = "~"
+ENVELOPE_VERSION = 1
+FLAG_ZLIB = 1
+COMPRESS_THRESHOLD = 256  # Bytes of msgpack.
+
+# Threads running DHT calls (see WorkerPool.)
+WORKERS = 4
+MAX_RETRY_INTERVAL = 60
+
+# Kept-alive connections to dht_msg_endpoint per DHT: one per worker
+# (the long poll runs on one of them), the sender thread and a spare.
+POOL_SIZE = WORKERS + 2
+
+# (Connect, read) timeout for a long poll.
+LONG_POLL_TIMEOUT = (5, 60)
+
+
+def pack_message(msg):
+    """
+    Encodes msg as an envelope: a version byte, a flags byte and the
+    msgpack of msg (zlib compressed if it's over COMPRESS_THRESHOLD and
+    that makes it smaller.) It's URL safe base64 after ENVELOPE_MARKER
+    which never starts the old hexlified msgpack format.
+    """
+    payload = umsgpack.packb(msg)
+    flags = 0
+    if len(payload) > COMPRESS_THRESHOLD:
+        compressed = zlib.compress(payload, 1)
+        if len(compressed) < len(payload):
+            payload = compressed
+            flags |= FLAG_ZLIB
+
+    frame = struct.pack("BB", ENVELOPE_VERSION, flags) + payload
+    frame = base64.urlsafe_b64encode(frame).rstrip(b"=")
+    return ENVELOPE_MARKER + frame.decode("ascii")
+
+
+def unpack_message(data):
+    """
+    Returns (msg, legacy) for an envelope from pack_message or the
+    old hexlified msgpack (legacy = True.)
+    """
+    if type(data) == bytes:
+        data = data.decode("ascii")
+
+    if not data.startswith(ENVELOPE_MARKER):
+        return umsgpack.unpackb(binascii.unhexlify(data)), True
+
+    frame = data[len(ENVELOPE_MARKER):]
+    frame = base64.urlsafe_b64decode(frame + "=" * (-len(frame) % 4))
+    version, flags = struct.unpack("BB", frame[:2])
+    if version != ENVELOPE_VERSION:
+        raise ValueError("Unknown envelope version " + str(version))
+
+    payload = frame[2:]
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+
+    return umsgpack.unpackb(payload), False
+
+
+class WorkerPool(object):
+    """
+    A fixed number of threads running jobs from a queue plus one
+    thread that queues jobs as they become due (kept in a heap.)
+    """
+
+    def __init__(self, workers=WORKERS):
+        self.jobs = Queue()
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = Condition()
+        self.running = 1
+        self.threads = []
+        for i in range(0, workers):
+            self.start_thread(self.work)
+        self.start_thread(self.schedule_loop)
+
+    def start_thread(self, target):
+        t = Thread(target=target)
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+
+    def submit(self, f, *args):
+        self.jobs.put((f, args))
+
+    def call_later(self, delay, f, *args):
+        with self.cond:
+            entry = (time.time() + delay, next(self.counter), f, args)
+            heapq.heappush(self.heap, entry)
+
+            # Wake up earlier for this one.
+            if self.heap[0] is entry:
+                self.cond.notify()
+
+    def schedule_loop(self):
+        with self.cond:
+            while self.running:
+                now = time.time()
+                while len(self.heap) and self.heap[0][0] <= now:
+                    due, i, f, args = heapq.heappop(self.heap)
+                    self.jobs.put((f, args))
+
+                wait = None
+                if len(self.heap):
+                    wait = self.heap[0][0] - now
+                self.cond.wait(wait)
+
+    def work(self):
+        while 1:
+            job = self.jobs.get()
+            if job is None:
+                return
+
+            f, args = job
+            try:
+                f(*args)
+            except Exception as e:
+                log.exception(e)
+
+    def stop(self):
+        with self.cond:
+            self.running = 0
+            self.heap = []
+            self.cond.notify()
+
+        for t in self.threads:
+            self.jobs.put(None)
+
 
 class DHTProtocol:
     def __init__(self):
@@ -60,15 +209,26 @@ class DHT:
         self.networking = networking
         self.relay_links = {}
         self.protocol = DHTProtocol()
+        self.reactor = reactor
         self.is_registered = Event()
         self.is_mutex_ready = Event()
         self.is_neighbours_ready = Event()
-        self.handles = []
-        self.threads = []
+        self.session = self.build_session()
+        self.pool = None
         self.running = 1
         self.has_mutex = 0
         self.neighbours = []
 
+        # Outbound messages by destination (see queue_put.)
+        self.outbox = OrderedDict()
+        self.outbox_cond = Condition()
+        self.sender = None
+        self.max_batch = 20
+        self.batch_linger = 0.05  # Seconds to wait for more messages.
+        self.put_retries = None  # Unlimited.
+        self.put_retry_interval = 0.5  # Doubled each failed attempt.
+        self.max_put_retry_interval = 30
+
         # Register a new "account."
         if self.networking:
             self.register(self.node_id, self.password)
@@ -85,36 +245,112 @@ class DHT:
 
     def stop(self):
         self.running = 0
-        for handle in self.handles:
-            handle.close()
-            # handle.raw._fp.close()
+        with self.outbox_cond:
+            outbox = self.outbox
+            self.outbox = OrderedDict()
+            self.outbox_cond.notify()
+
+        # Unsent.
+        for batch in outbox.values():
+            for msg, d in batch["msgs"]:
+                self.fire(d, 0)
+
+        if self.pool is not None:
+            self.pool.stop()
+        self.session.close()
+
+    def build_session(self):
+        """
+        Every call to dht_msg_endpoint goes through one session so
+        connections are kept alive and reused. Calls aren't idempotent
+        (put adds a message, list pops them) so only failed connects
+        are retried.
+        """
+        retry = Retry(total=3, connect=3, read=0, status=0,
+                      backoff_factor=0.1)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE,
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        return session
+
+    def fire(self, d, result):
+        """
+        Fires d with result on the reactor thread. Deferreds returned
+        by put, queue_put and retry_in_thread are fired here from the
+        sender or worker threads. Without a running reactor there's
+        nothing to race so d is fired on the calling thread.
+        """
+        if self.reactor.running:
+            self.reactor.callFromThread(d.callback, result)
+        else:
+            d.callback(result)
 
     def hook_queue(self, q):
         self.protocol.messages_received = q
         self.check_for_new_messages()
 
-    def retry_in_thread(self, f, args={"args": None}, check_interval=2):
-        def thread_loop(this_obj):
-            while 1:
-                try:
-                    while not f(**args) and this_obj.running:
-                        time.sleep(check_interval)
+    def worker_pool(self):
+        # Started on first use.
+        if self.pool is None:
+            self.pool = WorkerPool()
+
+        return self.pool
+
+    def retry_in_thread(self, f, args={"args": None}, check_interval=2,
+                        backoff=2):
+        """
+        Calls f(**args) on the worker pool until it returns something
+        true, waiting check_interval seconds between tries (multiplied
+        by backoff each time up to MAX_RETRY_INTERVAL.) Returns a
+        Deferred fired with the result (see fire.)
+        """
+        d = defer.Deferred()
+        pool = self.worker_pool()
 
-                        if not this_obj.running:
-                            return
+        def attempt(interval):
+            if not self.running:
+                return
 
+            try:
+                ret = f(**args)
+                if ret:
+                    self.fire(d, ret)
                     return
-                except Exception as e:
-                    print("unknown exception")
-                    print(e)
-                    time.sleep(1)
+            except Exception as e:
+                self.debug_print("unknown exception")
+                self.debug_print(e)
 
-        t = Thread(target=thread_loop, args=(self,))
-        t.setDaemon(True)
-        self.threads.append(t)
-        t.start()
+            pool.call_later(interval, attempt,
+                            min(interval * backoff, MAX_RETRY_INTERVAL))
+
+        pool.submit(attempt, check_interval)
+        return d
+
+    def periodic(self, f, interval, retry_interval=1):
+        """
+        Calls f(args=None) on the worker pool now and then interval
+        seconds after each call finishes (retry_interval if it raised.)
+        """
+        pool = self.worker_pool()
+
+        def run():
+            if not self.running:
+                return
 
-        return t
+            delay = interval
+            try:
+                f(args=None)
+            except Exception as e:
+                self.debug_print("unknown exception")
+                self.debug_print(e)
+                delay = retry_interval
+
+            pool.call_later(delay, run)
+
+        pool.submit(run)
 
     def check_for_new_messages(self):
         def do(args):
@@ -124,9 +360,9 @@ class DHT:
             return 0
 
         if LONG_POLLING:
-            self.retry_in_thread(do, check_interval=0.1)
+            self.periodic(do, 0.1)
         else:
-            self.retry_in_thread(do, check_interval=2)
+            self.periodic(do, 2)
 
     def mutex_loop(self):
         def do(args):
@@ -136,14 +372,14 @@ class DHT:
             call += urlencode({"password": self.password})
 
             # Make API call.
-            ret = requests.get(call, timeout=5).text
+            ret = self.session.get(call, timeout=5).text
             if "1" in ret or "2" in ret:
                 self.has_mutex = int(ret)
             self.is_mutex_ready.set()
 
             return 0
 
-        self.retry_in_thread(do, check_interval=MUTEX_TIMEOUT)
+        self.periodic(do, MUTEX_TIMEOUT)
 
     def alive_loop(self):
         def do(args):
@@ -152,12 +388,12 @@ class DHT:
             call += urlencode({"node_id": self.node_id}) + "&"
             call += urlencode({"password": self.password})
 
-            # Make API call.
-            ret = requests.get(call, timeout=5)
+            # Make API call (read so the connection goes back to the pool.)
+            self.session.get(call, timeout=5).content
 
             return 0
 
-        self.retry_in_thread(do, check_interval=ALIVE_TIMEOUT)
+        self.periodic(do, ALIVE_TIMEOUT)
 
     def can_test_knode(self, id):
         for neighbour in self.neighbours:
@@ -183,7 +419,7 @@ class DHT:
             call += urlencode({"network_id": self.network_id})
 
             # Make API call.
-            ret = requests.get(call, timeout=5).text
+            ret = self.session.get(call, timeout=5).text
             ret = json.loads(ret)
             if type(ret) == dict:
                 ret = [ret]
@@ -212,7 +448,7 @@ class DHT:
 
             return 0
 
-        self.retry_in_thread(do, check_interval=ALIVE_TIMEOUT)
+        self.periodic(do, ALIVE_TIMEOUT)
 
     def get_neighbours(self):
         return self.neighbours
@@ -249,8 +485,7 @@ class DHT:
                    call += "&" + urlencode({"ip": self.ip})
 
                 # Make API call.
-                ret = requests.get(call, timeout=5)
-                self.handles.append(ret)
+                ret = self.session.get(call, timeout=5)
                 if "success" not in ret.text:
                     return 0
                 self.is_registered.set()
@@ -268,9 +503,24 @@ class DHT:
         }
         self.retry_in_thread(do, mappings)
 
+    def build_dht_responses(self, msg):
+        # Messages in a put (more than one if they were batched.)
+        msg, legacy = unpack_message(msg)
+        if isinstance(msg, umsgpack.Ext) and msg.type == BATCH_EXT:
+            msgs = umsgpack.unpackb(msg.data)
+        else:
+            msgs = [msg]
+
+        if legacy:
+            msgs = [self.decode_legacy(x) for x in msgs]
+
+        return msgs
+
     def build_dht_response(self, msg):
-        msg = binascii.unhexlify(msg)
-        msg = umsgpack.unpackb(msg)
+        return self.build_dht_responses(msg)[0]
+
+    def decode_legacy(self, msg):
+        # The old format sent some objects as their repr.
         try:
             str_types = [type(u""), type(b"")]
             if type(msg) in str_types:
@@ -281,21 +531,11 @@ class DHT:
         return msg
 
     def serialize_message(self, msg):
-        msg = umsgpack.packb(msg)
-        msg = binascii.hexlify(msg)
-        return msg
+        return pack_message(msg)
 
     def async_dht_put(self, key, value):
-        d = defer.Deferred()
-        def do(args):
-            t = self.put(key, value, list_pop=0)
-            while t.isAlive():
-                time.sleep(1)
-
-            d.callback("success")
-            return 1
-
-        self.retry_in_thread(do)
+        d = self.put(key, value, list_pop=0)
+        d.addCallback(lambda ret: "success")
         return d
 
     def async_dht_get(self, key):
@@ -303,9 +543,9 @@ class DHT:
         def do(args):
             ret = self.list(node_id=key, list_pop=0, timeout=5)
             if len(ret):
-                d.callback(ret[0])
+                self.fire(d, ret[0])
             else:
-                d.callback(None)
+                self.fire(d, None)
             return 1
 
         self.retry_in_thread(do)
@@ -320,23 +560,8 @@ class DHT:
                 return 1
 
             try:
-                # Send a message directly to a node in the "DHT"
-                call = dht_msg_endpoint + "?call=put&"
-                call += urlencode({"dest_node_id": node_id}) + "&"
-                msg = self.serialize_message(msg)
-                call += urlencode({"msg": msg}) + "&"
-                call += urlencode({"node_id": self.node_id}) + "&"
-                call += urlencode({"password": self.password}) + "&"
-                call += urlencode({"list_pop": list_pop})
-
-                # Make API call.
-                ret = requests.get(call, timeout=5)
-                self.handles.append(ret)
-                if "success" not in ret.text:
-                    return 0
-
-                return 1
-
+                return self.put_call(node_id, self.serialize_message(msg),
+                                     list_pop)
             except Exception as e:
                 # Reschedule call.
                 self.debug_print("DHT PUT TIMED OUT")
@@ -352,6 +577,140 @@ class DHT:
         }
         return self.retry_in_thread(do, mappings)
 
+    def put_call(self, node_id, msg, list_pop=1):
+        # Send a message directly to a node in the "DHT"
+        call = dht_msg_endpoint + "?call=put&"
+        call += urlencode({"dest_node_id": node_id}) + "&"
+        call += urlencode({"node_id": self.node_id}) + "&"
+        call += urlencode({"password": self.password}) + "&"
+        call += urlencode({"list_pop": list_pop})
+
+        # Make API call.
+        if POST_MESSAGES:
+            ret = self.session.post(call, data={"msg": msg}, timeout=5)
+        else:
+            call += "&" + urlencode({"msg": msg})
+            ret = self.session.get(call, timeout=5)
+        if "success" not in ret.text:
+            return 0
+
+        return 1
+
+    def queue_put(self, node_id, msg):
+        """
+        Queues msg for node_id and returns a Deferred that's fired with
+        1 once it's been sent or 0 if it couldn't be (see fire.) One
+        sender thread sends everything: messages for the same node
+        queued within batch_linger of the first go in one put (up to
+        max_batch.)
+        Failed puts go back in the outbox with a backoff and are tried
+        put_retries times (forever if it's None.)
+        """
+        d = defer.Deferred()
+        if node_id in self.relay_links:
+            relay_link = self.relay_links[node_id]
+            msg = self.build_dht_response(self.serialize_message(msg))
+            relay_link.protocol.messages_received.put_nowait(msg)
+            d.callback(1)
+            return d
+
+        with self.outbox_cond:
+            batch = self.outbox.get(node_id)
+            if batch is None:
+                batch = self.outbox[node_id] = {
+                    "due": time.time() + self.batch_linger,
+                    "msgs": [],
+                    "attempts": 0
+                }
+            batch["msgs"].append((msg, d))
+            self.outbox_cond.notify()
+
+            if self.sender is None:
+                self.sender = Thread(target=self.send_loop)
+                self.sender.daemon = True
+                self.sender.start()
+
+        return d
+
+    def next_batch(self):
+        # Waits for a destination to be due or have a full batch.
+        with self.outbox_cond:
+            while self.running:
+                wait = 1
+                now = time.time()
+                for node_id, batch in self.outbox.items():
+                    due = batch["due"] - now
+                    full = len(batch["msgs"]) >= self.max_batch
+                    if due <= 0 or (full and not batch["attempts"]):
+                        msgs = batch["msgs"][:self.max_batch]
+                        batch["msgs"] = batch["msgs"][self.max_batch:]
+                        del self.outbox[node_id]
+
+                        # Overflow waits its turn.
+                        if len(batch["msgs"]):
+                            self.outbox[node_id] = batch
+
+                        return node_id, msgs, batch["attempts"]
+
+                    wait = min(wait, due)
+
+                self.outbox_cond.wait(wait)
+
+        return None, [], 0
+
+    def retry_batch(self, node_id, msgs, attempts):
+        # Puts msgs back in front of anything since queued for node_id.
+        delay = self.put_retry_interval * 2 ** min(attempts - 1, 16)
+        delay = min(delay, self.max_put_retry_interval)
+        with self.outbox_cond:
+            if not self.running:
+                return 0
+
+            batch = self.outbox.pop(node_id, None)
+            if batch is not None:
+                msgs = msgs + batch["msgs"]
+            self.outbox[node_id] = {
+                "due": time.time() + delay,
+                "msgs": msgs,
+                "attempts": attempts
+            }
+            self.outbox_cond.notify()
+
+        return 1
+
+    def send_loop(self):
+        while self.running:
+            node_id, msgs, attempts = self.next_batch()
+            if not len(msgs):
+                continue
+
+            # A batch is one message wrapping the rest.
+            if len(msgs) == 1:
+                payload = msgs[0][0]
+            else:
+                payload = umsgpack.Ext(BATCH_EXT, umsgpack.packb([
+                    msg for msg, d in msgs
+                ]))
+            payload = self.serialize_message(payload)
+
+            sent = 0
+            try:
+                sent = self.put_call(node_id, payload)
+            except Exception as e:
+                self.debug_print("DHT PUT FAILED")
+                self.debug_print(e)
+
+            # Retried later so other nodes aren't held up.
+            attempts += 1
+            if not sent:
+                retries = self.put_retries
+                if retries is None or attempts < retries:
+                    if self.retry_batch(node_id, msgs, attempts):
+                        continue
+
+            for msg, d in msgs:
+                self.fire(d, sent)
+
     def list(self, node_id=None, password=None, list_pop=1, timeout=None):
         if not self.networking:
             return []
@@ -368,12 +727,10 @@ class DHT:
             # Make API call.
             if timeout is None:
                 if LONG_POLLING:
-                    timeout = None
+                    timeout = LONG_POLL_TIMEOUT
                 else:
                     timeout = 4
-            ret = requests.get(call, timeout=timeout)
-            self.handles.append(ret)
-            content_gen = ret.iter_content()
+            ret = self.session.get(call, timeout=timeout)
             messages = ret.text
             messages = json.loads(messages)
 
@@ -385,14 +742,15 @@ class DHT:
             ret = []
             if type(messages) == list:
                 for msg in messages:
-                    dht_response = self.build_dht_response(msg)
-                    ret.append(dht_response)
+                    # They've been popped so only skip the bad one.
+                    try:
+                        ret += self.build_dht_responses(msg)
+                    except Exception as e:
+                        log.warning("Skipped bad DHT message: %s" % str(e))
 
             return ret
         except Exception as e:
-            print("EXCEPTION IN DHT MSG LIST")
-            self.debug_print("Exception in dht msg list")
-            print(e)
+            log.warning("Exception in DHT msg list: %s" % str(e))
             return []
 
     def direct_message(self, node_id, msg):
@@ -418,7 +776,7 @@ class DHT:
         if type(node_id) != str:
             node_id = node_id.decode("utf-8")
 
-        self.put(node_id, msg)
+        return self.queue_put(node_id, msg)
 
     def get_id(self):
         node_id = self.node_id
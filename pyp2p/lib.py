@@ -453,14 +453,8 @@ def encode_str(s, encoding="unicode"):
         if type(s) == str:
             if encoding == "ascii":
                 # Encodes unicode directly as bytes.
-                codes = []
-                for ch in s:
-                    codes.append(ord(ch))
-
-                if len(codes):
-                    return bytes(codes)
-                else:
-                    return b""
+                # (Each code point becomes one byte, same as latin-1.)
+                return s.encode("latin-1")
         else:
             # bytes
             if encoding == "unicode":
@@ -6,8 +6,21 @@ this class.
 
 import hashlib
 import signal
-import zlib
-from ast import literal_eval
+import weakref
+from collections import OrderedDict
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    blake2b = None
+
+try:
+    import selectors
+except ImportError:
+    try:
+        import selectors34 as selectors  # py2
+    except ImportError:
+        selectors = None
 
 from .nat_pmp import NatPMP
 from .rendezvous_client import *
@@ -23,9 +36,6 @@ min_retransmit_interval = 5
 # A theoretical time for a message to propagate across the network.
 propagation_delay = 5
 
-# A table of message hashes for received messages.
-seen_messages = {}
-
 # How often to get new DHT messages.
 dht_msg_interval = 5
 
@@ -67,51 +77,341 @@ logging.basicConfig()
 log = logging.getLogger(__name__)
 
 
-def is_msg_old(msg, record_seen=0):
-    if type(msg) == str:
-        msg = msg.encode("ascii")
+class SeenMessage(object):
+    __slots__ = ["times", "last"]
 
-    response_hash = hashlib.sha256(msg).hexdigest()
-    if response_hash in seen_messages:
-        seen = seen_messages[response_hash]
-        elapsed = int(time.time()) - seen["last"]
-        if elapsed < min_retransmit_interval:
-            return 1
+    def __init__(self, times, last):
+        self.times = times
+        self.last = last
 
-        if seen["times"] >= max_retransmissions:
-            return 1
 
-    if record_seen:
-        record_msg_hash(msg)
+class SeenMessages(object):
+    """
+    Hashes of received messages used to reject duplicates. Entries are
+    keyed by raw digests (16 byte BLAKE2b where available) and kept in
+    least recently updated order so both expiry (after ttl seconds
+    without being seen) and eviction (past max_entries) only ever look
+    at the oldest entry.
+    """
 
-    return 0
+    # Every cache so clear_seen_messages() can reset them.
+    instances = weakref.WeakSet()
 
+    def __init__(self, max_entries=1024 * 64, ttl=None):
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
 
-def record_msg_hash(msg):
-    if type(msg) == str:
-        msg = msg.encode("ascii")
-    response_hash = hashlib.sha256(msg).hexdigest()
-
-    if not is_msg_old(msg):
-        timestamp = int(time.time())
-        if response_hash in seen_messages:
-            seen = seen_messages[response_hash]
-            seen["times"] += 1
-            seen["last"] = timestamp
-        else:
-            seen_messages[response_hash] = {
-                "times": 1,
-                "last": timestamp
-            }
+        # Long enough for every retransmission to propagate.
+        if ttl is None:
+            ttl = (max_retransmissions + 1) * min_retransmit_interval
+            ttl += propagation_delay
+        self.ttl = ttl
+
+        # When the oldest entry is due to expire.
+        self.next_expiry = 0
+
+        self.clock = time.time
+        SeenMessages.instances.add(self)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, msg):
+        return self.digest(msg) in self.entries
+
+    @staticmethod
+    def digest(msg):
+        if type(msg) == type(u""):
+            msg = msg.encode("utf-8")
+
+        # Only used to spot duplicates so a short digest is plenty.
+        if blake2b is not None:
+            return blake2b(msg, digest_size=16).digest()
+
+        return hashlib.sha256(msg).digest()
+
+    def expire(self, now=None):
+        if now is None:
+            now = self.clock()
+
+        # Oldest entries are first.
+        self.next_expiry = now + self.ttl
+        while len(self.entries):
+            digest, seen = next(iter(self.entries.items()))
+            if now - seen.last < self.ttl:
+                self.next_expiry = seen.last + self.ttl
+                break
+            del self.entries[digest]
+
+    def check(self, msg, record_seen=0):
+        """
+        Returns 1 if msg is a duplicate, otherwise 0 - recording it
+        first if record_seen is set. The message is only hashed once.
+        """
+        now = self.clock()
+        if now >= self.next_expiry:
+            self.expire(now)
+
+        digest = self.digest(msg)
+        seen = self.entries.get(digest)
+        if seen is not None:
+            elapsed = now - seen.last
+            if elapsed < min_retransmit_interval:
+                return 1
+
+            if seen.times >= max_retransmissions:
+                return 1
+
+        if record_seen:
+            if seen is not None:
+                del self.entries[digest]
+                seen.times += 1
+                seen.last = now
+            else:
+                seen = SeenMessage(1, now)
+
+                # Evict least recently seen.
+                while len(self.entries) >= self.max_entries:
+                    self.entries.popitem(last=False)
+
+            self.entries[digest] = seen
 
-        return 1
-    else:
         return 0
 
+    def is_msg_old(self, msg, record_seen=0):
+        return self.check(msg, record_seen)
+
+    def record_msg_hash(self, msg):
+        # 1 if it was recorded, 0 if it's a duplicate.
+        if self.check(msg, record_seen=1):
+            return 0
+
+        return 1
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.next_expiry = 0
+
+
+# Default cache for the module level functions.
+seen_messages = SeenMessages()
+
+
+def is_msg_old(msg, record_seen=0):
+    return seen_messages.is_msg_old(msg, record_seen)
+
+
+def record_msg_hash(msg):
+    return seen_messages.record_msg_hash(msg)
+
 
 def clear_seen_messages():
-    global seen_messages
-    seen_messages = {}
+    for cache in list(SeenMessages.instances):
+        cache.clear()
+
+
+class PeerRecord(object):
+    """
+    A connection in Net.inbound / Net.outbound. Fields can also be used
+    like the dicts nodes used to be (node["con"], node["ip"] etc.)
+    """
+
+    __slots__ = ["con", "type", "ip", "port"]
+
+    def __init__(self, con, type, ip, port):
+        self.con = con
+        self.type = type
+        self.ip = ip
+        self.port = port
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def get(self, key, default=None):
+        if key not in self.__slots__:
+            return default
+
+        return getattr(self, key)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.__slots__]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class ConRegistry(object):
+    """
+    Indexes a Net's connections by peer IP, con ID and UNL so lookups
+    don't have to scan every connection. Connections are added and
+    removed alongside Net.inbound / Net.outbound and reindexed when their
+    nonce or UNL is set. The con ID is derived once per connection and
+    cached on it as con.con_id.
+    """
+
+    def __init__(self, net):
+        self.net = net
+
+        # id(con) -> node.
+        self.nodes = {}
+
+        # Nodes whose con was closed since the last reap().
+        self.dead = []
+
+        # id(con) -> node for cons that still have queued output.
+        self.backlog = {}
+
+        # id(con) -> node for cons that haven't sent their nonce.
+        self.awaiting_nonce = {}
+
+        # id(con) -> (ip, con_id, unl) it's currently indexed under.
+        self.keys = {}
+
+        # Indexes.
+        self.by_ip = {}
+        self.by_id = {}
+        self.by_unl = {}
+
+        # Our LAN IP (only looked up when needed.)
+        self.lan_ip = None
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add(self, node):
+        con = node["con"]
+        self.nodes[id(con)] = node
+        con.registry = self
+        self.index(node)
+
+        # Catch up on anything that happened before it was added.
+        if not con.connected:
+            self.dead.append(node)
+        if len(getattr(con, "send_queue", ())):
+            self.backlog[id(con)] = node
+        self.net.watch(con)
+
+    def remove(self, node):
+        con = node["con"]
+        if self.nodes.get(id(con)) is not node:
+            return
+
+        self.unindex(con)
+        del self.nodes[id(con)]
+        self.backlog.pop(id(con), None)
+        self.net.unwatch(con)
+        if con.registry is self:
+            con.registry = None
+
+    def reindex(self, con):
+        node = self.nodes.get(id(con))
+        if node is None:
+            return
+
+        self.unindex(con)
+        self.index(node)
+
+    def clear(self):
+        for node in list(self.nodes.values()):
+            self.remove(node)
+        self.dead = []
+
+    def closed(self, con):
+        # Called by con.close().
+        node = self.nodes.get(id(con))
+        if node is not None:
+            self.dead.append(node)
+            self.net.unwatch(con)
+
+    def reap(self):
+        """
+        Removes cons closed since the last call from the indexes and
+        returns their nodes.
+        """
+        dead, self.dead = self.dead, []
+        for node in dead:
+            self.remove(node)
+
+        return dead
+
+    def queued(self, con):
+        # Called by con.flush() when output is left over.
+        node = self.nodes.get(id(con))
+        if node is not None:
+            self.backlog[id(con)] = node
+            self.net.watch(con)
+
+    def drained(self, con):
+        # Called by con.flush() when the last queued output is written.
+        if id(con) in self.nodes:
+            self.net.watch(con)
+
+    def pop_backlog(self):
+        backlog, self.backlog = self.backlog, {}
+        return list(backlog.values())
+
+    def our_ip(self, their_ip):
+        # Con IDs use the LAN IP for LAN connections.
+        if is_ip_private(their_ip):
+            if self.lan_ip is None:
+                self.lan_ip = get_lan_ip(self.net.interface)
+            return self.lan_ip
+
+        return self.net.wan_ip
+
+    def index(self, node):
+        con = node["con"]
+        ip = node["ip"]
+
+        # Derive con ID.
+        con.con_id = None
+        if con.nonce is not None:
+            try:
+                con.con_id = self.net.generate_con_id(con.nonce, ip,
+                                                      self.our_ip(ip))
+            except Exception as e:
+                self.net.debug_print("Unable to derive con ID: " + str(e))
+
+        self.by_ip.setdefault(ip, []).append(node)
+        if con.con_id is not None:
+            self.by_id[con.con_id] = node
+        if con.nonce is None:
+            self.awaiting_nonce[id(con)] = node
+        if con.unl is not None:
+            self.by_unl.setdefault(con.unl, []).append(node)
+        self.keys[id(con)] = (ip, con.con_id, con.unl)
+
+    def unindex(self, con):
+        node = self.nodes[id(con)]
+        ip, con_id, unl = self.keys.pop(id(con))
+        for index, key in [(self.by_ip, ip), (self.by_unl, unl)]:
+            nodes = index.get(key)
+            if nodes is not None and node in nodes:
+                nodes.remove(node)
+                if not len(nodes):
+                    del index[key]
+
+        if con_id is not None and self.by_id.get(con_id) is node:
+            del self.by_id[con_id]
+        self.awaiting_nonce.pop(id(con), None)
 
 
 class Net:
@@ -184,6 +484,12 @@ class Net:
         # (same hash as previous messages)?
         self.enable_duplicates = 1
 
+        # Hashes of recently received messages (for enable_duplicates.)
+        self.seen_messages = SeenMessages()
+
+        # Do connections queue outbound lines instead of blocking?
+        self.enable_send_queue = 1
+
         # Where should I store errors?
         self.error_log_path = error_log_path
 
@@ -230,14 +536,9 @@ class Net:
                     """u?("|')status("|')(:|,)\s+u?("|')RST("|')""",
                 ]
 
-                # Convert zlib packed binary to Python object.
+                # Already decoded by the DHT (see dht_msg.unpack_message.)
                 self.debug_print("In net dht" + str(type(msg)))
                 if type(msg) == type(b""):
-                    try:
-                        msg = literal_eval(zlib.decompress(msg))
-                    except:
-                        pass
-
                     # Encode result to unicode for RE checks.
                     """
                     If buffer errors result: enable this.
@@ -294,6 +595,25 @@ class Net:
         # Set to 1 when self.start() has been called.
         self.is_net_started = 0
 
+        # Connections indexed by IP, con ID and UNL.
+        self.registry = ConRegistry(self)
+
+        # Readiness based event loop used by poll().
+        self.selector = None
+
+        # Cons registered with the selector: id(con) -> (fileobj, events).
+        self.selector_socks = {}
+
+        # Passive server and rendezvous con registered with the selector.
+        self.selector_passive = None
+        self.selector_server_con = None
+
+        # When synchronize() last ran.
+        self.last_synchronize = 0
+
+        # Default time poll() waits for network activity.
+        self.poll_timeout = 0.5
+
         # Start synchronize thread.
         # t = Thread(target=self.synchronize_loop)
         # t.setDaemon(True)
@@ -323,6 +643,9 @@ class Net:
     def disable_forwarding(self):
         self.enable_forwarding = 0
 
+    def disable_send_queue(self):
+        self.enable_send_queue = 0
+
     def get_connection_no(self):
         return len(self.outbound) + len(self.inbound)
 
@@ -360,15 +683,9 @@ class Net:
 
             # Don't connect to same nodes.
             if same_nodes:
-                for node in self.outbound + self.inbound:
-                    try:
-                        addr, port = node["con"].s.getpeername()
-                        if node_ip == addr:
-                            self.debug_print("Already connected to this node.")
-                            return 0
-                    except Exception as e:
-                        print(e)
-                        return 0
+                if node_ip in self.registry.by_ip:
+                    self.debug_print("Already connected to this node.")
+                    return 0
 
         return 1
 
@@ -387,11 +704,11 @@ class Net:
         con = None
         try:
             if not self.enable_duplicate_ip_cons:
-                for node in self.outbound + self.inbound:
-                    if node_ip == node["ip"]:
-                        self.debug_print("Already connected.")
-                        con = node["con"]
-                        return con
+                nodes = self.registry.by_ip.get(node_ip)
+                if nodes:
+                    self.debug_print("Already connected.")
+                    con = nodes[0]["con"]
+                    return con
 
             # Avoid connecting to ourself.
             if not self.validate_node(node_ip, node_port):
@@ -426,13 +743,9 @@ class Net:
                     # Record node details and return con.
                     self.rendezvous.simultaneous_cons = []
                     if con is not None:
-                        node = {
-                            "con": con,
-                            "type": "simultaneous",
-                            "ip": node_ip,
-                            "port": 0
-                        }
+                        node = PeerRecord(con, "simultaneous", node_ip, 0)
                         self.outbound.append(node)
+                        self.registry.add(node)
                         self.debug_print("SUCCESS")
                     else:
                         self.debug_print("FAILURE")
@@ -443,13 +756,9 @@ class Net:
                     # Try connect to passive server.
                     con = Sock(node_ip, node_port, blocking=0,
                                timeout=timeout, interface=self.interface)
-                    node = {
-                        "con": con,
-                        "type": "passive",
-                        "ip": node_ip,
-                        "port": node_port
-                    }
+                    node = PeerRecord(con, "passive", node_ip, node_port)
                     self.outbound.append(node)
+                    self.registry.add(node)
                     self.debug_print("SUCCESS")
                 except Exception as e:
                     self.debug_print("FAILURE")
@@ -469,7 +778,7 @@ class Net:
                     record_seen = not self.enable_duplicates
 
                     # Check if message is old.
-                    return not is_msg_old(msg, record_seen)
+                    return not self.seen_messages.check(msg, record_seen)
 
                 return filter_msg_check
 
@@ -477,6 +786,7 @@ class Net:
             # If it's enabled.
             if con is not None:
                 con.reply_filter = filter_msg_check_builder()
+                con.enable_send_queue = self.enable_send_queue
 
     def bootstrap(self):
         """
@@ -508,15 +818,11 @@ class Net:
         try:
             connection_slots = self.max_outbound - (len(self.outbound))
             if connection_slots > 0:
-                # Connect to rendezvous server.
-                rendezvous_con = self.rendezvous.server_connect()
-
                 # Retrieve random nodes to bootstrap with.
-                rendezvous_con.send_line("BOOTSTRAP " +
-                                         str(self.max_outbound * 2))
-                choices = rendezvous_con.recv_line(timeout=2)
+                choices = self.rendezvous.control_request([
+                    "BOOTSTRAP " + str(self.max_outbound * 2)
+                ], 1)[0]
                 if choices == "NODES EMPTY":
-                    rendezvous_con.close()
                     self.debug_print("Node list is empty.")
                     return self
                 else:
@@ -524,7 +830,6 @@ class Net:
 
                 # Parse node list.
                 choices = re.findall("(?:(p|s)[:]([0-9]+[.][0-9]+[.][0-9]+[.][0-9]+)[:]([0-9]+))+\s?", choices)
-                rendezvous_con.s.close()
 
                 # Attempt to make active simultaneous connections.
                 passive_nodes = []
@@ -724,10 +1029,9 @@ class Net:
         # Save WAN IP.
         self.debug_print("WAN IP = " + str(self.wan_ip))
 
-        # Check rendezvous server is up.
+        # Check rendezvous server is up (kept for later requests.)
         try:
-            rendezvous_con = self.rendezvous.server_connect()
-            rendezvous_con.close()
+            self.rendezvous.control()
         except:
             raise Exception("Unable to connect to rendezvous server.")
 
@@ -807,6 +1111,7 @@ class Net:
 
         if self.last_advertise is not None:
             self.rendezvous.leave_fight()
+        self.rendezvous.close_control()
 
         """
         Just let the threads timeout by themselves.
@@ -818,21 +1123,30 @@ class Net:
         for con in self:
             con.close()
 
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+            self.selector_socks = {}
+            self.selector_passive = None
+            self.selector_server_con = None
+
         if signum is not None:
             raise Exception("Process was interrupted.")
 
     # Return a connection that matches a remote UNL.
     def con_by_unl(self, unl, cons=None):
+        if type(unl) == dict:
+            unl = unl["value"]
+
         if cons is None:
-            cons = self.outbound + self.inbound
+            nodes = self.registry.by_unl.get(unl, [])
+            cons = [node["con"] for node in nodes]
+
         for con in cons:
-            if not isinstance(con, Sock):
+            if isinstance(con, (PeerRecord, dict)):
                 con = con["con"]
 
             if con.unl is not None:
-                self.debug_print("CMP")
-                self.debug_print(unl)
-                self.debug_print(con.unl)
                 if unl == con.unl:
                     # Connection not ready.
                     if con.nonce is None and self.net_type == "direct":
@@ -840,23 +1154,20 @@ class Net:
 
                     return con
             else:
-                self.debug_print("\a")
                 self.debug_print("Con UNL is None (in con by unl)")
-                self.debug_print(cons)
 
         return None
 
     # Return a connection by its IP.
     def con_by_ip(self, ip):
-        for node in self.outbound + self.inbound:
+        for node in self.registry.by_ip.get(ip, []):
             # Used to block UNLs until nonces are received.
             # Otherwise they might try do I/O and ruin their protocols.
             if self.net_type == "direct":
-                if node["con"].nonce is None and self.net_type == "direct":
+                if node["con"].nonce is None:
                     continue
 
-            if node["ip"] == ip:
-                return node["con"]
+            return node["con"]
 
         return None
 
@@ -912,34 +1223,15 @@ class Net:
         return con_id
 
     def con_by_id(self, expected_id):
-        for node in self.outbound + self.inbound:
-            # Nothing to test.
-            if node["con"].nonce is None and self.net_type == "direct":
-                self.debug_print("Nonce not set")
-                continue
-
-            # Generate con_id from con.
-            try:
-                their_wan_ip, junk = node["con"].s.getpeername()
-            except:
-                continue
-            if is_ip_private(their_wan_ip):
-                our_wan_ip = get_lan_ip(self.interface)
-            else:
-                our_wan_ip = self.wan_ip
-            found_id = self.generate_con_id(
-                node["con"].nonce,
-                their_wan_ip,
-                our_wan_ip
-            )
-
-            # Check result.
-            if found_id == expected_id:
-                return node["con"]
+        # IDs are derived when a con's nonce is set (see ConRegistry.)
+        node = self.registry.by_id.get(expected_id)
+        if node is None or not node["con"].connected:
+            return None
 
-        return None
+        return node["con"]
 
     # Send a message to all currently established connections.
+    # (Lines are queued per connection so a slow peer can't stall the rest.)
     def broadcast(self, msg, source_con=None):
         for node in self.outbound + self.inbound:
             if node["con"] != source_con:
@@ -956,49 +1248,152 @@ class Net:
             self.start_passive_server()
 
         # Start from scratch.
+        self.registry.clear()
         self.inbound = []
         self.outbound = []
 
-    def synchronize(self):
-        # Clean up dead connections.
-        for node_list_name in ["self.inbound", "self.outbound"]:
-            node_list = eval(node_list_name)[:]
-            for node in node_list:
-                if not node["con"].connected:
-                    self.debug_print("\a")
-                    self.debug_print("Removing disconnected: " + str(node))
-                    eval(node_list_name).remove(node)
+    # Accept new passive inbound connections.
+    def accept_passive_cons(self):
+        if self.passive is not None:
+            r, w, e = select.select([self.passive], [], [], 0)
+            for s in r:
+                if s == self.passive:
+                    # Accept a new con from the listen queue.
+                    client, address = self.passive.accept()
+                    con = Sock(blocking=0)
+                    con.set_sock(client)
+                    con.enable_send_queue = self.enable_send_queue
+                    node_ip, node_port = con.s.getpeername()
+
+                    # Reject duplicate connections.
+                    if self.validate_node(node_ip, node_port):
+                        try:
+                            node = PeerRecord(con, "accept", node_ip,
+                                              node_port)
+                            self.inbound.append(node)
+                            self.registry.add(node)
+                            self.debug_print(
+                                    "Accepted new passive connection: " +
+                                    str(node))
+                        except:
+                            log.debug("con.s.get")
+                    else:
+                        self.debug_print("Validation failure")
+                        con.close()
 
-        # Timeout connections that haven't responded to reverse query.
-        old_reverse_queries = []
-        for reverse_query in self.pending_reverse_queries:
-            duration = time.time() - reverse_query["timestamp"]
-            if duration >= self.reverse_query_expiry:
-                reverse_query["con"].close()
-                old_reverse_queries.append(reverse_query)
+    # Accept new passive simultaneous connections.
+    def accept_simultaneous_cons(self):
+        if self.node_type == "simultaneous":
+            """
+            This is basically the code that passive simultaneous
+            nodes periodically call to parse any responses from the
+            Rendezvous Server which should hopefully be new
+            requests to initiate hole punching from active
+            simultaneous nodes.
+
+            If a challenge comes in, the passive simultaneous
+            node accepts the challenge by giving details to the
+            server for the challenging node (active simultaneous)
+            to complete the simultaneous open.
+            """
 
-        # Remove old reverse queries.
-        for reverse_query in old_reverse_queries:
-            self.pending_reverse_queries.remove(reverse_query)
+            # try:
+            t = time.time()
+            if self.rendezvous.server_con is not None:
+                for reply in self.rendezvous.server_con:
+                    # Reconnect.
+                    if re.match("^RECONNECT$", reply) is not None:
+                        if self.enable_advertise:
+                            self.rendezvous.simultaneous_listen()
+                        continue
 
-        # Get connection nonce (for building IDs.)
-        if self.net_type == "direct":
-            for node in self.inbound + self.outbound:
-                if node["con"].nonce is not None:
-                    continue
+                    # Find any challenges.
+                    # CHALLENGE 192.168.0.1 50184 50185 50186 50187 TCP
+                    parts = re.findall("^CHALLENGE ([0-9]+[.][0-9]+[.][0-9]+[.][0-9]+) ((?:[0-9]+\s?)+) (TCP|UDP)$", reply)
+                    if not len(parts):
+                        continue
+                    (candidate_ip, candidate_predictions, candidate_proto)\
+                        = parts[0]
+                    self.debug_print("Found challenge")
+                    self.debug_print(parts[0])
+
+                    # Already connected.
+                    if not self.validate_node(candidate_ip):
+                        self.debug_print("validation failed")
+                        continue
+
+                    # Last meeting was too recent.
+                    if t - self.last_passive_sim_open < sim_open_interval:
+                        continue
 
-                # Receive nonce part.
-                if len(node["con"].nonce_buf) < 64:
-                    assert(node["con"].blocking != 1)
-                    remaining = 64 - len(node["con"].nonce_buf)
-                    nonce_part = node["con"].recv(remaining)
-                    if len(nonce_part):
-                        node["con"].nonce_buf += nonce_part
+                    # Accept challenge.
+                    if self.sys_clock is not None:
+                        origin_ntp = self.sys_clock.time()
+                    else:
+                        origin_ntp = get_ntp()
+                    if origin_ntp is None:
+                        continue
+                    msg = "ACCEPT %s %s TCP %s" % (
+                        candidate_ip,
+                        self.rendezvous.predictions,
+                        str(origin_ntp)
+                    )
+                    ret = self.rendezvous.server_con.send_line(msg)
+                    if not ret:
+                        continue
 
-                # Set nonce.
-                if len(node["con"].nonce_buf) == 64:
-                    node["con"].nonce = node["con"].nonce_buf
+                    """
+                    Adding threading here doesn't work because Python's
+                    fake threads and the act of starting a thread ruins
+                    the timing between code synchronisation - especially
+                    code running on the same host or in a LAN. Will
+                    compensate by reducing the NTP delay to have the
+                    meetings occur faster and setting a limit for meetings
+                    to occur within the same period.
+                    """
+                    # Walk to fight and return holes made.
+                    self.last_passive_sim_open = t
+                    con = self.rendezvous.attend_fight(
+                        self.rendezvous.mappings, candidate_ip,
+                        candidate_predictions, origin_ntp
+                    )
+                    if con is not None:
+                        self.add_simultaneous_con(con)
 
+                    # Create new predictions ready to accept next client.
+                    self.rendezvous.simultaneous_cons = []
+                    if self.enable_advertise:
+                        self.rendezvous.simultaneous_listen()
+
+    def add_simultaneous_con(self, con):
+        # Record a con made by accepting a challenge.
+        con.enable_send_queue = self.enable_send_queue
+        try:
+            node_ip, node_port = con.s.getpeername()
+            node = PeerRecord(con, "simultaneous", node_ip, node_port)
+            self.inbound.append(node)
+            self.registry.add(node)
+        except Exception as e:
+            log.debug(str(e))
+
+    def expire_reverse_queries(self):
+        # Timeout connections that haven't responded to reverse query.
+        # Queries are appended as they're made so the oldest are first.
+        expired = 0
+        now = time.time()
+        for reverse_query in self.pending_reverse_queries:
+            duration = now - reverse_query["timestamp"]
+            if duration < self.reverse_query_expiry:
+                break
+
+            reverse_query["con"].close()
+            expired += 1
+
+        # Remove old reverse queries.
+        if expired:
+            del self.pending_reverse_queries[:expired]
+
+    def process_dht_messages(self):
         # Check for reverse connect requests.
         if self.dht_node is not None and self.net_type == "direct":
             # Don't do this every synch cycle.
@@ -1009,8 +1404,10 @@ class Net:
                     skip_dht_check = 1
 
             if not skip_dht_check and len(self.dht_messages):
-                processed = []
-                for dht_response in self.dht_messages:
+                # The DHT may add messages while we're working.
+                pending = self.dht_messages[:]
+                processed = set()
+                for dht_response in pending:
                     # Found reverse connect request.
                     msg = str(dht_response["message"])
                     if re.match("^REVERSE_CONNECT:[a-zA-Z0-9+/-=_\s]+:[a-fA-F0-9]{64}$", msg) is not None:
@@ -1047,7 +1444,7 @@ class Net:
 
                         # Skip if already connected.
                         if is_connected:
-                            processed.append(dht_response)
+                            processed.add(id(dht_response))
                             continue
 
                         # Ask if the source sent it.
@@ -1078,7 +1475,7 @@ class Net:
                                          {"success": success_builder()},
                                          nonce=nonce)
 
-                        processed.append(dht_response)
+                        processed.add(id(dht_response))
 
                     # Found reverse query (did you make this?)
                     elif re.match("^REVERSE_QUERY:[a-zA-Z0-9+/-=_\s]+$", msg)\
@@ -1096,7 +1493,7 @@ class Net:
                             self.debug_print(str(self.unl.pending_reverse_con))
                             self.debug_print("oops, we don't know about this"
                                              " reverse query!")
-                            processed.append(dht_response)
+                            processed.add(id(dht_response))
                             continue
                         else:
                             self.unl.pending_reverse_con.remove(
@@ -1106,153 +1503,96 @@ class Net:
                         query = "REVERSE_ORIGIN:" + self.unl.value
                         self.dht_node.repeat_relay_message(node_id, query)
 
-                        processed.append(dht_response)
+                        processed.add(id(dht_response))
 
                     # Found reverse origin (yes I made this.)
                     elif re.match("^REVERSE_ORIGIN:[a-zA-Z0-9+/-=_\s]+$", msg) \
                             is not None:
                         self.debug_print("Received reverse origin")
+                        their_unl = msg[len("REVERSE_ORIGIN:"):]
+                        remaining = []
                         for reverse_query in self.pending_reverse_queries:
-                            pattern = "^REVERSE_ORIGIN:" + reverse_query["unl"]
-                            pattern += "$"
-                            if re.match(pattern, msg) is not None:
+                            if reverse_query["unl"] == their_unl:
                                 self.debug_print("Removing pending reverse"
                                                  " query: success!")
-                                self.pending_reverse_queries.remove(
-                                        reverse_query)
-                                processed.append(dht_response)
+                                processed.add(id(dht_response))
+                            else:
+                                remaining.append(reverse_query)
+                        self.pending_reverse_queries[:] = remaining
 
                 # Remove processed messages.
-                for msg in processed:
-                    self.debug_print(msg)
-                    self.dht_messages.remove(msg)
+                if len(processed):
+                    for dht_response in pending:
+                        if id(dht_response) in processed:
+                            self.debug_print(dht_response)
+                    self.dht_messages[:len(pending)] = [
+                        dht_response for dht_response in pending
+                        if id(dht_response) not in processed
+                    ]
 
             self.last_dht_msg = t
 
-        # Accept inbound connections.
-        if len(self.inbound) < self.max_inbound:
-            # Accept new passive inbound connections.
-            if self.passive is not None:
-                r, w, e = select.select([self.passive], [], [], 0)
-                for s in r:
-                    if s == self.passive:
-                        # Accept a new con from the listen queue.
-                        client, address = self.passive.accept()
-                        con = Sock(blocking=0)
-                        con.set_sock(client)
-                        node_ip, node_port = con.s.getpeername()
-
-                        # Reject duplicate connections.
-                        if self.validate_node(node_ip, node_port):
-                            try:
-                                node = {
-                                    "type": "accept",
-                                    "con": con,
-                                    "ip": con.s.getpeername()[0],
-                                    "port": con.s.getpeername()[1],
-                                }
-                                self.inbound.append(node)
-                                self.debug_print(
-                                        "Accepted new passive connection: " +
-                                        str(node))
-                            except:
-                                log.debug("con.s.get")
-                        else:
-                            self.debug_print("Validation failure")
-                            con.close()
+    def reap_cons(self):
+        # Cons tell the registry when they're closed.
+        dead = self.registry.reap()
+        if not len(dead):
+            return
+
+        for node in dead:
+            self.debug_print("Removing disconnected: " + str(node))
+
+        self.inbound = [node for node in self.inbound
+                        if node["con"].connected]
+        self.outbound = [node for node in self.outbound
+                         if node["con"].connected]
+
+    def read_nonce(self, node):
+        # Receive nonce part.
+        con = node["con"]
+        if len(con.nonce_buf) < 64:
+            assert(con.blocking != 1)
+            remaining = 64 - len(con.nonce_buf)
+
+            # poll() may have read past the nonce: leave the rest for
+            # parse_buf.
+            if len(con.recv_buf) < remaining:
+                con.get_chunks(remaining)
+            nonce_part = con.recv_buf.read(remaining)
+            if len(nonce_part):
+                con.nonce_buf += encode_str(nonce_part, "unicode")
+
+        # Set nonce.
+        if len(node["con"].nonce_buf) == 64:
+            node["con"].nonce = node["con"].nonce_buf
 
-            # Accept new passive simultaneous connections.
-            if self.node_type == "simultaneous":
-                """
-                This is basically the code that passive simultaneous
-                nodes periodically call to parse any responses from the
-                Rendezvous Server which should hopefully be new
-                requests to initiate hole punching from active
-                simultaneous nodes.
-
-                If a challenge comes in, the passive simultaneous
-                node accepts the challenge by giving details to the
-                server for the challenging node (active simultaneous)
-                to complete the simultaneous open.
-                """
-
-                # try:
-                t = time.time()
-                if self.rendezvous.server_con is not None:
-                    for reply in self.rendezvous.server_con:
-                        # Reconnect.
-                        if re.match("^RECONNECT$", reply) is not None:
-                            if self.enable_advertise:
-                                self.rendezvous.simultaneous_listen()
-                            continue
+    def synchronize(self):
+        self.last_synchronize = time.time()
 
-                        # Find any challenges.
-                        # CHALLENGE 192.168.0.1 50184 50185 50186 50187 TCP
-                        parts = re.findall("^CHALLENGE ([0-9]+[.][0-9]+[.][0-9]+[.][0-9]+) ((?:[0-9]+\s?)+) (TCP|UDP)$", reply)
-                        if not len(parts):
-                            continue
-                        (candidate_ip, candidate_predictions, candidate_proto)\
-                            = parts[0]
-                        self.debug_print("Found challenge")
-                        self.debug_print(parts[0])
-
-                        # Already connected.
-                        if not self.validate_node(candidate_ip):
-                            self.debug_print("validation failed")
-                            continue
+        # Clean up dead connections.
+        self.reap_cons()
 
-                        # Last meeting was too recent.
-                        if t - self.last_passive_sim_open < sim_open_interval:
-                            continue
+        # Write out queued lines.
+        for node in self.registry.pop_backlog():
+            node["con"].flush()
 
-                        # Accept challenge.
-                        if self.sys_clock is not None:
-                            origin_ntp = self.sys_clock.time()
-                        else:
-                            origin_ntp = get_ntp()
-                        if origin_ntp is None:
-                            continue
-                        msg = "ACCEPT %s %s TCP %s" % (
-                            candidate_ip,
-                            self.rendezvous.predictions,
-                            str(origin_ntp)
-                        )
-                        ret = self.rendezvous.server_con.send_line(msg)
-                        if not ret:
-                            continue
+        # Timeout connections that haven't responded to reverse query.
+        self.expire_reverse_queries()
 
-                        """
-                        Adding threading here doesn't work because Python's
-                        fake threads and the act of starting a thread ruins
-                        the timing between code synchronisation - especially
-                        code running on the same host or in a LAN. Will
-                        compensate by reducing the NTP delay to have the
-                        meetings occur faster and setting a limit for meetings
-                        to occur within the same period.
-                        """
-                        # Walk to fight and return holes made.
-                        self.last_passive_sim_open = t
-                        con = self.rendezvous.attend_fight(
-                            self.rendezvous.mappings, candidate_ip,
-                            candidate_predictions, origin_ntp
-                        )
-                        if con is not None:
-                            try:
-                                node = {
-                                    "type": "simultaneous",
-                                    "con": con,
-                                    "ip": con.s.getpeername()[0],
-                                    "port": con.s.getpeername()[1],
-                                }
-                                self.inbound.append(node)
-                            except:
-                                log.debug(str(e))
-                                pass
+        # Forget old message hashes.
+        self.seen_messages.expire()
 
-                        # Create new predictions ready to accept next client.
-                        self.rendezvous.simultaneous_cons = []
-                        if self.enable_advertise:
-                            self.rendezvous.simultaneous_listen()
+        # Get connection nonce (for building IDs.)
+        if self.net_type == "direct":
+            for node in list(self.registry.awaiting_nonce.values()):
+                self.read_nonce(node)
+
+        # Check for reverse connect requests.
+        self.process_dht_messages()
+
+        # Accept inbound connections.
+        if len(self.inbound) < self.max_inbound:
+            self.accept_passive_cons()
+            self.accept_simultaneous_cons()
 
         # QUIT - remove us from bootstrapping server.
         if len(self.inbound) == self.max_inbound:
@@ -1268,6 +1608,161 @@ class Net:
         # Relist node again if noded.
         self.advertise()
 
+    def watch(self, con):
+        """
+        Registers a connection with poll()'s selector or updates the
+        events it waits for. Connections only ask for write readiness
+        while they have queued output. Called by the registry as cons
+        are added or queue output so poll() doesn't scan every con.
+        """
+        if self.selector is None:
+            return
+
+        if not con.connected or con.blocking or con.s is None:
+            self.unwatch(con)
+            return
+
+        events = selectors.EVENT_READ
+        if len(con.send_queue):
+            events |= selectors.EVENT_WRITE
+
+        registered = self.selector_socks.get(id(con))
+        if registered is not None:
+            fileobj, old_events = registered
+            if fileobj is con.s:
+                if old_events != events:
+                    self.selector.modify(fileobj, events, ("con", con))
+                    self.selector_socks[id(con)] = (fileobj, events)
+                return
+
+            # Socket was replaced.
+            self.unwatch(con)
+
+        self.selector_register(con.s, events, ("con", con))
+        self.selector_socks[id(con)] = (con.s, events)
+
+    def unwatch(self, con):
+        registered = self.selector_socks.pop(id(con), None)
+        if registered is not None:
+            self.selector_unregister(registered[0])
+
+    def selector_register(self, fileobj, events, data):
+        try:
+            self.selector.register(fileobj, events, data)
+        except KeyError:
+            # File descriptor was reused after a close we weren't told of.
+            self.selector.unregister(fileobj.fileno())
+            self.selector.register(fileobj, events, data)
+
+    def selector_unregister(self, fileobj):
+        try:
+            self.selector.unregister(fileobj)
+        except (KeyError, ValueError):
+            pass
+
+    def update_selector(self):
+        """
+        Creates the selector on first use (registering the current cons)
+        and follows changes to the passive server and the rendezvous
+        server connection. Cons are kept up to date by watch().
+        """
+        if self.selector is None:
+            self.selector = selectors.DefaultSelector()
+            for node in self.inbound + self.outbound:
+                self.watch(node["con"])
+
+        if self.passive is not self.selector_passive:
+            if self.selector_passive is not None:
+                self.selector_unregister(self.selector_passive)
+            self.selector_passive = self.passive
+            if self.passive is not None:
+                self.selector_register(self.passive, selectors.EVENT_READ,
+                                       ("passive", None))
+
+        server_con = self.rendezvous.server_con
+        if server_con is not None and not server_con.connected:
+            server_con = None
+        server_sock = server_con.s if server_con is not None else None
+        if self.selector_server_con is not None:
+            con, fileobj = self.selector_server_con
+            if con is not server_con or fileobj is not server_sock:
+                self.selector_unregister(fileobj)
+                self.selector_server_con = None
+        if server_con is not None and self.selector_server_con is None:
+            self.selector_register(server_sock, selectors.EVENT_READ,
+                                   ("rendezvous", server_con))
+            self.selector_server_con = (server_con, server_sock)
+
+    def poll(self, timeout=None):
+        """
+        Event driven alternative to calling synchronize() on a timer.
+        Waits up to timeout seconds (default: self.poll_timeout) for the
+        passive server, any connection or the rendezvous server to become
+        ready and only then accepts, reads or writes. Selector
+        registrations change only when cons open, close or queue output
+        and the time based work in synchronize() runs at most once every
+        poll_timeout, so idle peers cost nothing. Replies are read into
+        each connection's buffer ready for the usual:
+
+        for con in net:
+            for reply in con:
+                ...
+
+        Returns the connections that received data.
+        """
+        if timeout is None:
+            timeout = self.poll_timeout
+
+        # Fall back on polling.
+        if selectors is None:
+            time.sleep(timeout)
+            self.synchronize()
+            return list(self)
+
+        self.update_selector()
+        ready = []
+        events = self.selector.select(timeout)
+
+        # Anything readable is read below so update() doesn't need to
+        # recv on watched cons (it clears the flag once it's used.)
+        for node in self.inbound + self.outbound:
+            if id(node["con"]) in self.selector_socks:
+                node["con"].event_driven = 1
+
+        for key, mask in events:
+            kind, con = key.data
+            if kind == "passive":
+                if len(self.inbound) < self.max_inbound:
+                    self.accept_passive_cons()
+                continue
+
+            if mask & selectors.EVENT_READ:
+                con.get_chunks()
+                if kind == "con":
+                    ready.append(con)
+
+            if mask & selectors.EVENT_WRITE:
+                con.flush()
+
+            # Challenges from the rendezvous server.
+            if kind == "rendezvous" and \
+                    len(self.inbound) < self.max_inbound:
+                self.accept_simultaneous_cons()
+
+        # Nonces that just arrived.
+        if self.net_type == "direct":
+            for con in ready:
+                node = self.registry.awaiting_nonce.get(id(con))
+                if node is not None:
+                    self.read_nonce(node)
+
+        # Everything else that's time based.
+        self.reap_cons()
+        if time.time() - self.last_synchronize >= self.poll_timeout:
+            self.synchronize()
+
+        return ready
+
     """
     These functions here make the class behave like a list. The
     list is a collection of connections (inbound) + (outbound.)
@@ -33,7 +33,7 @@ Todo:
 
 import gc
 import logging
-from threading import Thread
+from threading import RLock, Thread
 
 import psutil
 
@@ -65,6 +65,19 @@ class RendezvousClient:
         self.predictable_nats = ["preserving", "delta"]
         self.sys_clock = sys_clock
 
+        # Persistent connection for PASSIVE READY, BOOTSTRAP, CLEAR etc.
+        self.control_con = None
+        self.control_lock = RLock()
+        self.control_checked = 0
+        self.control_check_interval = 30  # Idle seconds before a check.
+
+        # Racing connects to the servers (see race_connect.)
+        self.enable_race = 1
+        self.connect_stagger = 0.25  # Seconds between connect attempts.
+        self.connect_timeout = 2
+        self.server_retry_interval = 60  # Failed servers go last for this.
+        self.server_health = {}  # (addr, port) -> RTT and failures.
+
     def server_connect(self, sock=None, index=None, servers=None):
         # Get server index if appropriate.
         servers = servers or self.rendezvous_servers[:]
@@ -73,6 +86,10 @@ class RendezvousClient:
                 servers[index]
             ]
 
+        # A pre-bound socket can only make one attempt at a time.
+        if sock is None and self.enable_race and len(servers) > 1:
+            return self.race_connect(servers)
+
         for server in servers:
             log.debug("Trying server:" + str(server))
 
@@ -100,11 +117,216 @@ class RendezvousClient:
 
         raise Exception("All rendezvous servers are down.")
 
+    def server_order(self, servers):
+        """
+        Servers that haven't failed recently first, then fastest
+        first by their smoothed RTT. Servers with no score yet keep
+        their configured order ahead of the rest.
+        """
+        now = time.time()
+
+        def score(server):
+            health = self.server_health.get((server["addr"], server["port"]))
+            if health is None:
+                return (0, 0)
+
+            return (health["down_until"] > now, health["rtt"])
+
+        return sorted(servers, key=score)
+
+    def record_server(self, server, rtt=None, failed=0, slower_than=None):
+        key = (server["addr"], server["port"])
+        health = self.server_health.setdefault(key, {
+            "rtt": 0.0,
+            "failures": 0,
+            "down_until": 0
+        })
+
+        if failed:
+            health["failures"] += 1
+            health["down_until"] = time.time() + self.server_retry_interval
+            return
+
+        # Abandoned while connecting so it's at least this slow.
+        if slower_than is not None:
+            health["rtt"] = max(health["rtt"], slower_than)
+            return
+
+        # EWMA.
+        if health["rtt"]:
+            health["rtt"] = health["rtt"] * 0.7 + rtt * 0.3
+        else:
+            health["rtt"] = rtt
+        health["failures"] = 0
+        health["down_until"] = 0
+
+    def race_connect(self, servers):
+        """
+        Happy eyeballs: starts non-blocking connects to the servers
+        (best first) connect_stagger seconds apart - or straight away
+        if one fails - and returns a Sock for whichever connects
+        first. The others are closed.
+        """
+        queue = self.server_order(servers)
+        pending = {}  # Socket -> (server, start time.)
+        winner = None
+        next_start = 0
+        try:
+            while winner is None and (len(queue) or len(pending)):
+                # Start the next server.
+                now = time.time()
+                if len(queue) and (now >= next_start or not len(pending)):
+                    server = queue.pop(0)
+                    log.debug("Racing server:" + str(server))
+                    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    try:
+                        if self.interface != "default":
+                            s.bind((get_lan_ip(self.interface), 0))
+                        s.setblocking(0)
+                        err = s.connect_ex((server["addr"],
+                                            int(server["port"])))
+                        if err not in (0, errno.EINPROGRESS,
+                                       errno.EWOULDBLOCK):
+                            raise socket.error(err, os.strerror(err))
+                    except socket.error as e:
+                        log.debug("Error in race_connect: " + str(e))
+                        s.close()
+                        self.record_server(server, failed=1)
+                        continue
+
+                    pending[s] = (server, now)
+                    next_start = now + self.connect_stagger
+                    continue
+
+                # Wait for a connect to finish or the next start.
+                due = min(started + self.connect_timeout
+                          for server, started in pending.values())
+                if len(queue):
+                    due = min(due, next_start)
+                socks = list(pending)
+                r, w, x = select.select([], socks, socks,
+                                        max(due - now, 0))
+
+                now = time.time()
+                for s in set(w + x):
+                    server, started = pending.pop(s)
+                    err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if not err:
+                        if winner is None:
+                            winner = (s, server, now - started)
+                        else:
+                            s.close()
+                            self.record_server(server, rtt=now - started)
+                        continue
+
+                    log.debug("Error in race_connect: " + os.strerror(err))
+                    s.close()
+                    self.record_server(server, failed=1)
+                    next_start = now
+
+                # Timed out.
+                for s, (server, started) in list(pending.items()):
+                    if now >= started + self.connect_timeout:
+                        del pending[s]
+                        s.close()
+                        self.record_server(server, failed=1)
+        finally:
+            for s, (server, started) in pending.items():
+                s.close()
+                self.record_server(server, slower_than=time.time() - started)
+
+        if winner is None:
+            raise Exception("All rendezvous servers are down.")
+
+        s, server, rtt = winner
+        self.record_server(server, rtt=rtt)
+        log.debug("server con made")
+        con = Sock(
+            blocking=1,
+            interface=self.interface,
+            timeout=2
+        )
+        con.set_sock(s)
+
+        return con
+
+    def control(self):
+        """
+        Returns the persistent control connection to the first
+        rendezvous server that's up. It's health checked with SOURCE TCP
+        if it's been idle for a while and replaced if it's closed or
+        the check fails.
+        """
+        with self.control_lock:
+            con = self.control_con
+            if con is not None and con.connected:
+                idle = time.time() - self.control_checked
+                if idle < self.control_check_interval:
+                    return con
+
+                if self.check_control(con):
+                    return con
+
+            self.close_control()
+            self.control_con = self.server_connect()
+            self.control_checked = time.time()
+            return self.control_con
+
+    def check_control(self, con):
+        # Servers always answer SOURCE TCP.
+        if not con.send_line("SOURCE TCP"):
+            return 0
+
+        reply = con.recv_line(timeout=2)
+        if not reply.startswith("REMOTE TCP"):
+            return 0
+
+        self.control_checked = time.time()
+        return 1
+
+    def control_request(self, msgs, replies=0, timeout=2):
+        """
+        Pipelines msgs down the control connection (one write) and
+        returns the next replies lines. If the connection has gone the
+        request is retried once on a new one. Requests without replies
+        are followed by SOURCE TCP so a half-dead connection can't
+        swallow them.
+        """
+        expected = replies
+        if not replies:
+            msgs = list(msgs) + ["SOURCE TCP"]
+            expected = 1
+
+        with self.control_lock:
+            for attempt in range(0, 2):
+                con = self.control()
+                lines = []
+                if con.send_lines(msgs):
+                    while len(lines) < expected:
+                        reply = con.recv_line(timeout=timeout)
+                        if not reply:
+                            break
+                        lines.append(reply)
+
+                    if len(lines) == expected:
+                        self.control_checked = time.time()
+                        return lines[:replies]
+
+                # Replies might arrive late so don't reuse it.
+                log.debug("Control request failed.")
+                self.close_control()
+
+            raise Exception("Rendezvous server request failed.")
+
+    def close_control(self):
+        with self.control_lock:
+            if self.control_con is not None:
+                self.control_con.close()
+                self.control_con = None
+
     # Delete any old rendezvous server state for node.
     def leave_fight(self):
-        con = self.server_connect()
-        con.send_line("CLEAR")
-        con.close()
+        self.control_request(["CLEAR"])
         return 1
 
     def add_listen_sock(self, mappings):
@@ -287,10 +509,8 @@ class RendezvousClient:
 
     def passive_listen(self, port, max_inbound=10):
         try:
-            con = self.server_connect()
             msg = "PASSIVE READY %s %s" % (str(port), str(max_inbound))
-            con.send_line(msg)
-            con.close()
+            self.control_request([msg])
             return 1
         except:
             return 0
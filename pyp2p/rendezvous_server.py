@@ -16,33 +16,346 @@ send the clear command which causes the server to remove
 the node details.
 """
 
-from twisted.internet import reactor
-from twisted.internet.protocol import Factory
+import argparse
+import bisect
+import heapq
+import itertools
+import logging
+import logging.handlers
+import multiprocessing
+import shutil
+import signal
+import tempfile
+from collections import deque
+from json.encoder import encode_basestring_ascii
+
+from twisted.internet import defer, reactor, task, threads
+from twisted.internet.protocol import Factory, ReconnectingClientFactory
 from twisted.protocols.basic import LineReceiver
+from twisted.python.threadpool import ThreadPool
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
 
 from .lib import *
+from .rendezvous_store import NodeTable, CandidateIndex, MemoryStore,\
+    StoreManager
 
 error_log_path = "error.log"
 debug = 1
+port_pattern = re.compile("^[0-9]+$")
+
+log = logging.getLogger(__name__)
+
+# Every line sent and received (see setup_logging.)
+access_log = None
+
+
+class AccessLog(object):
+    """
+    Buffered JSONL log of every line sent and received. Records are
+    kept as tuples and only formatted when they're written out, which
+    happens when buffer_size are waiting or on flush().
+    """
+
+    def __init__(self, path, buffer_size=1000):
+        self.fp = open(path, "ab")
+        self.buffer_size = buffer_size
+        self.records = []
+
+    def write(self, peer, direction, line):
+        self.records.append((time.time(), peer, direction, line))
+        if len(self.records) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        records, self.records = self.records, []
+        if not len(records):
+            return
+
+        entries = []
+        for t, peer, direction, line in records:
+            if type(line) == bytes:
+                line = line.decode("utf-8", "replace")
+            entries.append(
+                """{"time": %.6f, "peer": "%s", "direction": "%s", """
+                """"line": %s}\n""" % (
+                    t, peer, direction, encode_basestring_ascii(line)
+                )
+            )
+
+        self.fp.write("".join(entries).encode("ascii"))
+        self.fp.flush()
+
+    def close(self):
+        self.flush()
+        self.fp.close()
+
+
+def setup_logging(level=logging.INFO, log_path=None, access_log_path=None,
+                  buffer_size=1000, flush_interval=1, clock=None):
+    """
+    Logs to stderr (or log_path) and, if access_log_path is given,
+    writes every line sent and received to it as JSONL. Records are
+    buffered in memory and written out when buffer_size are waiting,
+    on an error or every flush_interval seconds.
+    """
+    global access_log
+    if log_path is None:
+        target = logging.StreamHandler()
+    else:
+        target = logging.FileHandler(log_path)
+    target.setFormatter(logging.Formatter("[%(asctime)s] %(message)s",
+                                          "%H:%M:%S %Y-%m-%d"))
+    log.addHandler(logging.handlers.MemoryHandler(buffer_size,
+                                                  logging.ERROR, target))
+    log.setLevel(level)
+
+    if access_log_path is not None:
+        access_log = AccessLog(access_log_path, buffer_size)
+
+    # Don't hold records back for long when it's quiet.
+    def flush():
+        for handler in log.handlers:
+            handler.flush()
+        if access_log is not None:
+            access_log.flush()
+
+    flusher = task.LoopingCall(flush)
+    flusher.clock = clock or reactor
+    flusher.start(flush_interval, now=False)
+
+    return flusher
+
+
+def stop_logging():
+    # Flushes and removes what setup_logging added.
+    global access_log
+    for handler in list(log.handlers):
+        handler.close()
+        log.removeHandler(handler)
+    if access_log is not None:
+        access_log.close()
+        access_log = None
+
+
+class ExpiryQueue(object):
+    """
+    Calls callbacks when they're due using a heap and a single
+    delayed call (clock.callLater) for whatever is due first.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock or reactor
+        self.heap = []
+        self.counter = itertools.count()
+        self.call = None
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, due, callback, *args):
+        entry = (due, next(self.counter), callback, args)
+        heapq.heappush(self.heap, entry)
+
+        # Wake up earlier for this one.
+        if self.heap[0] is entry:
+            self.wake()
+
+    def wake(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+        if len(self.heap):
+            delay = max(0, self.heap[0][0] - self.clock.seconds())
+            self.call = self.clock.callLater(delay, self.run)
+
+    def run(self):
+        self.call = None
+        now = self.clock.seconds()
+        while len(self.heap) and self.heap[0][0] <= now:
+            due, i, callback, args = heapq.heappop(self.heap)
+            try:
+                callback(*args)
+            except Exception as e:
+                error = parse_exception(e)
+                log_exception(error_log_path, error)
+
+        self.wake()
+
+    def stop(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+
+class Histogram(object):
+    # Cumulative buckets in the Prometheus style (seconds.)
+    bounds = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+              1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        total = 0
+        for bound, count in zip(self.bounds + ("+Inf",), self.counts):
+            total += count
+            lines.append('%s_bucket{%s,le="%s"} %d' % (
+                name, labels, bound, total
+            ))
+        lines.append("%s_sum{%s} %f" % (name, labels, self.sum))
+        lines.append("%s_count{%s} %d" % (name, labels, self.count))
+
+        return lines
+
+
+class Metrics(object):
+    """
+    Counters and latency histograms for one worker. Table sizes
+    come from the store when rendered so they cover every worker.
+    """
+
+    # CANDIDATE to the first CHALLENGE sent and to ACCEPT received.
+    # ACCEPT received to FIGHT sent (includes time queued for the store.)
+    stages = ("challenge", "accept", "fight")
+
+    def __init__(self):
+        self.commands = {}
+        self.unknown = 0
+        self.invalid = 0
+        self.lines_in = 0
+        self.lines_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.opened = 0
+        self.bootstrap_requested = 0
+        self.bootstrap_returned = 0
+        self.latency = dict((stage, Histogram()) for stage in self.stages)
+
+    def command(self, name):
+        self.commands[name] = self.commands.get(name, 0) + 1
+
+    def render(self, gauges):
+        # Prometheus text format.
+        lines = ["# TYPE rendezvous_commands_total counter"]
+        for name in sorted(self.commands):
+            lines.append('rendezvous_commands_total{command="%s"} %d' % (
+                name, self.commands[name]
+            ))
+        lines.append('rendezvous_commands_total{command="unknown"} %d' %
+                     self.unknown)
+        lines.append('rendezvous_commands_total{command="invalid"} %d' %
+                     self.invalid)
+
+        lines += [
+            "# TYPE rendezvous_lines_total counter",
+            'rendezvous_lines_total{direction="in"} %d' % self.lines_in,
+            'rendezvous_lines_total{direction="out"} %d' % self.lines_out,
+            "# TYPE rendezvous_bytes_total counter",
+            'rendezvous_bytes_total{direction="in"} %d' % self.bytes_in,
+            'rendezvous_bytes_total{direction="out"} %d' % self.bytes_out,
+            "# TYPE rendezvous_connections_opened_total counter",
+            "rendezvous_connections_opened_total %d" % self.opened,
+            "# TYPE rendezvous_bootstrap_nodes_total counter",
+            'rendezvous_bootstrap_nodes_total{kind="requested"} %d' %
+            self.bootstrap_requested,
+            'rendezvous_bootstrap_nodes_total{kind="returned"} %d' %
+            self.bootstrap_returned,
+            "# TYPE rendezvous_bootstrap_fill_ratio gauge",
+            "rendezvous_bootstrap_fill_ratio %f" % (
+                float(self.bootstrap_returned) /
+                (self.bootstrap_requested or 1)
+            )
+        ]
+
+        for name in sorted(gauges):
+            lines.append("# TYPE rendezvous_%s gauge" % name)
+            lines.append("rendezvous_%s %d" % (name, gauges[name]))
+
+        lines.append("# TYPE rendezvous_latency_seconds histogram")
+        for stage in self.stages:
+            lines += self.latency[stage].render(
+                "rendezvous_latency_seconds", 'stage="%s"' % stage
+            )
+
+        return "\n".join(lines) + "\n"
+
+
+class MetricsResource(Resource):
+    # Serves RendezvousFactory.metrics on any path.
+    isLeaf = True
+
+    def __init__(self, factory):
+        Resource.__init__(self)
+        self.factory = factory
+
+    def render_GET(self, request):
+        request.setHeader(b"Content-Type",
+                          b"text/plain; version=0.0.4; charset=utf-8")
+
+        # Table sizes come from the store (off the reactor thread.)
+        closed = []
+        request.notifyFinish().addErrback(closed.append)
+
+        def write(gauges):
+            if not closed:
+                body = self.factory.metrics.render(gauges)
+                request.write(body.encode("ascii"))
+                request.finish()
+
+        def failed(failure):
+            self.factory.store_failed(failure)
+            if not closed:
+                request.setResponseCode(503)
+                request.finish()
+
+        d = self.factory.call_store(self.factory.gauges)
+        d.addCallbacks(write, failed)
+        return NOT_DONE_YET
+
+
+def listen_stats(factory, port, interface="127.0.0.1"):
+    """
+    Serves the factory's metrics over HTTP. It's local only by
+    default and cheap enough to scrape every few seconds.
+    """
+    return reactor.listenTCP(port, Site(MetricsResource(factory)),
+                             interface=interface)
 
 
 class RendezvousProtocol(LineReceiver):
     def __init__(self, factory):
         self.factory = factory
-        self.challege_timeout = 60 * 2  # Seconds.
-        self.node_lifetime = 60 * 60 * 24  # 12 hours.
-        self.cleanup = 5 * 60  # Every 5 minutes.
+        self.challenge_timeout = factory.challenge_timeout
+        self.node_lifetime = factory.node_lifetime
         self.max_candidates = 100  # Per simultaneous node.
         self.connected = False
+        self.metrics = factory.metrics
+
+        # Peer details (set when the connection is made.)
+        self.ip_addr = None
+        self.port = None
+        self.who = None
+
+        # (worker ID, con ID) that the store knows us by.
+        self.ref = None
+
+        # When the line being handled was received.
+        self.received = time.time()
 
     def log_entry(self, msg, direction="none"):
         if sys.version_info >= (3, 0, 0):
             if type(msg) == bytes:
                 msg = msg.decode("utf-8")
-        ip_addr = str(self.transport.getPeer().host)
-        port = str(self.transport.getPeer().port)
-        when = time.strftime("%H:%M:%S %Y-%m-%d")
-        who = """%s:%s""" % (ip_addr, port)
         if direction == "send":
             direction = " -> "
         elif direction == "recv":
@@ -50,10 +363,49 @@ class RendezvousProtocol(LineReceiver):
         else:
             direction = " "
 
-        entry = """[%s] %s%s%s""" % (when, msg, direction, who)
+        entry = """%s%s%s""" % (msg, direction, self.who)
         return entry
 
+    def log_line(self, msg, direction):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(self.log_entry(msg, direction))
+        if access_log is not None:
+            access_log.write(self.who, direction, msg)
+
+    def log_error(self, e):
+        error = parse_exception(e)
+        log_exception(error_log_path, error)
+        log.error(self.log_entry("ERROR = " + error))
+
+    def run(self, f, *args):
+        # Calls f on the store thread (see RendezvousFactory.call_store.)
+        d = self.factory.call_store(f, *args)
+        d.addErrback(self.failed)
+        return d
+
+    def dispatch(self, handler, match, received):
+        # Lines are handled in order so received stays valid until
+        # the handler returns.
+        self.received = received
+        handler(self, match)
+
+    def failed(self, failure):
+        if failure.check(EOFError, IOError, OSError):
+            self.factory.store_failed(failure)
+            return
+
+        error = failure.getTraceback()
+        log_exception(error_log_path, error)
+        log.error(self.log_entry("ERROR = " + error))
+
     def send_line(self, msg):
+        # Written by the reactor.
+        if self.factory.store_pool is not None:
+            self.factory.reactor.callFromThread(self.write_line, msg)
+        else:
+            self.write_line(msg)
+
+    def write_line(self, msg):
         # Not connected.
         if not self.connected:
             return
@@ -63,15 +415,13 @@ class RendezvousProtocol(LineReceiver):
             if type(msg) != bytes:
                 msg = msg.encode("ascii")
         except Exception as e:
-            print("send line e")
-            print(e)
+            log.error("send line e " + str(e))
             return
 
-        # stdout for debugging.
-        if debug:
-            print(self.log_entry(msg, "send"))
-
+        self.log_line(msg, "send")
         self.sendLine(msg)
+        self.metrics.lines_out += 1
+        self.metrics.bytes_out += len(msg) + len(self.delimiter)
 
     def send_remote_port(self):
         """
@@ -80,7 +430,7 @@ class RendezvousProtocol(LineReceiver):
         bound port for an endpoint because a lot of NAT types
         preserve the port.
         """
-        msg = "REMOTE TCP %s" % (str(self.transport.getPeer().port))
+        msg = "REMOTE TCP %s" % (str(self.port))
         self.send_line(msg)
 
     def is_valid_ipv4_address(self, address):
@@ -98,9 +448,9 @@ class RendezvousProtocol(LineReceiver):
         return True
 
     def is_valid_port(self, port):
-        port = re.findall("^[0-9]+$", str(port))
-        if len(port):
-            port = int(port[0])
+        port = str(port)
+        if port_pattern.match(port) is not None:
+            port = int(port)
             if 0 < port <= 65535:
                 return 1
         return 0
@@ -111,44 +461,43 @@ class RendezvousProtocol(LineReceiver):
         designated node if a certain amount of time has passed
         since they last connected.
         """
-        if node_ip in self.factory.candidates:
-            old_candidates = []
-            for candidate in self.factory.candidates[node_ip]:
-                elapsed = int(time.time() - candidate["time"])
-                if elapsed > self.challege_timeout:
-                    old_candidates.append(candidate)
-
-            for candidate in old_candidates:
-                self.factory.candidates[node_ip].remove(candidate)
+        t = time.time() - self.challenge_timeout
+        self.factory.store.remove_older_candidates(node_ip, t)
 
-    def propogate_candidates(self, node_ip):
+    def propogate_candidates(self, node_ip, node=None):
         """
         Used to progate new candidates to passive simultaneous
         nodes.
         """
+        if node is None:
+            node = self.factory.store.get_node("simultaneous", node_ip)
+            if node is None:
+                return
 
-        if node_ip in self.factory.candidates:
-            old_candidates = []
-            for candidate in self.factory.candidates[node_ip]:
-                # Not connected.
-                if not candidate["con"].connected:
-                    continue
+        # Already sent -- removed when they accept this challenge.
+        for candidate in self.factory.store.pending_candidates(node_ip):
+            # Not connected.
+            if not self.factory.is_connected(candidate["con"]):
+                continue
 
-                # Already sent -- updated when they accept this challenge.
-                if candidate["propogated"]:
-                    continue
+            # Notify node of challege from client.
+            msg = "CHALLENGE %s %s %s" % (
+                candidate["ip_addr"],
+                " ".join(map(str, candidate["predictions"])),
+                candidate["proto"])
 
-                # Notify node of challege from client.
-                msg = "CHALLENGE %s %s %s" % (
-                    candidate["ip_addr"],
-                    " ".join(map(str, candidate["predictions"])),
-                    candidate["proto"])
+            self.factory.send_to(node["con"], msg)
 
-                self.factory.nodes["simultaneous"][node_ip]["con"].\
-                    send_line(msg)
-                old_candidates.append(candidate)
+            # Pending candidates are sent again until they're accepted.
+            if candidate.get("challenged"):
+                continue
+            store = self.factory.store
+            if store.challenge_candidate(node_ip, candidate["ip_addr"]):
+                self.metrics.latency["challenge"].observe(
+                    time.time() - candidate["time"]
+                )
 
-    def synchronize_simultaneous(self, node_ip):
+    def synchronize_simultaneous(self, node_ip, node=None):
         """
         Because adjacent mappings for certain NAT types can
         be stolen by other connections, the purpose of this
@@ -159,348 +508,310 @@ class RendezvousProtocol(LineReceiver):
         attempt.
         """
 
-        for candidate in self.factory.candidates[node_ip]:
+        if node is None:
+            node = self.factory.store.get_node("simultaneous", node_ip)
+            if node is None:
+                return
+
+        # Candidates made too long after the node last connected.
+        t = node["time"] + self.challenge_timeout
+        for candidate in self.factory.store.candidates_since(node_ip, t):
             # Only if candidate is connected.
-            if not candidate["con"].connected:
+            if not self.factory.is_connected(candidate["con"]):
                 continue
 
             # Synchronise simultaneous node.
-            if candidate["time"] -\
-                    self.factory.nodes["simultaneous"][node_ip]["time"] >\
-                    self.challege_timeout:
-                msg = "RECONNECT"
-                self.factory.nodes["simultaneous"][node_ip]["con"].\
-                    send_line(msg)
-                return
+            msg = "RECONNECT"
+            self.factory.send_to(node["con"], msg)
+            return
 
         self.cleanup_candidates(node_ip)
-        self.propogate_candidates(node_ip)
+        self.propogate_candidates(node_ip, node)
 
     def connectionMade(self):
         try:
             self.connected = True
-            if debug:
-                print(self.log_entry("OPENED =", "none"))
-
-            # Force reconnect if node has candidates and the timeout is old.
-            ip_addr = self.transport.getPeer().host
-            if ip_addr in self.factory.nodes["simultaneous"]:
-                # Update time.
-                self.factory.nodes["simultaneous"][ip_addr]["time"] =\
-                    time.time()
-                self.synchronize_simultaneous(ip_addr)
+            peer = self.transport.getPeer()
+            self.ip_addr = peer.host
+            self.port = peer.port
+            self.who = """%s:%s""" % (self.ip_addr, self.port)
+            self.ref = self.factory.register(self)
+            self.metrics.opened += 1
+            self.log_line("OPENED =", "none")
+            self.run(self.opened)
         except Exception as e:
-            error = parse_exception(e)
-            log_exception(error_log_path, error)
-            print(self.log_entry("ERROR =", error))
+            self.log_error(e)
+
+    def opened(self):
+        self.factory.store.con_opened(self.ref)
+
+        # Force reconnect if node has candidates and the timeout is old.
+        ip_addr = self.ip_addr
+        node = self.factory.store.touch_node("simultaneous", ip_addr,
+                                             time.time())
+        if node is not None:
+            self.synchronize_simultaneous(ip_addr, node)
 
     def connectionLost(self, reason):
         """
-        Mostly handles clean-up of node + candidate structures.
-        Avoids memory exhaustion for a large number of connections.
+        Node and candidate structures are cleaned up by the
+        factory's expiry queue as they become due.
         """
         try:
             self.connected = False
-            if debug:
-                print(self.log_entry("CLOSED =", "none"))
-
-            # Every five minutes: cleanup
-            t = time.time()
-            if time.time() - self.factory.last_cleanup >= self.cleanup:
-                self.factory.last_cleanup = t
-
-                # Delete old passive nodes.
-                old_node_ips = []
-                for node_ip in list(self.factory.nodes["passive"]):
-                    passive_node = self.factory.nodes["passive"][node_ip]
-                    # Gives enough time for passive nodes to receive clients.
-                    if t - passive_node["time"] >= self.node_lifetime:
-                        old_node_ips.append(node_ip)
-                for node_ip in old_node_ips:
-                    del self.factory.nodes["passive"][node_ip]
-
-                # Delete old simultaneous nodes.
-                old_node_ips = []
-                for node_ip in list(self.factory.nodes["simultaneous"]):
-                    simultaneous_node =\
-                        self.factory.nodes["simultaneous"][node_ip]
-                    # Gives enough time for passive nodes to receive clients.
-                    if t - simultaneous_node["time"] >= self.node_lifetime:
-                        old_node_ips.append(node_ip)
-                for node_ip in old_node_ips:
-                    del self.factory.nodes["simultaneous"][node_ip]
-
-                # Delete old candidates and candidate structs.
-                old_node_ips = []
-                for node_ip in list(self.factory.candidates):
-                    # Record old candidates.
-                    old_candidates = []
-                    for candidate in self.factory.candidates[node_ip]:
-                        # Hole punching is ms time sensitive.
-                        # Candidates older than this is safe to assume
-                        # they're not needed.
-                        if node_ip not in self.factory.nodes["simultaneous"] \
-                                and t - candidate["time"] >= self.challenge_timeout * 5:
-                            old_candidates.append(candidate)
-
-                    # Remove old candidates.
-                    for candidate in old_candidates:
-                        self.factory.candidates[node_ip].remove(candidate)
-
-                    # Record old node IPs.
-                    if not len(self.factory.candidates[node_ip]) and \
-                            node_ip not in self.factory.nodes["simultaneous"]:
-                        old_node_ips.append(node_ip)
-
-                # Remove old node IPs.
-                for node_ip in old_node_ips:
-                    del self.factory.candidates[node_ip]
+            self.factory.unregister(self)
+            self.log_line("CLOSED =", "none")
         except Exception as e:
-            error = parse_exception(e)
-            log_exception(error_log_path, error)
-            print(self.log_entry("ERROR =", error))
+            self.log_error(e)
+
+    def handle_bootstrap(self, match):
+        # Return nodes for bootstrapping.
+        n = int(match.group(1))
+
+        # Invalid number.
+        if n < 1 or n > 100:
+            return
+
+        # Bootstrap n passive, n .
+        msg = "NODES "
+        node_types = ["passive"]
+        our_ip = self.ip_addr
+        node_no = 0
+        for node_type in node_types:
+            # Random nodes that aren't us.
+            skip = (our_ip, "127.0.0.1")
+            for ip_addr, element in \
+                    self.factory.store.sample_nodes(node_type, n, skip):
+                # Not connected.
+                if node_type == "simultaneous" and\
+                        not self.factory.is_connected(element["con"]):
+                    continue
+
+                # Append new node.
+                msg += node_type[0] + ":" + ip_addr + ":"
+                msg += str(element["port"]) + " "
+                node_no += 1
+
+        self.metrics.bootstrap_requested += n
+        self.metrics.bootstrap_returned += node_no
+
+        # No nodes in response.
+        if not node_no:
+            msg = "NODES EMPTY"
+
+        # Send nodes list.
+        self.send_line(msg)
+
+    def handle_ready(self, match):
+        # Add node details to relevant sections.
+        node_type, passive_port, max_inbound = match.groups()
+        node_type = node_type.lower()
+
+        # Init / setup.
+        node_ip = self.ip_addr
+        node = {
+            "max_inbound": int(max_inbound),
+            "no": 0,
+            "port": passive_port,
+            "time": time.time(),
+            "con": self.ref,
+            "ip_list": []
+        }
+        self.factory.store.set_node(node_type, node_ip, node)
+        self.factory.in_reactor(self.factory.expire_node, node_type, node_ip,
+                                node["time"])
+
+        # Passive doesn't have a candidates list.
+        if node_type == "simultaneous":
+            if not self.factory.store.init_candidates(node_ip):
+                self.cleanup_candidates(node_ip)
+                self.propogate_candidates(node_ip, node)
+
+    def handle_source(self, match):
+        # Echo back mapped port.
+        self.send_remote_port()
+
+    def handle_candidate(self, match):
+        # Client wishes to actively initate a simultaneous open.
+        # CANDIDATE 192.168.0.1 TCP.
+        node_ip, proto, predictions = match.groups()
+        predictions = predictions.split(" ")
+        client_ip = self.ip_addr
+
+        # Invalid IP address.
+        if not self.is_valid_ipv4_address(node_ip):
+            log.debug("Candidate invalid ip4" + str(node_ip))
+            return
+        node = self.factory.store.get_node("simultaneous", node_ip)
+        if node is None:
+            log.debug("Candidate: node ip not in factory nodes sim.")
+            return
+
+        # Valid port.
+        valid_ports = 1
+        for port in predictions:
+            if not self.is_valid_port(port):
+                valid_ports = 0
+        if not valid_ports:
+            log.debug("Candidate not valid port")
+            return
+
+        # Not connected.
+        if not self.factory.is_connected(node["con"]):
+            log.debug("Candidate not connected.")
+            return
+
+        candidate = {
+            "ip_addr": client_ip,
+            "time": time.time(),
+            "predictions": predictions,
+            "proto": proto,
+            "con": self.ref,
+            "propogated": 0,
+            "challenged": 0
+        }
+
+        # Replaces any candidate from this client.
+        if not self.factory.store.add_candidate(node_ip, candidate,
+                                                self.max_candidates):
+            log.debug("Candidate max candidates reached.")
+            return
+
+        self.factory.in_reactor(self.factory.expire_candidate, node_ip,
+                                client_ip, candidate["time"])
+        msg = "PREDICTION SET"
+        self.send_line(msg)
+
+        # Synchronize simultaneous node.
+        self.synchronize_simultaneous(node_ip, node)
+
+    def handle_accept(self, match):
+        # Node wishes to respond to a simultaneous open challenge from
+        # a client.
+        # ACCEPT 192.168.0.1 4552 345 TCP 1412137849.288068
+        client_ip, predictions, proto, ntp = match.groups()
+
+        # Invalid IP address.
+        node_ip = self.ip_addr
+        if not self.factory.store.has_candidates(node_ip):
+            return
+
+        # Invalid predictions.
+        predictions = predictions.split(" ")
+        valid_ports = 1
+        for port in predictions:
+            if not self.is_valid_port(port):
+                valid_ports = 0
+        if not valid_ports:
+            return
+
+        # Invalid NTP.
+        t = time.time()
+        minute = 60 * 10
+        if int(float(ntp)) < t - minute or\
+                int(float(ntp)) > t + minute:
+            return
+
+        # Relay fight to client_ip.
+        # FIGHT 192.168.0.1 4552 345 34235 TCP 123123123.1
+        msg = "FIGHT %s %s %s %s" % (node_ip, " ".join(map(str, predictions)), proto, str(ntp))
+        """
+        Signal to propogate_candidates() not to relay this
+        candidate again. Note that this occurs after a
+        valid accept which thus counts as acknowledging
+        receiving the challenge.
+        """
+        candidate = self.factory.store.accept_candidate(node_ip, client_ip)
+        if candidate is not None:
+            latency = self.metrics.latency
+            latency["accept"].observe(time.time() - candidate["time"])
+            self.factory.send_to(candidate["con"], msg)
+            latency["fight"].observe(time.time() - self.received)
+
+    def handle_clear(self, match):
+        # Remove node details.
+        ip_addr = self.ip_addr
+        self.factory.store.remove_node("passive", ip_addr)
+        self.factory.store.remove_node("simultaneous", ip_addr)
+
+    def handle_quit(self, match):
+        # Disconnect.
+        self.factory.in_reactor(self.transport.loseConnection)
+
+    """
+    First token of a line -> (handler, validator.) Validators are
+    compiled once and matched against the whole line; a line that
+    doesn't match is ignored. Handlers are passed the match.
+    """
+    commands = {
+        u"BOOTSTRAP": (
+            handle_bootstrap,
+            re.compile(u"^BOOTSTRAP ([0-9]+)")
+        ),
+        u"PASSIVE": (
+            handle_ready,
+            re.compile(u"^(PASSIVE) READY ([0-9]+) ([0-9]+)$")
+        ),
+        u"SIMULTANEOUS": (
+            handle_ready,
+            re.compile(u"^(SIMULTANEOUS) READY ([0-9]+) ([0-9]+)$")
+        ),
+        u"SOURCE": (
+            handle_source,
+            re.compile(u"^SOURCE TCP")
+        ),
+        u"CANDIDATE": (
+            handle_candidate,
+            re.compile(u"^CANDIDATE ([0-9]+[.][0-9]+[.][0-9]+[.][0-9]+)"
+                       u" (TCP|UDP) ((?:[0-9]+\\s?)+)$")
+        ),
+        u"ACCEPT": (
+            handle_accept,
+            re.compile(u"^ACCEPT ([0-9]+[.][0-9]+[.][0-9]+[.][0-9]+)"
+                       u" ((?:[0-9]+\\s?)+) (TCP|UDP)"
+                       u" ([0-9]+(?:[.][0-9]+)?)$")
+        ),
+        u"CLEAR": (handle_clear, None),
+        u"QUIT": (handle_quit, None)
+    }
+
+    def dataReceived(self, data):
+        self.metrics.bytes_in += len(data)
+        LineReceiver.dataReceived(self, data)
 
     def lineReceived(self, line):
+        self.metrics.lines_in += 1
+
         # Unicode for text patterns.
         try:
             line = line.decode("utf-8")
         except:
             # Received invalid characters.
+            self.metrics.invalid += 1
             return
-        if debug:
-            print(self.log_entry(line, "recv"))
+        self.log_line(line, "recv")
 
         try:
-            # Return nodes for bootstrapping.
-            if re.match("^BOOTSTRAP", line) is not None:
-                parts = re.findall("^BOOTSTRAP ([0-9]+)", line)
-                while 1:
-                    # Invalid response.
-                    if not len(parts):
-                        break
-                    n = int(parts[0])
-
-                    # Invalid number.
-                    if n < 1 or n > 100:
-                        break
-
-                    # Bootstrap n passive, n .
-                    msg = "NODES "
-                    node_types = ["passive"]
-                    our_ip = self.transport.getPeer().host
-                    node_no = 0
-                    for node_type in node_types:
-                        ip_addr_list = list(self.factory.nodes[node_type])
-                        for i in range(0, n):
-                            # There's no nodes left to bootstrap with.
-                            ip_addr_list_len = len(ip_addr_list)
-                            if not ip_addr_list_len:
-                                break
-
-                            # Choose a random node.
-                            rand_index = random.randrange(0, ip_addr_list_len)
-                            ip_addr = ip_addr_list[rand_index]
-                            element = self.factory.nodes[node_type][ip_addr]
-
-                            # Skip our own IP.
-                            if our_ip == ip_addr or ip_addr == "127.0.0.1":
-                                i -= 1
-                                ip_addr_list.remove(ip_addr)
-                                continue
-
-                            # Not connected.
-                            if node_type == "simultaneous" and\
-                                    not element["con"].connected:
-                                i -= 1
-                                ip_addr_list.remove(ip_addr)
-                                continue
-
-                            # Append new node.
-                            msg += node_type[0] + ":" + ip_addr + ":"
-                            msg += str(element["port"]) + " "
-                            ip_addr_list.remove(ip_addr)
-                            node_no += 1
-
-                    # No nodes in response.
-                    if not node_no:
-                        msg = "NODES EMPTY"
-
-                    # Send nodes list.
-                    self.send_line(msg)
-                    break
-
-            # Add node details to relevant sections.
-            if re.match("^(SIMULTANEOUS|PASSIVE) READY [0-9]+ [0-9]+$", line)\
-                    is not None:
-                # Get type.
-                node_type, passive_port, max_inbound = re.findall("^(SIMULTANEOUS|PASSIVE) READY ([0-9]+) ([0-9]+)", line)[0]
-                node_type = node_type.lower()
-                valid_node_types = ["simultaneous", "passive"]
-                if node_type not in valid_node_types:
-                    return
+            # Unknown command.
+            name = line.split(u" ", 1)[0]
+            command = self.commands.get(name)
+            if command is None:
+                self.metrics.unknown += 1
+                return
 
-                # Init / setup.
-                node_ip = self.transport.getPeer().host
-                self.factory.nodes[node_type][node_ip] = {
-                    "max_inbound": max_inbound,
-                    "no": 0,
-                    "port": passive_port,
-                    "time": time.time(),
-                    "con": self,
-                    "ip_list": []
-                }
-
-                # Passive doesn't have a candidates list.
-                if node_type == "simultaneous":
-                    if node_ip not in self.factory.candidates:
-                        self.factory.candidates[node_ip] = []
-                    else:
-                        self.cleanup_candidates(node_ip)
-                        self.propogate_candidates(node_ip)
-
-            # Echo back mapped port.
-            if re.match("^SOURCE TCP", line) is not None:
-                self.send_remote_port()
-
-            # Client wishes to actively initate a simultaneous open.
-            if re.match("^CANDIDATE", line) is not None:
-                # CANDIDATE 192.168.0.1 TCP.
-                parts = re.findall("^CANDIDATE ([0-9]+[.][0-9]+[.][0-9]+[.][0-9]+) (TCP|UDP) ((?:[0-9]+\s?)+)$", line)
-                while 1:
-                    # Invalid response.
-                    if not len(parts):
-                        break
-                    node_ip, proto, predictions = parts[0]
-                    predictions = predictions.split(" ")
-                    client_ip = self.transport.getPeer().host
-
-                    # Invalid IP address.
-                    if not self.is_valid_ipv4_address(node_ip):
-                        print("Candidate invalid ip4" + str(node_ip))
-                        break
-                    if node_ip not in self.factory.nodes["simultaneous"]:
-                        print("Candidate: node ip not in factory nodes sim.")
-                        break
-
-                    # Valid port.
-                    valid_ports = 1
-                    for port in predictions:
-                        if not self.is_valid_port(port):
-                            valid_ports = 0
-                    if not valid_ports:
-                        print("Candidate not valid port")
-                        break
-
-                    # Not connected.
-                    if not self.factory.nodes["simultaneous"][node_ip]["con"].\
-                            connected:
-                        print("Candidate not connected.")
-                        break
-
-                    candidate = {
-                        "ip_addr": client_ip,
-                        "time": time.time(),
-                        "predictions": predictions,
-                        "proto": proto,
-                        "con": self,
-                        "propogated": 0
-                    }
-
-                    # Delete candidate if it already exists.
-                    if node_ip in self.factory.candidates:
-                        # Max candidates reached.
-                        num_candidates = len(self.factory.candidates[node_ip])
-                        if num_candidates >= self.max_candidates:
-                            print("Candidate max candidates reached.")
-                            break
-
-                        for test_candidate in self.factory.candidates[node_ip]:
-                            if test_candidate["ip_addr"] == client_ip:
-                                self.factory.candidates[node_ip].remove(test_candidate)
-                                print("Candidate removign test canadidate.")
-                                break
-
-                    self.factory.candidates[node_ip].append(candidate)
-                    candidate_index = len(self.factory.candidates[node_ip]) - 1
-
-                    # Update predictions.
-                    self.factory.candidates[node_ip][candidate_index]["predictions"] = predictions
-                    msg = "PREDICTION SET"
-                    self.send_line(msg)
-
-                    # Synchronize simultaneous node.
-                    self.synchronize_simultaneous(node_ip)
-                    break
-
-            # Node wishes to respond to a simultaneous open challenge from
-            # a client.
-            if re.match("^ACCEPT", line) is not None:
-                # ACCEPT 192.168.0.1 4552 345 TCP 1412137849.288068
-                p = "^ACCEPT ([0-9]+[.][0-9]+[.][0-9]+[.][0-9]+)"
-                p += " ((?:[0-9]+\s?)+) (TCP|UDP) ([0-9]+(?:[.][0-9]+)?)$"
-                parts = re.findall(p, line)
-                while 1:
-                    # Invalid reply.
-                    if not len(parts):
-                        break
-                    client_ip, predictions, proto, ntp = parts[0]
-
-                    # Invalid IP address.
-                    node_ip = self.transport.getPeer().host
-                    if node_ip not in self.factory.candidates:
-                        break
-
-                    # Invalid predictions.
-                    predictions = predictions.split(" ")
-                    valid_ports = 1
-                    for port in predictions:
-                        if not self.is_valid_port(port):
-                            valid_ports = 0
-                    if not valid_ports:
-                        break
-
-                    # Invalid NTP.
-                    ntp = ntp
-                    t = time.time()
-                    minute = 60 * 10
-                    if int(float(ntp)) < t - minute or\
-                            int(float(ntp)) > t + minute:
-                        break
-
-                    # Relay fight to client_ip.
-                    # FIGHT 192.168.0.1 4552 345 34235 TCP 123123123.1
-                    msg = "FIGHT %s %s %s %s" % (node_ip, " ".join(map(str, predictions)), proto, str(ntp))
-                    for candidate in self.factory.candidates[node_ip]:
-                        if candidate["ip_addr"] == client_ip:
-                            candidate["con"].send_line(msg)
-
-                            """
-                            Signal to propogate_candidates() not to relay this
-                            candidate again. Note that this occurs after a
-                            valid accept which thus counts as acknowledging
-                            receiving the challenge.
-                            """
-                            candidate["propogated"] = 1
-                            break
-
-                    break
-
-            # Remove node details.
-            if re.match("^CLEAR", line) is not None:
-                ip_addr = self.transport.getPeer().host
-                if ip_addr in self.factory.nodes["passive"]:
-                    del self.factory.nodes["passive"][ip_addr]
-                if ip_addr in self.factory.nodes["simultaneous"]:
-                    del self.factory.nodes["simultaneous"][ip_addr]
-
-            # Disconnect.
-            if re.match("^QUIT", line) is not None:
-                self.transport.loseConnection()
+            # Invalid arguments.
+            handler, validator = command
+            match = None
+            if validator is not None:
+                match = validator.match(line)
+                if match is None:
+                    self.metrics.invalid += 1
+                    return
 
+            self.metrics.command(name)
+            self.run(self.dispatch, handler, match, time.time())
         except Exception as e:
-            error = parse_exception(e)
-            log_exception(error_log_path, error)
-            print(self.log_entry("ERROR =", error))
+            self.log_error(e)
 
 
 class RendezvousFactory(Factory):
@@ -548,38 +859,445 @@ class RendezvousFactory(Factory):
     used for bootstrapping.
     """
 
-    def __init__(self):
-        self.last_cleanup = time.time()
-        self.candidates = {}
-        self.nodes = {
-            'passive': {},
-            'simultaneous': {},
-            'active': {},
-            'relay': {},
-            'bootstrap': {}
-        }
+    def __init__(self, clock=None, store=None, worker_id=0, relay=None,
+                 store_pool=None):
+        self.challenge_timeout = 60 * 2  # Seconds.
+        self.node_lifetime = 60 * 60 * 24  # 12 hours.
+        self.expiry = ExpiryQueue(clock)
+
+        # (node type, IP) for nodes with a pending expiry.
+        self.expiring = set()
+
+        # (node IP, client IP) for candidates with a pending expiry.
+        self.expiring_candidates = set()
+
+        # Node and candidate tables.
+        self.store = store or MemoryStore()
 
-        # Test data.
         """
-        test_ip = "192.168.0.10"
-        self.nodes["passive"][test_ip] = {
-            "ip_addr": test_ip,
-            "port": 194,
-        }
-        self.nodes["simultaneous"][test_ip] = {
-            "time": time.time(),
-            "ip_addr": test_ip,
-            "port": 0
-        }
-        self.candidates[test_ip] = []
+        A shared store is in another process so commands run on
+        store_pool's (single) thread where waiting on the store doesn't
+        hold up the reactor. Writes, the relay and the expiry queue stay
+        on the reactor thread.
         """
+        self.store_pool = store_pool
+        self.reactor = reactor
+
+        # Set when the reactor is shutting down.
+        self.stopping = 0
+
+        # Our connections by ID. Lines for connections held by
+        # other workers go through the relay.
+        self.worker_id = worker_id
+        self.relay = relay
+        self.cons = {}
+        self.con_ids = itertools.count(1)
+
+        # Counters for this worker (see listen_stats.)
+        self.metrics = Metrics()
+
+    @property
+    def nodes(self):
+        # Node tables (read only copies for shared stores.)
+        if isinstance(self.store, MemoryStore):
+            return self.store.nodes
+
+        return self.store.get_nodes()
+
+    @property
+    def candidates(self):
+        # Candidates by node IP (read only copies for shared stores.)
+        if isinstance(self.store, MemoryStore):
+            return self.store.candidates
+
+        return self.store.get_candidates()
+
+    def call_store(self, f, *args):
+        """
+        Calls f(*args) - on store_pool's thread if there is one - and
+        returns a Deferred with the result. Calls run in order and
+        callbacks run on the reactor.
+        """
+        if self.store_pool is None:
+            return defer.maybeDeferred(f, *args)
+
+        return threads.deferToThreadPool(self.reactor, self.store_pool, f,
+                                         *args)
+
+    def in_reactor(self, f, *args):
+        # Calls f on the reactor thread.
+        if self.store_pool is None:
+            f(*args)
+        else:
+            self.reactor.callFromThread(f, *args)
+
+    def store_failed(self, failure):
+        if failure.check(EOFError, IOError, OSError):
+            # The store's process has gone (e.g. it's shutting down.)
+            log.warning("Store unavailable: " + failure.getErrorMessage())
+        else:
+            log_exception(error_log_path, failure.getTraceback())
+
+    def stop(self):
+        self.stopping = 1
+        self.expiry.stop()
+        if self.relay is not None:
+            self.relay.stop()
 
     def buildProtocol(self, addr):
         return RendezvousProtocol(self)
 
-if __name__ == "__main__":
-    print("Starting rendezvous server.")
-    factory = RendezvousFactory()
-    reactor.listenTCP(8000, factory, interface="0.0.0.0")
+    def register(self, con):
+        # The store is told by the con (see RendezvousProtocol.opened.)
+        con_id = next(self.con_ids)
+        self.cons[con_id] = con
+
+        return (self.worker_id, con_id)
+
+    def unregister(self, con):
+        if con.ref is not None and self.cons.get(con.ref[1]) is con:
+            del self.cons[con.ref[1]]
+
+            # Dropped with the rest of the worker's if we're stopping.
+            if not self.stopping:
+                d = self.call_store(self.store.con_closed, con.ref)
+                d.addErrback(self.store_failed)
+
+    def worker_lost(self, worker_id):
+        # Another worker's relay connection dropped: it's gone.
+        if self.stopping:
+            return
+
+        log.warning("Worker %d has gone." % worker_id)
+        d = self.call_store(self.store.purge_worker, worker_id)
+        d.addErrback(self.store_failed)
+
+    def is_connected(self, ref):
+        if ref[0] == self.worker_id:
+            con = self.cons.get(ref[1])
+            return con is not None and con.connected
+
+        return self.store.is_connected(ref)
+
+    def send_to(self, ref, msg):
+        if ref[0] == self.worker_id:
+            self.deliver(ref[1], msg)
+        elif self.relay is not None:
+            self.in_reactor(self.relay.send, ref, msg)
+
+    def deliver(self, con_id, msg):
+        con = self.cons.get(con_id)
+        if con is not None:
+            con.send_line(msg)
+
+    def expire_node(self, node_type, node_ip, t):
+        """
+        Removes a node once it hasn't been seen for node_lifetime.
+        Nodes refresh their time by reconnecting so there's only
+        one pending expiry per node and it's pushed back when due.
+        """
+        key = (node_type, node_ip)
+        if key in self.expiring:
+            return
+
+        self.expiring.add(key)
+        self.expiry.schedule(t + self.node_lifetime, self.node_due,
+                             node_type, node_ip)
+
+    def node_due(self, node_type, node_ip):
+        self.expiring.discard((node_type, node_ip))
+        before = self.expiry.clock.seconds() - self.node_lifetime
+        d = self.call_store(self.store.expire_node, node_type, node_ip,
+                            before)
+        d.addCallback(self.node_seen, node_type, node_ip)
+        d.addErrback(self.store_failed)
+
+    def node_seen(self, t, node_type, node_ip):
+        # Seen since this was scheduled.
+        if t is not None:
+            self.expire_node(node_type, node_ip, t)
+
+    def expire_candidate(self, node_ip, client_ip, t):
+        """
+        Hole punching is ms time sensitive. Candidates older than
+        this is safe to assume they're not needed. A client's new
+        candidate replaces its old one so there's one pending expiry
+        per client and node, pushed back when due.
+        """
+        key = (node_ip, client_ip)
+        if key in self.expiring_candidates:
+            return
+
+        self.expiring_candidates.add(key)
+        self.expiry.schedule(t + self.challenge_timeout * 5,
+                             self.candidate_due, node_ip, client_ip)
+
+    def candidate_due(self, node_ip, client_ip):
+        self.expiring_candidates.discard((node_ip, client_ip))
+        before = self.expiry.clock.seconds() - self.challenge_timeout * 5
+        d = self.call_store(self.store.expire_candidate, node_ip, client_ip,
+                            before)
+        d.addCallback(self.candidate_seen, node_ip, client_ip)
+        d.addErrback(self.store_failed)
+
+    def candidate_seen(self, t, node_ip, client_ip):
+        # Replaced since this was scheduled.
+        if t is not None:
+            self.expire_candidate(node_ip, client_ip, t)
+
+    def gauges(self):
+        gauges = self.store.gauges()
+        gauges["expiry_queue"] = len(self.expiry)
+        gauges["worker_connections"] = len(self.cons)
+        return gauges
+
+
+class RelayProtocol(LineReceiver):
+    """
+    Receives "WORKER id" from another worker when it connects and
+    then "con_id line" for our connections. The other worker's
+    connections are dropped from the store if it goes away.
+    """
+
+    def __init__(self):
+        self.peer_id = None
+
+    def lineReceived(self, line):
+        try:
+            if self.peer_id is None:
+                self.peer_id = int(line.split(b" ", 1)[1])
+                return
+
+            con_id, msg = line.split(b" ", 1)
+            self.factory.rendezvous.deliver(int(con_id), msg)
+        except Exception as e:
+            error = parse_exception(e)
+            log_exception(error_log_path, error)
+
+    def connectionLost(self, reason):
+        if self.peer_id is not None:
+            self.factory.rendezvous.worker_lost(self.peer_id)
+
+
+class RelayFactory(Factory):
+    protocol = RelayProtocol
+
+    def __init__(self, rendezvous):
+        self.rendezvous = rendezvous
+
+
+class RelayClientProtocol(LineReceiver):
+    # Our side of the connection to another worker.
+    def connectionMade(self):
+        relay = self.factory.relay
+        self.sendLine(("WORKER %d" % relay.worker_id).encode("ascii"))
+        self.factory.resetDelay()
+        relay.connected(self.factory.peer_id, self)
+
+    def connectionLost(self, reason):
+        self.factory.relay.disconnected(self.factory.peer_id, self)
+
+
+class RelayClientFactory(ReconnectingClientFactory):
+    protocol = RelayClientProtocol
+    initialDelay = 0.1
+    maxDelay = 5
+
+    def __init__(self, relay, peer_id):
+        self.relay = relay
+        self.peer_id = peer_id
+
+
+class WorkerRelay(object):
+    """
+    Passes lines for connections held by other worker processes
+    through a Unix socket per worker in run_dir. Each worker keeps a
+    connection open to every other one (reconnecting as needed) and
+    writes to it without blocking. Lines for a worker that isn't
+    connected yet are held, up to max_pending.
+    """
+
+    def __init__(self, run_dir, worker_id, workers=1):
+        self.run_dir = run_dir
+        self.worker_id = worker_id
+        self.workers = workers
+        self.max_pending = 1000
+
+        # Worker ID -> connected RelayClientProtocol.
+        self.peers = {}
+
+        # Worker ID -> lines waiting for a connection.
+        self.pending = {}
+        self.factories = []
+
+    def path(self, worker_id):
+        return os.path.join(self.run_dir, "worker-%d.sock" % worker_id)
+
+    def listen(self, rendezvous):
+        path = self.path(self.worker_id)
+        if os.path.exists(path):
+            os.unlink(path)
+
+        return reactor.listenUNIX(path, RelayFactory(rendezvous))
+
+    def connect(self):
+        for peer_id in range(1, self.workers + 1):
+            if peer_id != self.worker_id:
+                factory = RelayClientFactory(self, peer_id)
+                self.factories.append(factory)
+                reactor.connectUNIX(self.path(peer_id), factory)
+
+    def stop(self):
+        for factory in self.factories:
+            factory.stopTrying()
+        for proto in list(self.peers.values()):
+            proto.transport.loseConnection()
+
+    def connected(self, peer_id, proto):
+        self.peers[peer_id] = proto
+        for line in self.pending.pop(peer_id, ()):
+            proto.sendLine(line)
+
+    def disconnected(self, peer_id, proto):
+        if self.peers.get(peer_id) is proto:
+            del self.peers[peer_id]
+
+    def send(self, ref, msg):
+        worker_id, con_id = ref
+        if type(msg) != bytes:
+            msg = msg.encode("ascii")
+        line = str(con_id).encode("ascii") + b" " + msg
+
+        proto = self.peers.get(worker_id)
+        if proto is not None:
+            proto.sendLine(line)
+            return 1
+
+        pending = self.pending.setdefault(worker_id, deque())
+        if len(pending) >= self.max_pending:
+            return 0
+        pending.append(line)
+
+        return 1
+
+
+def run_worker(worker_id, port, interface, address, authkey, run_dir,
+               log_level=logging.INFO, log_path=None, access_log_path=None,
+               stats_port=None, workers=1):
+    """
+    Serves rendezvous clients on a port shared with the other workers
+    (SO_REUSEPORT) with the node and candidate tables in the store
+    served by StoreManager at address. Worker N's metrics are on
+    stats_port + N - 1.
+    """
+    if access_log_path is not None:
+        access_log_path = "%s.%d" % (access_log_path, worker_id)
+    setup_logging(level=log_level, log_path=log_path,
+                  access_log_path=access_log_path)
+
+    manager = StoreManager(address=address, authkey=authkey)
+    manager.connect()
+    relay = WorkerRelay(run_dir, worker_id, workers)
+    store_pool = ThreadPool(1, 1, "store")
+    factory = RendezvousFactory(store=manager.get_store(),
+                                worker_id=worker_id, relay=relay,
+                                store_pool=store_pool)
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s.bind((interface, port))
+    s.listen(1024)
+    s.setblocking(0)
+    reactor.adoptStreamPort(s.fileno(), socket.AF_INET, factory)
+    s.close()
+    relay.listen(factory)
+    relay.connect()
+    if stats_port is not None:
+        listen_stats(factory, stats_port + worker_id - 1)
+
+    store_pool.start()
+    reactor.addSystemEventTrigger("before", "shutdown", factory.stop)
+    reactor.addSystemEventTrigger("after", "shutdown", store_pool.stop)
+
+    log.info("Worker %d serving on port %d." % (worker_id, port))
     reactor.run()
+    stop_logging()
+
+
+def serve(port=8000, interface="0.0.0.0", workers=1,
+          log_level=logging.INFO, log_path=None, access_log_path=None,
+          stats_port=None):
+    """
+    Runs the rendezvous server. With more than one worker the tables
+    go in a StoreManager process and each worker is its own process
+    accepting connections on the same port. Metrics are served on
+    127.0.0.1:stats_port if it's given (see listen_stats.)
+    """
+    if workers <= 1:
+        setup_logging(level=log_level, log_path=log_path,
+                      access_log_path=access_log_path)
+        log.info("Starting rendezvous server.")
+        factory = RendezvousFactory()
+        reactor.listenTCP(port, factory, interface=interface)
+        if stats_port is not None:
+            listen_stats(factory, stats_port)
+        reactor.run()
+        stop_logging()
+        return
+
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise Exception("Multiple workers need SO_REUSEPORT.")
+
+    run_dir = tempfile.mkdtemp(prefix="rendezvous-")
+    authkey = os.urandom(16)
+    manager = StoreManager(address=os.path.join(run_dir, "store.sock"),
+                           authkey=authkey)
+    manager.start()
+
+    # Take the workers down with us.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # Fresh interpreters so workers don't share our reactor's epoll.
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    try:
+        for worker_id in range(1, workers + 1):
+            process = context.Process(
+                target=run_worker,
+                args=(worker_id, port, interface, manager.address, authkey,
+                      run_dir, log_level, log_path, access_log_path,
+                      stats_port, workers)
+            )
+            process.start()
+            processes.append(process)
+
+        for process in processes:
+            process.join()
+    finally:
+        # Workers close their connections through the store.
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+        manager.shutdown()
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PyP2P rendezvous server")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--log", help="log file (default: stderr)")
+    parser.add_argument("--access-log", help="JSONL log of every line")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes sharing the port (SO_REUSEPORT)")
+    parser.add_argument("--stats-port", type=int,
+                        help="local HTTP metrics port (one per worker)")
+    args = parser.parse_args()
+
+    serve(port=args.port, workers=args.workers,
+          log_level=logging.DEBUG if debug else logging.INFO,
+          log_path=args.log, access_log_path=args.access_log,
+          stats_port=args.stats_port)
 
@@ -0,0 +1,404 @@
+"""
+Storage for the rendezvous server's node and candidate tables.
+
+MemoryStore keeps them in the server process. For running several
+worker processes on the same port, StoreManager serves one SharedStore
+over a local socket and each worker uses a proxy to it. Either way the
+server only uses the store's methods, and records hold connection
+references - (worker ID, connection ID) - rather than connections.
+"""
+
+import random
+import threading
+from collections import OrderedDict
+from multiprocessing.managers import BaseManager
+
+
+class NodeTable(object):
+    """
+    Maps node IPs to their details like a dict but also keeps the IPs
+    in arrays (nodes with spare inbound slots and full ones) so random
+    nodes can be sampled without copying the whole table. Removal
+    swaps the last IP into the free slot.
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self.spare = []
+        self.full = []
+
+        # IP -> (array, index in array.)
+        self.positions = {}
+
+    def has_spare(self, node):
+        return node.get("no", 0) < node.get("max_inbound", 0)
+
+    def link(self, ip_addr):
+        if self.has_spare(self.nodes[ip_addr]):
+            array = self.spare
+        else:
+            array = self.full
+        self.positions[ip_addr] = (array, len(array))
+        array.append(ip_addr)
+
+    def unlink(self, ip_addr):
+        array, index = self.positions.pop(ip_addr)
+        last = array.pop()
+        if last != ip_addr:
+            array[index] = last
+            self.positions[last] = (array, index)
+
+    def __setitem__(self, ip_addr, node):
+        if ip_addr in self.nodes:
+            self.unlink(ip_addr)
+        self.nodes[ip_addr] = node
+        self.link(ip_addr)
+
+    def __delitem__(self, ip_addr):
+        self.unlink(ip_addr)
+        del self.nodes[ip_addr]
+
+    def __getitem__(self, ip_addr):
+        return self.nodes[ip_addr]
+
+    def __contains__(self, ip_addr):
+        return ip_addr in self.nodes
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def get(self, ip_addr, default=None):
+        return self.nodes.get(ip_addr, default)
+
+    def items(self):
+        return self.nodes.items()
+
+    def handed_out(self, ip_addr):
+        # Count a client we've sent to this node.
+        node = self.nodes[ip_addr]
+        node["no"] += 1
+        if node["no"] == node["max_inbound"]:
+            self.unlink(ip_addr)
+            self.link(ip_addr)
+
+    def sample(self, n, skip=()):
+        """
+        Returns up to n random IPs not in skip, preferring nodes with
+        spare inbound slots.
+        """
+        ip_addrs = []
+        for array in [self.spare, self.full]:
+            needed = n - len(ip_addrs)
+            if needed <= 0:
+                break
+
+            # Draw extra in case some are skipped.
+            k = min(len(array), needed + len(skip))
+            for ip_addr in random.sample(array, k):
+                if ip_addr in skip:
+                    continue
+                ip_addrs.append(ip_addr)
+                if len(ip_addrs) == n:
+                    break
+
+        return ip_addrs
+
+
+class CandidateIndex(object):
+    """
+    Hole punching candidates for one simultaneous node keyed by client
+    IP in the order they were made (oldest first.) Candidates that
+    haven't been accepted yet are also kept in a separate queue so
+    propagation only touches those.
+    """
+
+    def __init__(self):
+        self.candidates = OrderedDict()
+        self.unpropagated = OrderedDict()
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def __contains__(self, client_ip):
+        return client_ip in self.candidates
+
+    def __iter__(self):
+        return iter(self.candidates.values())
+
+    def get(self, client_ip, default=None):
+        return self.candidates.get(client_ip, default)
+
+    def add(self, candidate):
+        # Replaces any older candidate from the same client.
+        client_ip = candidate["ip_addr"]
+        self.remove(client_ip)
+        self.candidates[client_ip] = candidate
+        if not candidate["propogated"]:
+            self.unpropagated[client_ip] = candidate
+
+    def remove(self, client_ip):
+        self.unpropagated.pop(client_ip, None)
+        return self.candidates.pop(client_ip, None)
+
+    def propagated(self, client_ip):
+        candidate = self.unpropagated.pop(client_ip, None)
+        if candidate is not None:
+            candidate["propogated"] = 1
+
+        return candidate
+
+    def pending(self):
+        return list(self.unpropagated.values())
+
+    def newest(self):
+        for client_ip in reversed(self.candidates):
+            yield self.candidates[client_ip]
+
+    def remove_older(self, t):
+        # Candidates are oldest first.
+        while len(self.candidates):
+            candidate = next(iter(self.candidates.values()))
+            if candidate["time"] >= t:
+                break
+            self.remove(candidate["ip_addr"])
+
+
+class MemoryStore(object):
+    def __init__(self):
+        self.nodes = {
+            'passive': NodeTable(),
+            'simultaneous': NodeTable(),
+            'active': {},
+            'relay': {},
+            'bootstrap': {}
+        }
+        self.candidates = {}
+
+        # References to open connections.
+        self.live = set()
+
+    # Nodes.
+    def get_node(self, node_type, node_ip):
+        return self.nodes[node_type].get(node_ip)
+
+    def set_node(self, node_type, node_ip, node):
+        self.nodes[node_type][node_ip] = node
+
+    def remove_node(self, node_type, node_ip):
+        if node_ip in self.nodes[node_type]:
+            del self.nodes[node_type][node_ip]
+
+    def touch_node(self, node_type, node_ip, t):
+        # Records the node was seen at t.
+        node = self.nodes[node_type].get(node_ip)
+        if node is not None:
+            node["time"] = t
+
+        return node
+
+    def get_nodes(self):
+        # Copies of the node tables (node type -> IP -> node.)
+        return dict((node_type, dict(table.items()))
+                    for node_type, table in self.nodes.items())
+
+    def sample_nodes(self, node_type, n, skip=()):
+        # Up to n random (IP, node) pairs counted as handed out.
+        table = self.nodes[node_type]
+        nodes = []
+        for node_ip in table.sample(n, skip):
+            table.handed_out(node_ip)
+            nodes.append((node_ip, table[node_ip]))
+
+        return nodes
+
+    def expire_node(self, node_type, node_ip, before):
+        """
+        Removes a node last seen before the given time. Returns its
+        time if it's been seen since, otherwise None.
+        """
+        node = self.nodes[node_type].get(node_ip)
+        if node is None:
+            return None
+        if node["time"] > before:
+            return node["time"]
+
+        del self.nodes[node_type][node_ip]
+        if node_type == "simultaneous":
+            self.drop_candidates(node_ip)
+
+        return None
+
+    # Candidates.
+    def init_candidates(self, node_ip):
+        # Returns 1 if the node didn't have a candidates list.
+        if node_ip in self.candidates:
+            return 0
+
+        self.candidates[node_ip] = CandidateIndex()
+        return 1
+
+    def get_candidates(self):
+        # Copies of the candidate lists (node IP -> client IP -> candidate.)
+        return dict((node_ip, OrderedDict(
+            (candidate["ip_addr"], candidate) for candidate in candidates
+        )) for node_ip, candidates in self.candidates.items())
+
+    def has_candidates(self, node_ip):
+        return node_ip in self.candidates
+
+    def add_candidate(self, node_ip, candidate, max_candidates):
+        # Returns 0 if there's no list or it's full.
+        candidates = self.candidates.get(node_ip)
+        if candidates is None or len(candidates) >= max_candidates:
+            return 0
+
+        candidates.add(candidate)
+        return 1
+
+    def accept_candidate(self, node_ip, client_ip):
+        # Marks a candidate as propagated and returns it.
+        candidates = self.candidates.get(node_ip)
+        if candidates is None:
+            return None
+
+        candidate = candidates.get(client_ip)
+        if candidate is not None:
+            candidates.propagated(client_ip)
+
+        return candidate
+
+    def challenge_candidate(self, node_ip, client_ip):
+        # Marks a candidate as challenged. Returns 1 the first time.
+        candidates = self.candidates.get(node_ip)
+        if candidates is None:
+            return 0
+
+        candidate = candidates.get(client_ip)
+        if candidate is None or candidate.get("challenged"):
+            return 0
+
+        candidate["challenged"] = 1
+        return 1
+
+    def pending_candidates(self, node_ip):
+        candidates = self.candidates.get(node_ip)
+        if candidates is None:
+            return []
+
+        return candidates.pending()
+
+    def candidates_since(self, node_ip, t):
+        # Candidates made after t, newest first.
+        since = []
+        candidates = self.candidates.get(node_ip)
+        if candidates is not None:
+            for candidate in candidates.newest():
+                if candidate["time"] <= t:
+                    break
+                since.append(candidate)
+
+        return since
+
+    def remove_older_candidates(self, node_ip, t):
+        candidates = self.candidates.get(node_ip)
+        if candidates is not None:
+            candidates.remove_older(t)
+
+    def expire_candidate(self, node_ip, client_ip, before):
+        """
+        Removes a client's candidate made before the given time. Returns
+        its time if it's been replaced since, otherwise None.
+        """
+        t = None
+        candidates = self.candidates.get(node_ip)
+        if candidates is not None:
+            candidate = candidates.get(client_ip)
+            if candidate is not None:
+                if candidate["time"] > before:
+                    t = candidate["time"]
+                else:
+                    candidates.remove(client_ip)
+
+        self.drop_candidates(node_ip)
+        return t
+
+    def drop_candidates(self, node_ip):
+        # Remove empty candidate structs for nodes that have gone.
+        if node_ip in self.nodes["simultaneous"]:
+            return
+
+        candidates = self.candidates.get(node_ip)
+        if candidates is not None and not len(candidates):
+            del self.candidates[node_ip]
+
+    # Connections.
+    def con_opened(self, ref):
+        self.live.add(ref)
+
+    def con_closed(self, ref):
+        self.live.discard(ref)
+
+    def is_connected(self, ref):
+        return ref in self.live
+
+    def purge_worker(self, worker_id):
+        # Forget the connections of a worker that's gone.
+        self.live = set(ref for ref in self.live if ref[0] != worker_id)
+
+    def gauges(self):
+        return {
+            "passive": len(self.nodes["passive"]),
+            "passive_spare": len(self.nodes["passive"].spare),
+            "simultaneous": len(self.nodes["simultaneous"]),
+            "candidate_lists": len(self.candidates),
+            "candidates": sum(map(len, self.candidates.values())),
+            "connections": len(self.live)
+        }
+
+
+def locked(method):
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class SharedStore(MemoryStore):
+    """
+    The MemoryStore run by StoreManager. Each worker's calls arrive on
+    their own thread so they're serialised with a lock.
+    """
+
+    def __init__(self):
+        MemoryStore.__init__(self)
+        self.lock = threading.RLock()
+
+
+for name, method in list(MemoryStore.__dict__.items()):
+    if not name.startswith("_") and callable(method):
+        setattr(SharedStore, name, locked(method))
+
+
+shared_store = None
+
+
+def get_shared_store():
+    # Runs in the manager process.
+    global shared_store
+    if shared_store is None:
+        shared_store = SharedStore()
+
+    return shared_store
+
+
+class StoreManager(BaseManager):
+    pass
+
+
+StoreManager.register("get_store", callable=get_shared_store)
@@ -23,6 +23,14 @@ Quirks:
   has been set to non-blocking to make things easier. If you need a non-blocking
   way to send a line: use send(). Note that you will have to check for the
   number of bytes sent and resend if needed just like the real send function.
+  send_lines does the same for a batch of lines in as few syscalls as possible.
+* If enable_send_queue is set on a non-blocking socket, send_line and
+  send_lines don't block: lines go into a bounded outbound queue that is
+  written out by flush(). send_queue_callback is told when the queue goes
+  above send_queue_high ("high") and back under send_queue_low ("low").
+  close() writes out what it can without blocking (by default) or waits
+  up to linger seconds for the queue to be written out.
+  Raw send() calls bypass the queue.
 * connect has the same behaviour as above to make things simpler (so will block
   regardless of whether socket is in non-blocking mode or not.) If you want to
   bypass this behaviour you can always connect the socket outside this class
@@ -40,27 +48,162 @@ send all / recv all.
 
 import errno
 import platform
+import select
 import socket
 import ssl
 import sys
 import time
+from collections import deque
+from itertools import islice
 
 from pyp2p.lib import get_lan_ip, parse_exception, log_exception
 from pyp2p.lib import encode_str
 
 error_log_path = "error.log"
 
+# Most buffers passed to a single sendmsg call.
+max_iov = 1024
+
+
+class RecvBuffer(object):
+    """
+    A receive buffer that sockets write into directly with recv_into.
+    Pending data lives in data[start:end]. Consuming data only moves
+    the start offset and free space is reclaimed by compacting the
+    pending bytes to the front of the buffer (or growing it) when
+    there isn't enough room left for the next read. This avoids
+    re-copying the whole buffer for every chunk received.
+
+    Nothing is allocated until the first write so idle connections
+    don't hold an empty buffer.
+    """
+
+    __slots__ = ["size", "data", "view", "start", "end", "high_water"]
+
+    def __init__(self, size=1024 * 4):
+        self.size = size
+        self.data = bytearray()
+        self.view = memoryview(self.data)
+        self.start = 0
+        self.end = 0
+
+        # Largest amount of data that has been pending at once.
+        self.high_water = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def reserve(self, n):
+        # Enough free space after the data already.
+        capacity = len(self.data)
+        if capacity - self.end >= n:
+            return
+
+        # Move pending data to the front.
+        pending = self.end - self.start
+        if capacity - pending >= n:
+            self.view[:pending] = self.view[self.start:self.end]
+        else:
+            # Grow buffer.
+            capacity = max(capacity, self.size)
+            while capacity - pending < n:
+                capacity *= 2
+            data = bytearray(capacity)
+            data[:pending] = self.view[self.start:self.end]
+            self.data = data
+            self.view = memoryview(self.data)
+
+        self.start = 0
+        self.end = pending
+
+    def recv_into(self, sock, n):
+        # Returns the number of bytes read from the socket.
+        self.reserve(n)
+        got = sock.recv_into(self.view[self.end:self.end + n], n)
+        self.end += got
+        if self.end - self.start > self.high_water:
+            self.high_water = self.end - self.start
+
+        return got
+
+    def write(self, data):
+        n = len(data)
+        self.reserve(n)
+        self.view[self.end:self.end + n] = data
+        self.end += n
+        if self.end - self.start > self.high_water:
+            self.high_water = self.end - self.start
+
+    def find(self, sub):
+        index = self.data.find(sub, self.start, self.end)
+        if index != -1:
+            index -= self.start
+
+        return index
+
+    def peek(self, n=None):
+        if n is None or n > self.end - self.start:
+            n = self.end - self.start
+
+        return self.view[self.start:self.start + n].tobytes()
+
+    def consume(self, n):
+        self.start += n
+        if self.start >= self.end:
+            self.clear()
+
+    def read(self, n=None):
+        ret = self.peek(n)
+        self.consume(len(ret))
+        return ret
+
+    def split(self, delimiter):
+        """
+        Returns all complete delimited lines and consumes them.
+        The partial line after the last delimiter stays in the buffer.
+        """
+        last = self.data.rfind(delimiter, self.start, self.end)
+        if last == -1:
+            return []
+
+        lines = self.view[self.start:last].tobytes().split(delimiter)
+        self.consume(last + len(delimiter) - self.start)
+        return lines
+
+    def clear(self):
+        self.start = 0
+        self.end = 0
+
+        # Give memory back after a burst of data.
+        if len(self.data) > self.size * 16:
+            self.data = bytearray(self.size)
+            self.view = memoryview(self.data)
+
+
+class Sock(object):
+    # Fixed attributes keep per connection memory down.
+    __slots__ = [
+        "registry", "con_id", "_nonce", "nonce_buf", "_unl", "reply_filter",
+        "_reply_callback", "max_buf", "max_chunks", "chunk_size", "recv_buf",
+        "replies", "blocking", "timeout", "s", "use_ssl", "alive",
+        "connected", "interface", "delimiter", "debug", "addr", "port",
+        "enable_sendmsg", "event_driven", "enable_send_queue", "send_queue",
+        "send_queue_len", "max_send_queue", "send_queue_high",
+        "send_queue_low", "send_queue_full", "send_queue_callback", "linger"
+    ]
 
-class Sock:
     def __init__(self, addr=None, port=None, blocking=0, timeout=5,
                  interface="default", use_ssl=0, debug=0):
+        # Index kept up to date when nonce or unl change (see Net.)
+        self.registry = None
+        self.con_id = None
         self.nonce = None
         self.nonce_buf = u""
         self.reply_filter = None
-        self.buf = b""
         self.max_buf = 1024 * 1024  # 1 MB.
         self.max_chunks = 1024  # Prevents spamming of multiple short messages.
         self.chunk_size = 1024 * 4
+        self.recv_buf = RecvBuffer(self.chunk_size)
         self.replies = []
         self.blocking = blocking
         self.timeout = timeout
@@ -73,9 +216,33 @@ class Sock:
             self.s = ssl.wrap_socket(self.s)
 
         self.connected = 0
+        self.addr = None
+        self.port = None
         self.interface = interface
         self.delimiter = b"\r\n"
         self.debug = debug
+        self._reply_callback = None
+
+        # Gather multiple buffers into one syscall where supported.
+        self.enable_sendmsg = 1
+
+        # Set by Net.poll while it handles a socket it has just read so
+        # update() doesn't need to recv again.
+        self.event_driven = 0
+
+        # Outbound queue used by send_line on non-blocking sockets.
+        self.enable_send_queue = 0
+        self.send_queue = deque()
+        self.send_queue_len = 0  # Bytes queued.
+        self.max_send_queue = 1024 * 1024  # 1 MB.
+        self.send_queue_high = 1024 * 256  # Signal backpressure.
+        self.send_queue_low = 1024 * 64  # Signal it's cleared.
+        self.send_queue_full = 0
+        self.send_queue_callback = None
+
+        # Seconds close() waits for queued lines to be written (0: it
+        # only writes what fits without blocking.)
+        self.linger = 0
 
         # Set keep alive.
         # self.set_keep_alive(self.s)
@@ -91,6 +258,44 @@ class Sock:
         else:
             self.set_blocking(self.blocking, self.timeout)
 
+    @property
+    def buf(self):
+        # Copy of the pending (unparsed) received data.
+        return self.recv_buf.peek()
+
+    @buf.setter
+    def buf(self, value):
+        self.recv_buf.clear()
+        self.recv_buf.write(value)
+
+    @property
+    def buf_high_water(self):
+        """
+        The most data that has been waiting in the receive buffer at once.
+        Useful for sizing max_buf per connection.
+        """
+        return self.recv_buf.high_water
+
+    @property
+    def nonce(self):
+        return self._nonce
+
+    @nonce.setter
+    def nonce(self, value):
+        self._nonce = value
+        if self.registry is not None:
+            self.registry.reindex(self)
+
+    @property
+    def unl(self):
+        return self._unl
+
+    @unl.setter
+    def unl(self, value):
+        self._unl = value
+        if self.registry is not None:
+            self.registry.reindex(self)
+
     def debug_print(self, msg):
         if self.debug:
             msg = "> " + str(msg)
@@ -203,7 +408,22 @@ class Sock:
             raise socket.error("Socket connect failed.")
 
     def close(self):
+        # Write out queued lines first. A send error closes the socket
+        # again from inside flush() so don't write a second time.
+        linger = self.linger
+        if linger is not None and self.connected and len(self.send_queue):
+            self.linger = None
+            try:
+                if linger:
+                    self.drain(linger)
+                else:
+                    self.flush()
+            finally:
+                self.linger = linger
+
         self.connected = 0
+        if self.registry is not None:
+            self.registry.closed(self)
 
         # Attempt graceful shutdown.
         try:
@@ -224,45 +444,21 @@ class Sock:
         to be complete when they arrive. The buffer stores all the data and
         this function splits the data into replies based on the new line
         delimiter.
+
+        The delimiter is located with bytes.find so the cost is linear in
+        the size of the buffer. Empty lines are dropped and any partial
+        reply after the last delimiter is left in the buffer.
         """
-        buf_len = len(self.buf)
         replies = []
-        reply = b""
-        chop = 0
-        skip = 0
-        i = 0
-        buf_len = len(self.buf)
-        for i in range(0, buf_len):
-            ch = self.buf[i:i + 1]
-            if skip:
-                skip -= 1
-                i += 1
+        for reply in self.recv_buf.split(self.delimiter):
+            # Skip empty lines.
+            if not reply:
                 continue
 
-            nxt = i + 1
-            if nxt < buf_len:
-                if ch == b"\r" and self.buf[nxt:nxt + 1] == b"\n":
-
-                    # Append new reply.
-                    if reply != b"":
-                        if encoding == "unicode":
-                            replies.append(encode_str(reply, encoding))
-                        else:
-                            replies.append(reply)
-                        reply = b""
-
-                    # Truncate the whole buf if chop is out of bounds.
-                    chop = nxt + 1
-                    skip = 1
-                    i += 1
-                    continue
-
-            reply += ch
-            i += 1
-
-        # Truncate buf.
-        if chop:
-            self.buf = self.buf[chop:]
+            if encoding == "unicode":
+                replies.append(encode_str(reply, encoding))
+            else:
+                replies.append(reply)
 
         return replies
 
@@ -296,7 +492,7 @@ class Sock:
             chunk_size = self.chunk_size
             while True:
                 # Don't exceed buffer size.
-                buf_len = len(self.buf)
+                buf_len = len(self.recv_buf)
                 if buf_len >= max_buf:
                     break
                 remaining = max_buf - buf_len
@@ -309,7 +505,8 @@ class Sock:
                     break
 
                 try:
-                    chunk = self.s.recv(chunk_size)
+                    # Read straight into the receive buffer.
+                    chunk_len = self.recv_buf.recv_into(self.s, chunk_size)
                 except socket.timeout as e:
                     self.debug_print("Get chunks timed out.")
                     self.debug_print(e)
@@ -340,13 +537,10 @@ class Sock:
                         self.close()
                         return
                 else:
-                    if chunk == b"":
+                    if not chunk_len:
                         self.close()
                         return
 
-                    # Avoid decoding errors.
-                    self.buf += chunk
-
                     # Otherwise the loop will be endless.
                     if self.blocking:
                         break
@@ -364,40 +558,72 @@ class Sock:
             if self.blocking:
                 if fixed_limit is None:
                     # Partial response.
-                    if self.delimiter not in self.buf:
+                    if self.recv_buf.find(self.delimiter) == -1:
                         repeat = 1
                         time.sleep(wait)
 
     def reply_callback(self, callback):
-        self.reply_callback = callback
+        self._reply_callback = callback
 
     # Called to check for replies and update buffers.
     def update(self):
-        self.get_chunks()
-        self.replies += self.parse_buf()
+        # Net.poll() has already read anything that was ready.
+        if self.event_driven:
+            self.event_driven = 0
+        else:
+            self.get_chunks()
+        replies = self.parse_buf()
 
-        # Execute callbacks on replies.
+        # Execute callbacks on new replies (older ones were already checked.)
         if self.reply_filter is not None:
-            replies = []
-            for reply in self.replies:
-                if not self.reply_filter(reply):
-                    replies.append(u"")
-                else:
-                    replies.append(reply)
-
-            self.replies = replies
+            reply_filter = self.reply_filter
+            replies = [reply if reply_filter(reply) else u""
+                       for reply in replies]
+
+        self.replies += replies
+
+    # Block until the socket can accept more data or timeout elapses.
+    def wait_writable(self, timeout):
+        timeout = max(timeout, 0)
+        if hasattr(select, "poll"):
+            poller = select.poll()
+            poller.register(self.s, select.POLLOUT)
+            return len(poller.poll(timeout * 1000)) != 0
+        else:
+            r, w, e = select.select([], [self.s], [], timeout)
+            return len(w) != 0
 
     # Blocking or non-blocking.
     def send(self, msg, send_all=0, timeout=5, encoding="ascii"):
+        # Convert to bytes Python 2 & 3
+        # The caller should ensure correct encoding.
+        if type(msg) == type(u""):
+            msg = encode_str(msg, "ascii")
+
+        return self.send_buffers([msg], send_all=send_all, timeout=timeout)
+
+    def send_buffers(self, buffers, send_all=0, timeout=5):
+        """
+        Sends a list of byte strings in order as one stream. Buffers are
+        wrapped in memoryviews so partial sends advance without copying.
+        When sendmsg is available several buffers are gathered into a
+        single system call. With send_all the function waits for the
+        socket to become writable (instead of spinning) until everything
+        has been sent or the timeout elapses.
+
+        Returns the number of bytes sent.
+        """
         # Update timeout.
         if timeout != self.timeout and self.blocking:
             self.set_blocking(self.blocking, timeout)
 
         try:
-            # Convert to bytes Python 2 & 3
-            # The caller should ensure correct encoding.
-            if type(msg) == type(u""):
-                msg = encode_str(msg, "ascii")
+            # Gathered writes aren't supported for SSL.
+            use_sendmsg = self.enable_sendmsg and not self.use_ssl and\
+                hasattr(self.s, "sendmsg")
+            if not use_sendmsg and len(buffers) > 1:
+                buffers = [b"".join(buffers)]
+            views = deque(memoryview(b) for b in buffers if len(b))
 
             # Work out stop time.
             if send_all:
@@ -405,63 +631,73 @@ class Sock:
             else:
                 future = 0
 
-            repeat = 1
             total_sent = 0
-            msg_len = len(msg)
-            while repeat:
-                repeat = 0
-                while True:
-                    # Attempt to send all.
-                    # This won't work if the network buffer is already full.
-                    try:
-                        bytes_sent = self.s.send(
-                                msg[total_sent:self.chunk_size])
-                    except socket.timeout as e:
-                        err = e.args[0]
-                        if err == "timed out":
-                            return 0
-                    except socket.error as e:
-                        err = e.args[0]
-                        if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
-                            break
-                        else:
-                            # Connection closed or other problem.
-                            self.debug_print("Con send closing other")
-                            self.close()
-                            return 0
-
-                    # Connection broken.
-                    if not bytes_sent or bytes_sent is None:
+            while len(views):
+                try:
+                    if use_sendmsg and len(views) > 1:
+                        bytes_sent = self.s.sendmsg(
+                            list(islice(views, 0, max_iov))
+                        )
+                    else:
+                        bytes_sent = self.s.send(views[0])
+                except socket.timeout as e:
+                    err = e.args[0]
+                    if err == "timed out":
+                        return 0
+                    raise
+                except ssl.SSLError as e:
+                    # Will block on non-blocking SSL sockets.
+                    want = [ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE]
+                    if e.errno not in want:
+                        self.debug_print("Con send ssl error")
                         self.close()
                         return 0
+                    bytes_sent = None
+                except socket.error as e:
+                    err = e.args[0]
+                    if err != errno.EAGAIN and err != errno.EWOULDBLOCK:
+                        # Connection closed or other problem.
+                        self.debug_print("Con send closing other")
+                        self.close()
+                        return 0
+                    bytes_sent = None
 
-                    # How much has been sent?
-                    total_sent += bytes_sent
-
-                    # Avoid looping forever.
-                    if self.blocking and not send_all:
+                # Network buffer is full.
+                if bytes_sent is None:
+                    if not send_all:
                         break
 
-                    # Everything sent.
-                    if total_sent >= msg_len:
+                    # Wait for space rather than spinning.
+                    remaining = future - time.time()
+                    if remaining <= 0 or not self.wait_writable(remaining):
                         break
+                    continue
 
-                    # Don't block.
-                    if not send_all:
-                        break
+                # Connection broken.
+                if not bytes_sent:
+                    self.close()
+                    return 0
 
-                    # Avoid 100% CPU.
-                    time.sleep(0.001)
+                # How much has been sent?
+                total_sent += bytes_sent
 
-                # Avoid looping forever.
-                if send_all:
-                    if time.time() >= future:
-                        repeat = 0
-                        break
+                # Drop sent buffers and advance into a partial one.
+                while bytes_sent:
+                    view_len = len(views[0])
+                    if bytes_sent >= view_len:
+                        views.popleft()
+                        bytes_sent -= view_len
+                    else:
+                        views[0] = views[0][bytes_sent:]
+                        bytes_sent = 0
+
+                # Don't block.
+                if not send_all:
+                    break
 
-                # Send the rest if blocking:
-                if total_sent < msg_len and send_all:
-                    repeat = 1
+                # Avoid looping forever.
+                if time.time() >= future:
+                    break
 
             return total_sent
         except Exception as e:
@@ -483,11 +719,8 @@ class Sock:
             # Get data.
             self.get_chunks(n, encoding=encoding)
 
-            # Return the current buffer.
-            ret = self.buf
-
-            # Reset the old buffer.
-            self.buf = b""
+            # Return (and empty) the current buffer.
+            ret = self.recv_buf.read()
 
             # Return results.
             if encoding == "unicode":
@@ -518,14 +751,15 @@ class Sock:
         if timeout != self.timeout and self.blocking:
             self.set_blocking(self.blocking, timeout)
 
+        # Queue instead of blocking.
+        if self.enable_send_queue and not self.blocking:
+            return self.queue_line(msg)
+
         try:
             # Convert to bytes Python 2 & 3
             if type(msg) == type(u""):
                 msg = encode_str(msg, "ascii")
 
-            # Convert delimiter to bytes.
-            msg += self.delimiter
-
             """
             The inclusion of the send_all flag makes this function behave like
             a blocking socket for the purposes of sending a full line even if
@@ -534,7 +768,8 @@ class Sock:
             bottleneck. (Otherwise you would have to check the number of bytes
             returned every time you sent a line which is quite annoying.)
             """
-            ret = self.send(msg, send_all=1, timeout=timeout)
+            ret = self.send_buffers([msg, self.delimiter], send_all=1,
+                                    timeout=timeout)
 
             return ret
         except Exception as e:
@@ -544,6 +779,152 @@ class Sock:
             self.close()
             return 0
 
+    # Sends several lines at once (gathered into one syscall if possible.)
+    # Blocking: blocks until all lines are sent like send_line.
+    def send_lines(self, msgs, timeout=5):
+        # Not connected.
+        if not self.connected:
+            return 0
+
+        # Queue instead of blocking.
+        if self.enable_send_queue and not self.blocking:
+            total = 0
+            for msg in msgs:
+                queued = self.queue_line(msg)
+                if not queued:
+                    break
+                total += queued
+            return total
+
+        buffers = []
+        for msg in msgs:
+            # Sanity checking.
+            assert (len(msg))
+
+            # Convert to bytes Python 2 & 3
+            if type(msg) == type(u""):
+                msg = encode_str(msg, "ascii")
+
+            buffers.append(msg)
+            buffers.append(self.delimiter)
+
+        return self.send_buffers(buffers, send_all=1, timeout=timeout)
+
+    def queue_line(self, msg):
+        """
+        Adds a line to the outbound queue and returns straight away with
+        the number of bytes queued (0 if the queue is full or the socket
+        is disconnected.) The queue is written out by flush() which is
+        called here if nothing was waiting and otherwise by whoever is
+        driving the socket (e.g. Net.synchronize.)
+        """
+        # Sanity checking.
+        assert (len(msg))
+
+        # Not connected.
+        if not self.connected:
+            return 0
+
+        # Convert to bytes Python 2 & 3
+        if type(msg) == type(u""):
+            msg = encode_str(msg, "ascii")
+        msg += self.delimiter
+
+        # Queue is bounded.
+        msg_len = len(msg)
+        if self.send_queue_len + msg_len > self.max_send_queue:
+            self.debug_print("Send queue full")
+            return 0
+
+        was_empty = not len(self.send_queue)
+        self.send_queue.append(msg)
+        self.send_queue_len += msg_len
+
+        # Signal backpressure.
+        if not self.send_queue_full and \
+                self.send_queue_len >= self.send_queue_high:
+            self.send_queue_full = 1
+            if self.send_queue_callback is not None:
+                self.send_queue_callback(self, "high")
+
+        # Try write it now to avoid waiting for the next flush.
+        if was_empty:
+            self.flush()
+
+        return msg_len
+
+    def flush(self):
+        """
+        Writes as much of the outbound queue as the kernel will accept
+        without blocking. Returns the number of bytes written.
+        """
+        total_sent = 0
+        while len(self.send_queue) and self.connected:
+            # Gather as many queued lines as possible into one write.
+            if self.enable_sendmsg:
+                buffers = list(islice(self.send_queue, 0, max_iov))
+            else:
+                buffers = [self.send_queue[0]]
+            buffers_len = 0
+            for buf in buffers:
+                buffers_len += len(buf)
+
+            sent = self.send_buffers(buffers, send_all=0,
+                                     timeout=self.timeout)
+            if not sent:
+                break
+            total_sent += sent
+            self.send_queue_len -= sent
+            is_partial = sent < buffers_len
+
+            # Drop sent lines and advance into a partial one.
+            while sent:
+                buf_len = len(self.send_queue[0])
+                if sent >= buf_len:
+                    self.send_queue.popleft()
+                    sent -= buf_len
+                else:
+                    self.send_queue[0] = memoryview(self.send_queue[0])[sent:]
+                    sent = 0
+
+            # Kernel buffer is full.
+            if is_partial:
+                break
+
+        # Backpressure is over.
+        if self.send_queue_full and \
+                self.send_queue_len <= self.send_queue_low:
+            self.send_queue_full = 0
+            if self.send_queue_callback is not None:
+                self.send_queue_callback(self, "low")
+
+        # Ask to be flushed again (or say there's nothing left.)
+        if self.registry is not None:
+            if len(self.send_queue):
+                self.registry.queued(self)
+            elif total_sent:
+                self.registry.drained(self)
+
+        return total_sent
+
+    def drain(self, timeout=5):
+        """
+        Flushes the outbound queue, waiting for the socket to become
+        writable, until it's empty or timeout elapses. Returns 1 if
+        everything was written.
+        """
+        future = time.time() + timeout
+        while len(self.send_queue) and self.connected:
+            self.flush()
+            if not len(self.send_queue) or not self.connected:
+                break
+
+            remaining = future - time.time()
+            if remaining <= 0 or not self.wait_writable(remaining):
+                break
+
+        return int(not len(self.send_queue))
+
     # Receives a new message delimited by a new line.
     # Blocking or non-blocking.
     def recv_line(self, timeout=5):
@@ -572,7 +953,7 @@ class Sock:
 
                 # Non-blocking.
                 if not ((not len(self.replies) or len(
-                        self.buf) >= self.max_buf) and self.blocking):
+                        self.recv_buf) >= self.max_buf) and self.blocking):
                     break
 
                 # Timeout elapsed.
@@ -245,7 +245,8 @@ if(!empty($call) && !empty($node_id))
             global $con;
             global $config;
         
-            $msg = $_GET["msg"];
+            #Sent in the POST body or the query string.
+            $msg = isset($_POST["msg"]) ? $_POST["msg"] : $_GET["msg"];
             if(empty($msg))
             {
                 echo("failure");
@@ -0,0 +1,166 @@
+import sys
+from unittest import TestCase
+
+if sys.version_info >= (3, 5, 0):
+    import asyncio
+    from pyp2p.async_net import *
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def direct_net():
+    return AsyncNet(
+        net_type="direct",
+        node_type="passive",
+        nat_type="preserving",
+        passive_bind="127.0.0.1",
+        passive_port=0,
+        wan_ip="8.8.8.8",
+        debug=1
+    )
+
+
+class TestAsyncNet(TestCase):
+    def setUp(self):
+        if sys.version_info < (3, 5, 0):
+            self.skipTest("asyncio transport needs Python 3.5+")
+
+    def test_async_sock(self):
+        async def echo(reader, writer):
+            while 1:
+                line = await reader.readline()
+                if not line:
+                    break
+                writer.write(line)
+            writer.close()
+
+        async def test():
+            server = await asyncio.start_server(echo, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            con = await AsyncSock.connect("127.0.0.1", port)
+            assert(con.connected)
+
+            # Nothing to read.
+            assert(await con.recv_line(timeout=0.1) == u"")
+
+            # Lines come back in order and empty lines are skipped.
+            assert(await con.send_line("test") == 6)
+            assert(await con.send_lines(["a", "b"]) == 6)
+            await con.send(b"\r\n")
+            assert(await con.recv_line() == u"test")
+            assert(await con.recv_line() == u"a")
+            assert(await con.recv_line() == u"b")
+            assert(await con.recv_line(timeout=0.1) == u"")
+
+            # Iteration ends when the connection closes.
+            await con.send_line("last")
+            con.writer.write_eof()
+            replies = []
+            async for reply in con:
+                replies.append(reply)
+            assert(replies == [u"last"])
+            assert(not con.connected)
+            assert(await con.send_line("test") == 0)
+
+            server.close()
+            await server.wait_closed()
+
+        run(test())
+
+    def test_wait_for_con(self):
+        async def test():
+            net = direct_net()
+            await net.start_passive_server()
+            assert(net.passive_port)
+
+            # Wait for a con by ID before it's been made.
+            nonce = "a" * 64
+            con_id = net.generate_con_id(nonce, "127.0.0.1", net.wan_ip)
+            waiter = asyncio.ensure_future(net.wait_for_con(con_id=con_id,
+                                                            timeout=5))
+            await asyncio.sleep(0)
+
+            client = await AsyncSock.connect("127.0.0.1", net.passive_port)
+            await client.send(nonce)
+            await client.send_line("test")
+            con = await waiter
+            assert(con is not None)
+            assert(con.nonce == nonce)
+            assert(list(net) == [con])
+            assert(await con.recv_line() == u"test")
+
+            # Already connected.
+            assert(await net.wait_for_con(con_id=con_id) is con)
+
+            # Nothing turns up.
+            assert(await net.wait_for_con(ip="1.1.1.1", timeout=0.1) is None)
+            assert(not len(net.con_waiters))
+
+            # Outbound con to another net.
+            other = direct_net()
+            await other.start_passive_server()
+            out = await net.add_node("127.0.0.1", other.passive_port,
+                                     "passive")
+            assert(out is not None)
+            assert(len(net.outbound) == 1)
+            out.nonce = nonce
+            await out.send(nonce)
+            await out.send_line("test")
+            found = await other.wait_for_con(ip="127.0.0.1", timeout=5)
+            await asyncio.gather(*[
+                c.send_line("reply") for c in other
+            ])
+            assert(await found.recv_line() == u"test")
+            assert(await out.recv_line() == u"reply")
+
+            # Dead cons are reaped.
+            client.close()
+            assert(await con.recv_line() == u"")
+            assert(list(net) == [out])
+
+            await other.stop()
+            await net.stop()
+            assert(not len(net.outbound + net.inbound))
+
+        run(test())
+
+    def test_async_punched_cons(self):
+        async def test():
+            net = direct_net()
+            net.node_type = "simultaneous"
+            listen = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listen.bind(("127.0.0.1", 0))
+            listen.listen(2)
+            port = listen.getsockname()[1]
+
+            # Quiet rendezvous con and a hole punched con.
+            net.rendezvous.server_con = Sock("127.0.0.1", port)
+            server, address = listen.accept()
+            sock = Sock("127.0.0.1", port)
+            peer, address = listen.accept()
+            listen.close()
+            peer.sendall(b"a" * 64 + b"test\r\n")
+
+            # Taken over on the event loop.
+            net.add_simultaneous_con(sock)
+            assert(not len(net.inbound))
+            await net.accept_simultaneous_cons()
+            assert(not len(net.punched_cons))
+            assert(len(net.inbound) == 1)
+            con = await net.wait_for_con(ip="127.0.0.1", timeout=5)
+            assert(isinstance(con, AsyncSock))
+            assert(con.nonce == "a" * 64)
+            assert(await con.recv_line() == u"test")
+
+            net.rendezvous.server_con.close()
+            server.close()
+            peer.close()
+            await net.stop()
+
+        run(test())
@@ -1,5 +1,6 @@
 import future
 import logging
+import sys
 from queue import Queue
 from unittest import TestCase
 from pyp2p.dht_msg import DHT
@@ -8,6 +9,80 @@ log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
 
+def wait_for(d, timeout=5):
+    # Result of a Deferred fired from another thread.
+    import time
+    results = []
+    d.addCallback(results.append)
+    future = time.time() + timeout
+    while not len(results) and time.time() < future:
+        time.sleep(0.01)
+
+    return results[0] if len(results) else None
+
+
+def serve_dht_msg():
+    """
+    Stands in for dht_msg.php on a local port. Returns the server
+    and what it's seen: messages by node, connections and puts. The
+    next state["fail"] puts are refused.
+    """
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlparse
+
+    state = {"messages": {}, "cons": [], "puts": 0, "fail": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            state["cons"].append(self.client_address)
+
+        def do_GET(self):
+            self.respond(parse_qs(urlparse(self.path).query))
+
+        def do_POST(self):
+            query = parse_qs(urlparse(self.path).query)
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            query.update(parse_qs(body.decode("ascii")))
+            self.respond(query)
+
+        def respond(self, query):
+            if query["call"][0] == "put" and state["fail"]:
+                state["fail"] -= 1
+                body = b"failed"
+            elif query["call"][0] == "put":
+                state["puts"] += 1
+                node_id = query["dest_node_id"][0]
+                state["messages"].setdefault(node_id, [])
+                state["messages"][node_id].append(query["msg"][0])
+                body = b"success"
+            else:
+                messages = state["messages"].pop(query["node_id"][0], [])
+                body = json.dumps(messages).encode("ascii")
+
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.endpoint = "http://127.0.0.1:%d/dht_msg.php" %\
+        server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server, state
+
+
 class TestDHTMsg(TestCase):
     def test_00001(self):
         dht_node = DHT()
@@ -33,3 +108,196 @@ class TestDHTMsg(TestCase):
         bob.send_direct_message(alice.get_id(), msg)
         assert(alice.has_messages())
         assert(alice.get_messages()[0] == msg)
+
+    def test_envelope(self):
+        import binascii
+        import umsgpack
+        from pyp2p.dht_msg import pack_message, unpack_message,\
+            COMPRESS_THRESHOLD, ENVELOPE_MARKER
+
+        dht_node = DHT(networking=0)
+        big = {u"status": u"SYN", u"data": u"x" * COMPRESS_THRESHOLD}
+        for msg in [u"REVERSE_CONNECT:abc", b"\x00\xff", big,
+                    u"{'not': 'evaluated'}"]:
+            packed = dht_node.serialize_message(msg)
+            assert(packed.startswith(ENVELOPE_MARKER))
+            assert(unpack_message(packed) == (msg, False))
+            assert(dht_node.build_dht_response(packed) == msg)
+
+        # Large messages are compressed.
+        assert(len(pack_message(big)) < COMPRESS_THRESHOLD)
+
+        # The old format still decodes as it did.
+        old = binascii.hexlify(umsgpack.packb(u"{'a': 1}"))
+        assert(dht_node.build_dht_response(old) == {"a": 1})
+        assert(dht_node.build_dht_responses(old.decode("ascii")) ==
+               [{"a": 1}])
+
+        # Unknown versions are rejected.
+        try:
+            unpack_message(ENVELOPE_MARKER + "AgA")
+            assert(0)
+        except ValueError:
+            pass
+
+
+class TestLocalDHTMsg(TestCase):
+    """
+    Runs against serve_dht_msg() instead of the live dht_msg.php.
+    """
+
+    def setUp(self):
+        import pyp2p.dht_msg
+
+        # ThreadingHTTPServer is new in 3.7.
+        if sys.version_info < (3, 7):
+            self.skipTest("Needs Python 3.7+")
+
+        self.server, self.state = serve_dht_msg()
+        self.endpoint = pyp2p.dht_msg.dht_msg_endpoint
+        pyp2p.dht_msg.dht_msg_endpoint = self.server.endpoint
+
+    def tearDown(self):
+        import pyp2p.dht_msg
+
+        pyp2p.dht_msg.dht_msg_endpoint = self.endpoint
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_session(self):
+        dht_node = DHT(networking=0)
+        try:
+            for i in range(0, 5):
+                assert(wait_for(dht_node.put(dht_node.node_id,
+                                             u"msg %d" % i)) == 1)
+            dht_node.networking = 1
+            replies = dht_node.list(timeout=5)
+            assert(replies == [u"msg %d" % i for i in range(0, 5)])
+
+            # Every call went over the same connection.
+            assert(len(self.state["cons"]) == 1)
+
+            # Or in a POST body.
+            import pyp2p.dht_msg
+            pyp2p.dht_msg.POST_MESSAGES = True
+            try:
+                assert(wait_for(dht_node.put(dht_node.node_id,
+                                             u"posted")) == 1)
+            finally:
+                pyp2p.dht_msg.POST_MESSAGES = False
+            assert(dht_node.list(timeout=5) == [u"posted"])
+
+            # Messages that can't be decoded are skipped on their own.
+            from pyp2p.dht_msg import ENVELOPE_MARKER
+            self.state["messages"][dht_node.node_id] = [
+                dht_node.serialize_message(u"before"),
+                ENVELOPE_MARKER + "AgA",
+                dht_node.serialize_message(u"after")
+            ]
+            assert(dht_node.list(timeout=5) == [u"before", u"after"])
+        finally:
+            dht_node.stop()
+
+    def test_queue_put(self):
+        import time
+
+        alice = DHT(networking=0)
+        bob = DHT(networking=0)
+        alice.max_batch = 4
+        try:
+            # Batched per destination, max_batch at a time.
+            results = []
+            for i in range(0, 6):
+                d = alice.queue_put(bob.node_id, u"msg %d" % i)
+                d.addCallback(results.append)
+            d = alice.queue_put(alice.node_id, {u"to": u"alice"})
+            d.addCallback(results.append)
+            future = time.time() + 5
+            while len(results) < 7 and time.time() < future:
+                time.sleep(0.01)
+            assert(results == [1] * 7)
+            assert(self.state["puts"] == 3)
+            assert(alice.sender is not None)
+
+            # Lists expand batches back into messages in order.
+            bob.networking = alice.networking = 1
+            replies = bob.list(timeout=5)
+            assert(replies == [u"msg %d" % i for i in range(0, 6)])
+            assert(alice.list(timeout=5) == [{u"to": u"alice"}])
+
+            # Failed puts are retried without holding up other nodes.
+            alice.put_retry_interval = 0.3
+            self.state["fail"] = 1
+            first = alice.queue_put(bob.node_id, u"retried")
+            time.sleep(0.1)
+            assert(wait_for(alice.queue_put(alice.node_id, u"x")) == 1)
+            assert(not first.called)
+            assert(wait_for(first) == 1)
+            assert(bob.list(timeout=5) == [u"retried"])
+
+            # Or given up on after put_retries attempts.
+            alice.put_retries = 2
+            alice.put_retry_interval = 0.01
+            self.state["fail"] = 2
+            assert(wait_for(alice.queue_put(bob.node_id, u"lost")) == 0)
+            assert(not len(bob.list(timeout=5)))
+
+            # Fired on the reactor thread once it's running.
+            class Reactor(object):
+                running = 1
+
+                def __init__(self):
+                    self.calls = []
+
+                def callFromThread(self, f, *args):
+                    self.calls.append((f, args))
+
+            alice.reactor = Reactor()
+            d = alice.queue_put(bob.node_id, u"later")
+            future = time.time() + 5
+            while not len(alice.reactor.calls) and time.time() < future:
+                time.sleep(0.01)
+            assert(not d.called)
+            f, args = alice.reactor.calls[0]
+            f(*args)
+            assert(d.result == 1)
+        finally:
+            alice.stop()
+            bob.stop()
+
+    def test_worker_pool(self):
+        import time
+        from pyp2p.dht_msg import WorkerPool, WORKERS
+
+        # Due jobs run in order on a fixed set of threads.
+        pool = WorkerPool(workers=2)
+        ran = []
+        pool.call_later(0.2, ran.append, "late")
+        pool.call_later(0.1, ran.append, "early")
+        pool.submit(ran.append, "now")
+        time.sleep(0.4)
+        assert(ran == ["now", "early", "late"])
+        assert(len(pool.threads) == 3)
+        pool.stop()
+
+        # One-off calls are retried until they succeed.
+        dht_node = DHT(networking=0)
+        try:
+            calls = []
+
+            def flaky(args):
+                calls.append(args)
+                return len(calls) == 3 and "done"
+
+            d = dht_node.retry_in_thread(flaky, check_interval=0.01)
+            assert(wait_for(d) == "done")
+            assert(len(calls) == 3)
+            assert(wait_for(dht_node.async_dht_put(dht_node.node_id,
+                                                   u"x")) == "success")
+
+            # However many are in flight.
+            for i in range(0, 50):
+                dht_node.put(dht_node.node_id, u"msg %d" % i)
+            assert(len(dht_node.pool.threads) == WORKERS + 1)
+        finally:
+            dht_node.stop()
@@ -829,3 +829,334 @@ class TestNet(TestCase):
 
         node_1.stop()
         net.stop()
+
+    def test_poll(self):
+        net = Net(
+            net_type="direct",
+            node_type="passive",
+            nat_type="preserving",
+            passive_bind="127.0.0.1",
+            passive_port=0,
+            wan_ip="8.8.8.8",
+            debug=1
+        )
+        net.disable_advertise()
+        net.start_passive_server()
+
+        # Nothing happening: poll waits for the timeout.
+        t = time.time()
+        assert(net.poll(0.2) == [])
+        assert(time.time() - t >= 0.15)
+
+        # Connect and send nonce.
+        client = Sock("127.0.0.1", net.passive_port, blocking=0)
+        client.send("a" * 64, send_all=1)
+        future = time.time() + 5
+        while not len(list(net)) and time.time() < future:
+            net.poll(0.1)
+        cons = list(net)
+        assert(len(cons) == 1)
+        con = cons[0]
+        assert(con.event_driven)
+        assert(net.selector_socks[id(con)][1] == selectors.EVENT_READ)
+
+        # Replies wake poll up straight away.
+        client.send_line("test")
+        t = time.time()
+        ready = net.poll(5)
+        assert(time.time() - t < 1)
+        assert(ready == [con])
+        assert(list(con) == [u"test"])
+
+        # Cons are still read outside of poll().
+        client.send_line("later")
+        replies = []
+        future = time.time() + 5
+        while not len(replies) and time.time() < future:
+            net.synchronize()
+            replies = list(con)
+            time.sleep(0.05)
+        assert(replies == [u"later"])
+
+        # Queued output is written when the socket is writable.
+        con.send_line("reply")
+        net.poll(0.1)
+        client.set_blocking(1, 1)
+        assert(client.recv_line(timeout=1) == u"reply")
+
+        # Only cons with a backlog wait for write readiness.
+        con.max_send_queue = 1024 * 1024 * 64
+        line = "x" * 1022
+        sent = 0
+        while not len(con.send_queue):
+            con.send_line(line)
+            sent += 1
+        assert(net.selector_socks[id(con)][1] & selectors.EVENT_WRITE)
+        received = []
+
+        def reader():
+            total = 0
+            while total < sent * 1024:
+                chunk = client.s.recv(1024 * 64)
+                if not chunk:
+                    break
+                total += len(chunk)
+                received.append(chunk)
+
+        r = Thread(target=reader)
+        r.start()
+        future = time.time() + 10
+        while len(con.send_queue) and time.time() < future:
+            net.poll(0.1)
+        r.join()
+        assert(len(b"".join(received)) == sent * 1024)
+        assert(net.selector_socks[id(con)][1] == selectors.EVENT_READ)
+
+        # Closed cons are unregistered.
+        con.close()
+        assert(id(con) not in net.selector_socks)
+
+        client.close()
+        net.stop()
+
+    def test_poll_nonce_and_line(self):
+        net = Net(
+            net_type="direct",
+            node_type="passive",
+            nat_type="preserving",
+            passive_bind="127.0.0.1",
+            passive_port=0,
+            wan_ip="8.8.8.8",
+            debug=1
+        )
+        net.disable_advertise()
+        net.start_passive_server()
+
+        # Nonce and first line in one write.
+        client = Sock("127.0.0.1", net.passive_port, blocking=0)
+        client.send("a" * 64 + "hello\r\n", send_all=1)
+        future = time.time() + 5
+        while not len(list(net)) and time.time() < future:
+            net.poll(0.1)
+        con = list(net)[0]
+        assert(con.nonce == u"a" * 64)
+        assert(list(con) == [u"hello"])
+
+        client.close()
+        net.stop()
+
+    def test_poll_idle(self):
+        net = Net(
+            net_type="direct",
+            node_type="passive",
+            nat_type="preserving",
+            passive_bind="127.0.0.1",
+            passive_port=0,
+            wan_ip="8.8.8.8",
+            debug=1
+        )
+        net.disable_advertise()
+        net.start_passive_server()
+
+        clients = []
+        for i in range(0, 2):
+            client = Sock("127.0.0.1", net.passive_port, blocking=0)
+            client.send(str(i) * 64, send_all=1)
+            clients.append(client)
+        future = time.time() + 5
+        while len(list(net)) < 2 and time.time() < future:
+            net.poll(0.1)
+        cons = list(net)
+        assert(len(cons) == 2)
+        busy = [con for con in cons if con.nonce == u"0" * 64][0]
+        idle = [con for con in cons if con.nonce == u"1" * 64][0]
+
+        # Count reads on the idle con's socket.
+        recvs = []
+
+        class CountingSocket(object):
+            def __init__(self, s):
+                self.s = s
+
+            def recv_into(self, *args):
+                recvs.append(args)
+                return self.s.recv_into(*args)
+
+            def __getattr__(self, name):
+                return getattr(self.s, name)
+
+        # The usual loop after poll() only reads the con that was ready.
+        clients[0].send_line("test")
+        ready = []
+        future = time.time() + 5
+        while not len(ready) and time.time() < future:
+            ready = net.poll(0.1)
+        idle.s = CountingSocket(idle.s)
+        replies = []
+        for con in net:
+            for reply in con:
+                replies.append(reply)
+        assert(ready == [busy])
+        assert(replies == [u"test"])
+        assert(not len(recvs))
+
+        # Read as usual without poll().
+        assert(not idle.event_driven)
+        list(idle)
+        assert(len(recvs))
+
+        for client in clients:
+            client.close()
+        net.stop()
+
+    def test_seen_messages(self):
+        cache = SeenMessages(max_entries=100)
+        now = [1000.0]
+        cache.clock = lambda: now[0]
+
+        # Duplicates are rejected until the retransmit interval passes.
+        assert(not cache.is_msg_old("test", record_seen=1))
+        assert(cache.is_msg_old("test"))
+        assert(cache.is_msg_old(b"test"))
+        now[0] += min_retransmit_interval
+        assert(cache.is_msg_old("test"))
+
+        # Entries expire.
+        now[0] += cache.ttl
+        assert(not cache.is_msg_old("test"))
+        assert(not len(cache))
+
+        # Size stays bounded under a flood of unique messages.
+        for i in range(0, 1000):
+            cache.record_msg_hash(str(i))
+            now[0] += 0.001
+        assert(len(cache) == 100)
+        assert("999" in cache)
+        assert("0" not in cache)
+
+        # Module level helpers clear every cache.
+        clear_seen_messages()
+        assert(not len(cache))
+
+    def test_registry(self):
+        net = Net(
+            net_type="direct",
+            node_type="passive",
+            nat_type="preserving",
+            passive_bind="127.0.0.1",
+            passive_port=0,
+            wan_ip="8.8.8.8",
+            debug=1
+        )
+        net.disable_advertise()
+        net.start_passive_server()
+
+        # Accept a con and receive its nonce.
+        nonce = "b" * 64
+        client = Sock("127.0.0.1", net.passive_port, blocking=0)
+        client.send(nonce, send_all=1)
+        future = time.time() + 5
+        while not len(list(net)) and time.time() < future:
+            net.poll(0.1)
+        con = list(net)[0]
+        assert(len(net.registry) == 1)
+
+        # Lookups.
+        con_id = net.generate_con_id(nonce, "127.0.0.1", net.wan_ip)
+        assert(con.con_id == con_id)
+        assert(net.con_by_id(con_id) is con)
+        assert(net.con_by_ip("127.0.0.1") is con)
+        assert(net.con_by_ip("127.0.0.2") is None)
+        assert(net.con_by_unl("unl") is None)
+        con.unl = "unl"
+        assert(net.con_by_unl("unl") is con)
+        assert(net.con_by_unl({"value": "unl"}) is con)
+
+        # Dead cons are removed from the indexes.
+        con.close()
+        net.synchronize()
+        assert(not len(net.registry))
+        assert(net.con_by_id(con_id) is None)
+        assert(net.con_by_ip("127.0.0.1") is None)
+        assert(net.con_by_unl("unl") is None)
+        assert(con.registry is None)
+
+        client.close()
+        net.stop()
+
+    def test_reap_cons(self):
+        net = Net(
+            net_type="direct",
+            node_type="passive",
+            nat_type="preserving",
+            passive_bind="127.0.0.1",
+            passive_port=0,
+            wan_ip="8.8.8.8",
+            debug=1
+        )
+        net.disable_advertise()
+        net.disable_bootstrap()
+
+        # Cons that have sent their nonce.
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(10)
+        addr = listener.getsockname()
+        pairs = []
+        for i in range(0, 10):
+            con = Sock(addr[0], addr[1], blocking=0)
+            pairs.append(listener.accept()[0])
+            con.nonce = str(i) * 64
+            node = PeerRecord(con, "passive", "127.0.0.1", 50500 + i)
+            net.inbound.append(node)
+            net.registry.add(node)
+        assert(not len(net.registry.awaiting_nonce))
+
+        # Only closed cons are queued for removal.
+        dead = [node["con"] for node in net.inbound[::3]]
+        for con in dead:
+            con.close()
+        assert(len(net.registry.dead) == len(dead))
+        net.synchronize()
+        assert(not len(net.registry.dead))
+        assert(len(net.inbound) == len(net.registry) == 10 - len(dead))
+        assert(not len([con for con in net if con in dead]))
+
+        # Expired reverse queries are dropped from the front.
+        t = time.time()
+        for i, age in enumerate([120, 90, 30, 0]):
+            net.pending_reverse_queries.append({
+                "unl": str(i),
+                "con": net.inbound[i]["con"],
+                "timestamp": t - age
+            })
+        net.expire_reverse_queries()
+        assert([q["unl"] for q in net.pending_reverse_queries] == ["2", "3"])
+        net.synchronize()
+        assert(len(net.inbound) == 10 - len(dead) - 2)
+
+        net.stop()
+        for s in pairs:
+            s.close()
+        listener.close()
+
+    def test_peer_record(self):
+        con = Sock()
+        node = PeerRecord(con, "passive", "127.0.0.1", 50500)
+        assert(node["con"] is con)
+        assert(node.ip == node["ip"] == "127.0.0.1")
+        node["port"] = 50501
+        assert(node.port == 50501)
+        assert("type" in node)
+        assert(node.get("nope", 1) == 1)
+        assert(dict(node.items())["type"] == "passive")
+        try:
+            node["nope"]
+            assert(0)
+        except KeyError:
+            pass
+
+        # No per instance dicts.
+        assert(not hasattr(node, "__dict__"))
+        assert(not hasattr(con, "__dict__"))
+        con.close()
@@ -20,6 +20,122 @@ class TestRendezvousClient(TestCase):
 
         rendezvous_servers[0]["port"] -= 10
 
+    def test_control(self):
+        import threading
+        try:
+            import socketserver
+        except ImportError:
+            import SocketServer as socketserver
+
+        # Answers like a rendezvous server and records what it gets.
+        lines = []
+        handlers = []
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                handlers.append(self)
+                for line in self.rfile:
+                    line = line.strip().decode("ascii")
+                    lines.append(line)
+                    if line == "SOURCE TCP":
+                        port = str(self.client_address[1]).encode("ascii")
+                        self.wfile.write(b"REMOTE TCP " + port + b"\r\n")
+                    elif line.startswith("BOOTSTRAP"):
+                        self.wfile.write(b"NODES EMPTY\r\n")
+
+        server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        client = RendezvousClient(nat_type="preserving", rendezvous_servers=[{
+            "addr": "127.0.0.1",
+            "port": server.server_address[1]
+        }])
+        try:
+            # Requests share one connection and can be pipelined.
+            # Ones without replies are acknowledged with SOURCE TCP.
+            assert(client.passive_listen(50500))
+            port = client.control_con.s.getsockname()[1]
+            replies = client.control_request(["BOOTSTRAP 5", "SOURCE TCP"], 2)
+            assert(replies == ["NODES EMPTY", "REMOTE TCP %d" % port])
+            assert(client.leave_fight())
+            assert(len(handlers) == 1)
+            assert(lines == ["PASSIVE READY 50500 10", "SOURCE TCP",
+                             "BOOTSTRAP 5", "SOURCE TCP",
+                             "CLEAR", "SOURCE TCP"])
+
+            # Health checked when it's been idle.
+            con = client.control_con
+            client.control_checked = 0
+            assert(client.control() is con)
+            assert(lines[-1] == "SOURCE TCP")
+
+            # Reconnects if the server drops it.
+            handlers[0].connection.shutdown(socket.SHUT_RDWR)
+            assert(client.control_request(["BOOTSTRAP 5"], 1) ==
+                   ["NODES EMPTY"])
+            assert(len(handlers) == 2)
+            assert(client.control_con is not con)
+
+            # Unacknowledged writes are retried on a new connection.
+            handlers[1].connection.shutdown(socket.SHUT_RDWR)
+            assert(client.leave_fight())
+            assert(len(handlers) == 3)
+            assert(lines[-2:] == ["CLEAR", "SOURCE TCP"])
+        finally:
+            client.close_control()
+            server.shutdown()
+            server.server_close()
+
+    def test_race_connect(self):
+        # Connects to a full listen backlog hang.
+        slow = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        slow.bind(("127.0.0.1", 0))
+        slow.listen(0)
+        filler = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        filler.connect(slow.getsockname())
+
+        # Nothing listening.
+        refused = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        refused.bind(("127.0.0.1", 0))
+        refused_port = refused.getsockname()[1]
+        refused.close()
+
+        live = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        live.bind(("127.0.0.1", 0))
+        live.listen(5)
+        servers = [
+            {"addr": "127.0.0.1", "port": slow.getsockname()[1]},
+            {"addr": "127.0.0.1", "port": refused_port},
+            {"addr": "127.0.0.1", "port": live.getsockname()[1]}
+        ]
+        client = RendezvousClient(nat_type="preserving",
+                                  rendezvous_servers=servers)
+        try:
+            t = time.time()
+            con = client.server_connect()
+            assert(time.time() - t < client.connect_timeout)
+            assert(con.connected and con.port == servers[2]["port"])
+            con.close()
+
+            # Fastest healthy server first from now on.
+            health = client.server_health
+            assert(health[("127.0.0.1", refused_port)]["failures"] == 1)
+            assert(health[("127.0.0.1", servers[0]["port"])]["rtt"] >=
+                   client.connect_stagger)
+            assert(client.server_order(servers) == [
+                servers[2], servers[0], servers[1]
+            ])
+            t = time.time()
+            con = client.server_connect()
+            assert(time.time() - t < client.connect_stagger)
+            assert(con.port == servers[2]["port"])
+            con.close()
+        finally:
+            for s in [slow, filler, live]:
+                s.close()
+
     def test_00001(self):
         from pyp2p.net import rendezvous_servers
         client = RendezvousClient(nat_type="preserving",
@@ -1,7 +1,29 @@
 from unittest import TestCase
+
+from twisted.internet.address import IPv4Address
+try:
+    from twisted.internet.testing import StringTransport
+except ImportError:
+    from twisted.test.proto_helpers import StringTransport
+
 from pyp2p.rendezvous_client import RendezvousClient
 
 
+def connect(factory, ip_addr):
+    # Protocol for a client at ip_addr with an in-memory transport.
+    addr = IPv4Address("TCP", ip_addr, 50500)
+    proto = factory.buildProtocol(addr)
+    proto.makeConnection(StringTransport(peerAddress=addr))
+    return proto
+
+
+def send(proto, line):
+    # Returns what the server wrote back.
+    proto.transport.clear()
+    proto.dataReceived(line.encode("ascii") + b"\r\n")
+    return proto.transport.value().decode("ascii")
+
+
 class TestRendezvousServer(TestCase):
     def test_00001(self):
         from pyp2p.net import rendezvous_servers
@@ -24,3 +46,446 @@ class TestRendezvousServer(TestCase):
         # but that is tested in the net tests
 
         s.close()
+
+    def test_commands(self):
+        import time
+        from pyp2p.rendezvous_server import RendezvousFactory
+
+        factory = RendezvousFactory()
+
+        node = connect(factory, "10.0.0.1")
+        client = connect(factory, "10.0.0.2")
+
+        # Register nodes.
+        assert(send(node, "SIMULTANEOUS READY 50500 10") == "")
+        assert(send(client, "PASSIVE READY 50501 10") == "")
+        assert("10.0.0.1" in factory.nodes["simultaneous"])
+        assert("10.0.0.2" in factory.nodes["passive"])
+        assert(send(node, "BOOTSTRAP 5") == "NODES p:10.0.0.2:50501 \r\n")
+        assert(send(client, "SOURCE TCP") == "REMOTE TCP 50500\r\n")
+
+        # Unknown commands and invalid arguments are ignored.
+        assert(send(client, "BOOTSTRAP x") == "")
+        assert(send(client, "BOOTSTRAP 101") == "")
+        assert(send(client, "PASSIVE READY x 10") == "")
+        assert(send(client, "NOPE") == "")
+        assert(send(client, "") == "")
+
+        # Hole punching.
+        node.transport.clear()
+        reply = send(client, "CANDIDATE 10.0.0.1 TCP 50502 50503")
+        assert(reply == "PREDICTION SET\r\n")
+        assert(node.transport.value() ==
+               b"CHALLENGE 10.0.0.2 50502 50503 TCP\r\n")
+        ntp = str(time.time())
+        client.transport.clear()
+        send(node, "ACCEPT 10.0.0.2 50504 TCP " + ntp)
+        assert(client.transport.value().decode("ascii") ==
+               "FIGHT 10.0.0.1 50504 TCP " + ntp + "\r\n")
+
+        # Remove node details.
+        send(client, "CLEAR")
+        assert("10.0.0.2" not in factory.nodes["passive"])
+        send(client, "QUIT")
+        assert(client.transport.disconnecting)
+
+    def test_node_table(self):
+        from pyp2p.rendezvous_server import NodeTable
+
+        table = NodeTable()
+        for i in range(0, 10):
+            table["10.0.0.%d" % i] = {
+                "max_inbound": 2,
+                "no": 0,
+                "port": "50500"
+            }
+        assert(len(table) == 10)
+        assert(sorted(table.sample(20)) == sorted(table))
+
+        # Removal keeps the arrays packed.
+        del table["10.0.0.0"]
+        del table["10.0.0.9"]
+        table["10.0.0.5"] = table["10.0.0.5"]
+        assert(len(table) == len(table.spare) == 8)
+        for ip_addr, (array, index) in table.positions.items():
+            assert(array[index] == ip_addr)
+
+        # Requester is skipped.
+        for i in range(0, 20):
+            assert("10.0.0.1" not in table.sample(7, skip=("10.0.0.1",)))
+
+        # Nodes with spare slots come first.
+        for ip_addr in list(table)[:6]:
+            table.handed_out(ip_addr)
+            table.handed_out(ip_addr)
+        assert(len(table.full) == 6)
+        spare = set(table.spare)
+        assert(set(table.sample(2)) == spare)
+        assert(spare < set(table.sample(3)))
+
+    def test_expiry(self):
+        import time
+        from twisted.internet import task
+        from pyp2p.rendezvous_server import RendezvousFactory
+
+        clock = task.Clock()
+        clock.advance(time.time())
+        factory = RendezvousFactory(clock=clock)
+
+        node = connect(factory, "10.0.0.1")
+        client = connect(factory, "10.0.0.2")
+        node.dataReceived(b"SIMULTANEOUS READY 50500 10\r\n")
+        client.dataReceived(b"PASSIVE READY 50501 10\r\n")
+        client.dataReceived(b"CANDIDATE 10.0.0.1 TCP 50502\r\n")
+        gauges = factory.gauges()
+        assert(gauges["passive"] == gauges["simultaneous"] == 1)
+        assert(gauges["candidates"] == 1)
+        assert(gauges["expiry_queue"] == 3)
+
+        # Replacing a candidate doesn't add to the queue.
+        for i in range(0, 10):
+            client.dataReceived(b"CANDIDATE 10.0.0.1 TCP 50502\r\n")
+        gauges = factory.gauges()
+        assert(gauges["candidates"] == 1)
+        assert(gauges["expiry_queue"] == 3)
+
+        # Candidates go first.
+        clock.advance(factory.challenge_timeout * 5 + 1)
+        assert(not len(factory.candidates["10.0.0.1"]))
+        assert(factory.gauges()["candidates"] == 0)
+
+        # Nodes seen since they were scheduled are kept.
+        factory.store.touch_node("passive", "10.0.0.2", clock.seconds())
+        clock.advance(factory.node_lifetime - factory.challenge_timeout * 5)
+        assert("10.0.0.1" not in factory.nodes["simultaneous"])
+        assert("10.0.0.1" not in factory.candidates)
+        assert("10.0.0.2" in factory.nodes["passive"])
+        clock.advance(factory.node_lifetime)
+        assert(factory.gauges() == {
+            "passive": 0,
+            "passive_spare": 0,
+            "simultaneous": 0,
+            "candidate_lists": 0,
+            "candidates": 0,
+            "connections": 2,
+            "expiry_queue": 0,
+            "worker_connections": 2
+        })
+        assert(not len(clock.getDelayedCalls()))
+
+    def test_candidate_index(self):
+        from pyp2p.rendezvous_server import CandidateIndex
+
+        def candidate(client_ip, t):
+            return {
+                "ip_addr": client_ip,
+                "time": t,
+                "predictions": ["50500"],
+                "proto": "TCP",
+                "con": None,
+                "propogated": 0
+            }
+
+        index = CandidateIndex()
+        for i in range(0, 5):
+            index.add(candidate("10.0.0.%d" % i, i))
+        assert(len(index) == len(index.pending()) == 5)
+
+        # Replacing a client's candidate moves it to the end.
+        index.add(candidate("10.0.0.0", 5))
+        assert([c["ip_addr"] for c in index.newest()][0] == "10.0.0.0")
+        assert(len(index) == 5)
+
+        # Accepted candidates aren't propagated again.
+        assert(index.propagated("10.0.0.1")["propogated"])
+        assert(index.propagated("10.0.0.1") is None)
+        assert("10.0.0.1" not in [c["ip_addr"] for c in index.pending()])
+        assert("10.0.0.1" in index)
+
+        # Old candidates are removed from the front.
+        index.remove_older(3)
+        assert(sorted(c["ip_addr"] for c in index) ==
+               ["10.0.0.0", "10.0.0.3", "10.0.0.4"])
+        assert(len(index.pending()) == 3)
+        assert(index.remove("10.0.0.3")["time"] == 3)
+        assert(index.remove("10.0.0.3") is None)
+
+    def test_logging(self):
+        import json
+        import logging
+        import os
+        import shutil
+        import tempfile
+        from twisted.internet import task
+        from pyp2p.rendezvous_server import RendezvousFactory, log,\
+            setup_logging, stop_logging
+
+        tmp = tempfile.mkdtemp()
+        log_path = os.path.join(tmp, "server.log")
+        access_log_path = os.path.join(tmp, "access.log")
+        clock = task.Clock()
+        flusher = setup_logging(level=logging.DEBUG, log_path=log_path,
+                                access_log_path=access_log_path,
+                                clock=clock)
+        try:
+            factory = RendezvousFactory(clock=clock)
+            proto = connect(factory, "10.0.0.1")
+            proto.dataReceived(b"SOURCE TCP\r\n")
+
+            # Buffered until flushed.
+            assert(not os.path.getsize(access_log_path))
+            clock.advance(1)
+            with open(access_log_path) as fp:
+                entries = [json.loads(line) for line in fp]
+            assert([(entry["direction"], entry["line"])
+                    for entry in entries] == [
+                ("none", "OPENED ="),
+                ("recv", "SOURCE TCP"),
+                ("send", "REMOTE TCP 50500")
+            ])
+            assert(entries[0]["peer"] == "10.0.0.1:50500")
+            with open(log_path) as fp:
+                assert("SOURCE TCP <- 10.0.0.1:50500" in fp.read())
+        finally:
+            flusher.stop()
+            stop_logging()
+            log.setLevel(logging.NOTSET)
+            shutil.rmtree(tmp)
+
+    def test_shared_store(self):
+        import time
+        from pyp2p.rendezvous_server import RendezvousFactory
+        from pyp2p.rendezvous_store import StoreManager
+
+        manager = StoreManager()
+        manager.start()
+        try:
+            # Two workers sharing the tables.
+            class Relay(object):
+                def send(self, ref, msg):
+                    workers[ref[0]].deliver(ref[1], msg)
+
+            workers = {}
+            for worker_id in [1, 2]:
+                workers[worker_id] = RendezvousFactory(
+                    store=manager.get_store(),
+                    worker_id=worker_id,
+                    relay=Relay()
+                )
+
+            # Nodes registered with one worker are seen by the other.
+            node = connect(workers[1], "10.0.0.1")
+            client = connect(workers[2], "10.0.0.2")
+            send(node, "SIMULTANEOUS READY 50500 10")
+            send(client, "PASSIVE READY 50501 10")
+            assert(send(connect(workers[1], "10.0.0.3"), "BOOTSTRAP 5") ==
+                   "NODES p:10.0.0.2:50501 \r\n")
+
+            # Challenge and fight are relayed between workers.
+            node.transport.clear()
+            reply = send(client, "CANDIDATE 10.0.0.1 TCP 50502")
+            assert(reply == "PREDICTION SET\r\n")
+            assert(node.transport.value() ==
+                   b"CHALLENGE 10.0.0.2 50502 TCP\r\n")
+            ntp = str(time.time())
+            client.transport.clear()
+            send(node, "ACCEPT 10.0.0.2 50504 TCP " + ntp)
+            assert(client.transport.value().decode("ascii") ==
+                   "FIGHT 10.0.0.1 50504 TCP " + ntp + "\r\n")
+
+            # Connection state is shared.
+            gauges = workers[2].gauges()
+            assert(gauges["passive"] == gauges["simultaneous"] == 1)
+            assert(gauges["candidates"] == 1)
+            assert("10.0.0.2" in workers[1].nodes["passive"])
+            assert("10.0.0.2" in workers[1].candidates["10.0.0.1"])
+            assert(workers[2].is_connected(node.ref))
+            node.connectionLost(None)
+            assert(not workers[2].is_connected(node.ref))
+
+            # Connections of a worker that's gone are dropped.
+            assert(workers[1].is_connected(client.ref))
+            workers[1].worker_lost(2)
+            assert(not workers[1].is_connected(client.ref))
+            send(client, "CLEAR")
+            assert(not workers[1].gauges()["passive"])
+        finally:
+            manager.shutdown()
+
+    def test_metrics(self):
+        import time
+        from twisted.web.test.requesthelper import DummyRequest
+        from pyp2p.rendezvous_server import RendezvousFactory,\
+            MetricsResource
+
+        factory = RendezvousFactory()
+
+        received = []
+
+        def receive(proto, data):
+            received.append(data)
+            proto.dataReceived(data)
+
+        node = connect(factory, "10.0.0.1")
+        client = connect(factory, "10.0.0.2")
+        receive(node, b"SIMULTANEOUS READY 50500 10\r\n")
+        receive(client, b"BOOTSTRAP 4\r\nNOPE\r\nBOOTSTRAP x\r\n")
+        receive(client, b"CANDIDATE 10.0.0.1 TCP 50502\r\n")
+
+        # Both pending candidates are challenged again.
+        other = connect(factory, "10.0.0.3")
+        receive(other, b"CANDIDATE 10.0.0.1 TCP 50506\r\n")
+        assert(node.transport.value().count(b"CHALLENGE 10.0.0.2") == 2)
+        receive(node, b"ACCEPT 10.0.0.2 50504 TCP %d\r\n" % time.time())
+
+        metrics = factory.metrics
+        assert(metrics.commands == {
+            "SIMULTANEOUS": 1,
+            "BOOTSTRAP": 1,
+            "CANDIDATE": 2,
+            "ACCEPT": 1
+        })
+        assert(metrics.unknown == metrics.invalid == 1)
+        assert(metrics.lines_in == 7)
+        bytes_in = len(b"".join(received))
+        assert(metrics.bytes_in == bytes_in)
+        sent = node.transport.value() + client.transport.value() +\
+            other.transport.value()
+        assert(metrics.lines_out == sent.count(b"\r\n") == 7)
+        assert(metrics.bytes_out == len(sent))
+        assert(metrics.opened == 3)
+        assert(metrics.bootstrap_requested == 4)
+        assert(metrics.bootstrap_returned == 0)
+        # Challenges are timed once per candidate.
+        assert(metrics.latency["challenge"].count == 2)
+        for stage in ["accept", "fight"]:
+            assert(metrics.latency[stage].count == 1)
+
+        # Scraped as text.
+        request = DummyRequest([b"metrics"])
+        MetricsResource(factory).render_GET(request)
+        assert(request.finished)
+        body = b"".join(request.written).decode("ascii")
+        lines = body.splitlines()
+        assert('rendezvous_commands_total{command="BOOTSTRAP"} 1' in lines)
+        assert('rendezvous_bytes_total{direction="in"} %d' % bytes_in
+               in lines)
+        assert("rendezvous_simultaneous 1" in lines)
+        assert("rendezvous_candidates 2" in lines)
+        assert("rendezvous_connections 3" in lines)
+        assert("rendezvous_bootstrap_fill_ratio 0.000000" in lines)
+        assert('rendezvous_latency_seconds_bucket'
+               '{stage="fight",le="+Inf"} 1' in lines)
+        assert('rendezvous_latency_seconds_count{stage="accept"} 1' in lines)
+
+    def test_store_pool(self):
+        import threading
+        import time
+        try:
+            from queue import Queue, Empty
+        except ImportError:
+            from Queue import Queue, Empty
+        from twisted.python.threadpool import ThreadPool
+        from pyp2p.rendezvous_server import RendezvousFactory
+
+        class Reactor(object):
+            # Runs calls from other threads when asked.
+            def __init__(self):
+                self.calls = Queue()
+
+            def callFromThread(self, f, *args, **kwargs):
+                self.calls.put((f, args, kwargs))
+
+            def run_until(self, done, timeout=5):
+                future = time.time() + timeout
+                while not done() and time.time() < future:
+                    try:
+                        f, args, kwargs = self.calls.get(timeout=0.05)
+                    except Empty:
+                        continue
+                    f(*args, **kwargs)
+
+                return done()
+
+        pool = ThreadPool(1, 1)
+        pool.start()
+        try:
+            factory = RendezvousFactory(store_pool=pool)
+            factory.reactor = Reactor()
+            store_threads = set()
+            set_node = factory.store.set_node
+
+            def record_set_node(*args):
+                store_threads.add(threading.current_thread())
+                return set_node(*args)
+
+            factory.store.set_node = record_set_node
+
+            # Commands run on the pool and write through the reactor.
+            node = connect(factory, "10.0.0.1")
+            node.dataReceived(b"PASSIVE READY 50500 10\r\nSOURCE TCP\r\n")
+            assert(node.transport.value() == b"")
+            assert(factory.reactor.run_until(
+                lambda: node.transport.value() == b"REMOTE TCP 50500\r\n"
+            ))
+            assert(store_threads and
+                   threading.current_thread() not in store_threads)
+            assert(factory.is_connected(node.ref))
+            assert(factory.reactor.run_until(lambda: len(factory.expiry)))
+
+            # Closed in order after the commands.
+            node.connectionLost(None)
+            assert(factory.reactor.run_until(
+                lambda: not factory.store.is_connected(node.ref)
+            ))
+        finally:
+            pool.stop()
+            factory.expiry.stop()
+
+    def test_worker_relay(self):
+        import shutil
+        import tempfile
+        from pyp2p.rendezvous_server import RendezvousFactory, RelayFactory,\
+            WorkerRelay
+
+        factory = RendezvousFactory(worker_id=1)
+        client = connect(factory, "10.0.0.2")
+
+        # Lines from worker 2 for our connections.
+        relay = RelayFactory(factory).buildProtocol(None)
+        relay.makeConnection(StringTransport())
+        relay.dataReceived(b"WORKER 2\r\n%d FIGHT 10.0.0.1 50504 TCP 1\r\n"
+                           % client.ref[1])
+        assert(client.transport.value() == b"FIGHT 10.0.0.1 50504 TCP 1\r\n")
+
+        # Its connections go when it does.
+        factory.store.con_opened((2, 1))
+        assert(factory.is_connected((2, 1)))
+        relay.connectionLost(None)
+        assert(not factory.is_connected((2, 1)))
+        assert(factory.is_connected(client.ref))
+
+        # Lines wait for the other worker to connect.
+        class Peer(object):
+            def __init__(self):
+                self.lines = []
+
+            def sendLine(self, line):
+                self.lines.append(line)
+
+        tmp = tempfile.mkdtemp()
+        try:
+            worker = WorkerRelay(tmp, 1, 2)
+            worker.max_pending = 2
+            assert(worker.send((2, 5), "CHALLENGE a"))
+            assert(worker.send((2, 5), u"CHALLENGE b"))
+            assert(not worker.send((2, 5), "CHALLENGE c"))
+            peer = Peer()
+            worker.connected(2, peer)
+            assert(worker.send((2, 6), "RECONNECT"))
+            assert(peer.lines == [b"5 CHALLENGE a", b"5 CHALLENGE b",
+                                  b"6 RECONNECT"])
+            worker.disconnected(2, peer)
+            assert(not len(worker.peers))
+        finally:
+            shutil.rmtree(tmp)
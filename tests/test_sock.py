@@ -177,6 +177,17 @@ def simple_server():
     s.close()
 
 
+def loopback_pair(blocking=0):
+    # Returns a connected (Sock, raw socket) pair over loopback.
+    listen = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen.bind(("127.0.0.1", 0))
+    listen.listen(1)
+    con = Sock("127.0.0.1", listen.getsockname()[1], blocking=blocking)
+    peer, address = listen.accept()
+    listen.close()
+    return con, peer
+
+
 class TestSock(TestCase):
     def test_http_upload_post(self):
         SockUpload(1000 * 100)
@@ -535,6 +546,213 @@ class TestSock(TestCase):
         time.sleep(2.2)
         sock.close()
 
+    def test_parse_buf(self):
+        s = Sock()
+        s.buf = b"\r\nx\r\n\r\n\r\r\n"
+        assert(s.parse_buf() == [u"x", u"\r"])
+        assert(s.buf == b"")
+
+        # Partial replies are kept.
+        s.buf = b"abc\r\nde\r"
+        assert(s.parse_buf() == [u"abc"])
+        assert(s.buf == b"de\r")
+        s.buf += b"\nf"
+        assert(s.parse_buf(encoding="ascii") == [b"de"])
+        assert(s.buf == b"f")
+
+        # Large buffers.
+        line = b"x" * 98 + b"\r\n"
+        s.buf = line * 10000 + b"tail"
+        x = s.parse_buf()
+        assert(len(x) == 10000)
+        assert(x[0] == u"x" * 98)
+        assert(s.buf == b"tail")
+        s.close()
+
+    def test_reply_filter(self):
+        # Replies are only passed to the filter once.
+        from pyp2p.net import SeenMessages
+        cache = SeenMessages()
+        checked = []
+
+        def reply_filter(msg):
+            checked.append(msg)
+            return not cache.check(msg, record_seen=1)
+
+        s = Sock()
+        s.event_driven = 1
+        s.reply_filter = reply_filter
+        s.buf = b"a\r\nb\r\na\r\n"
+        assert(len(s) == 3)
+        assert(len(s) == 3)
+        assert(list(s) == [u"a", u"b", u""])
+        assert(checked == [u"a", u"b", u"a"])
+        s.close()
+
+    def test_recv_buffer(self):
+        con, peer = loopback_pair()
+        peer.sendall(b"first\r\nsec")
+        time.sleep(0.1)
+        con.update()
+        assert(con.replies == [u"first"])
+        assert(con.buf == b"sec")
+        peer.sendall(b"ond\r\n" + b"x" * (1024 * 100))
+        time.sleep(0.1)
+        con.update()
+        assert(con.replies == [u"first", u"second"])
+        assert(len(con.recv_buf) == 1024 * 100)
+        assert(con.buf_high_water >= 1024 * 100)
+
+        # Raw recv empties the buffer.
+        data = con.recv(1, encoding="ascii")
+        assert(type(data) == bytes)
+        assert(data == b"x" * (1024 * 100))
+        assert(con.buf == b"")
+
+        # Remote close.
+        peer.close()
+        time.sleep(0.1)
+        con.update()
+        assert(not con.connected)
+
+    def test_send_large(self):
+        con, peer = loopback_pair()
+        payload = os.urandom(1024 * 1024 * 4)
+        received = []
+
+        def reader():
+            data = b""
+            while len(data) < len(payload):
+                chunk = peer.recv(1024 * 64)
+                if not chunk:
+                    break
+                data += chunk
+            received.append(data)
+
+        t = Thread(target=reader)
+        t.start()
+        assert(con.send(payload, send_all=1, timeout=10) == len(payload))
+        t.join()
+        assert(received[0] == payload)
+
+        # Batched lines arrive in order.
+        assert(con.send_lines([u"a", b"bc", u"d"]) == 10)
+        con.enable_sendmsg = 0
+        assert(con.send_line(u"e") == 3)
+        time.sleep(0.1)
+        assert(peer.recv(1024) == b"a\r\nbc\r\nd\r\ne\r\n")
+        con.close()
+        peer.close()
+
+    def test_send_queue(self):
+        con, peer = loopback_pair()
+        con.enable_send_queue = 1
+        con.max_send_queue = 1024 * 1024 * 8
+        con.send_queue_high = 1024 * 1024 * 2
+        con.send_queue_low = 1024 * 64
+        events = []
+
+        def callback(sock, level):
+            events.append(level)
+
+        con.send_queue_callback = callback
+
+        # Peer isn't reading so lines back up in the queue.
+        line = b"x" * 1022
+        sent = 0
+        t = time.time()
+        while not con.send_queue_full:
+            assert(con.send_line(line) == 1024)
+            sent += 1
+        assert(time.time() - t < 5)
+        assert(events == ["high"])
+        assert(len(con.send_queue))
+
+        # Queue is bounded.
+        con.max_send_queue = con.send_queue_len
+        assert(con.send_line(line) == 0)
+
+        # Drain it.
+        received = []
+
+        def reader():
+            total = 0
+            while total < sent * 1024:
+                chunk = peer.recv(1024 * 64)
+                if not chunk:
+                    break
+                total += len(chunk)
+                received.append(chunk)
+
+        r = Thread(target=reader)
+        r.start()
+        future = time.time() + 10
+        while len(con.send_queue) and time.time() < future:
+            con.flush()
+            con.wait_writable(0.1)
+        r.join()
+        assert(con.send_queue_len == 0)
+        assert(events == ["high", "low"])
+        assert(b"".join(received) == (line + b"\r\n") * sent)
+        con.close()
+        peer.close()
+
+    def test_send_queue_close(self):
+        # Queued lines are written out by close() given a linger.
+        con, peer = loopback_pair()
+        con.enable_send_queue = 1
+        con.max_send_queue = 1024 * 1024 * 64
+        con.linger = 5
+        line = b"x" * 1022
+        sent = 0
+        while not len(con.send_queue):
+            con.send_line(line)
+            sent += 1
+        for i in range(0, 100):
+            con.send_line(line)
+            sent += 1
+
+        received = []
+
+        def reader():
+            while True:
+                chunk = peer.recv(1024 * 64)
+                if not chunk:
+                    break
+                received.append(chunk)
+
+        r = Thread(target=reader)
+        r.start()
+        con.close()
+        r.join()
+        assert(b"".join(received) == (line + b"\r\n") * sent)
+        peer.close()
+
+        # Waits no longer than linger for a peer that isn't reading.
+        con, peer = loopback_pair()
+        con.enable_send_queue = 1
+        con.max_send_queue = 1024 * 1024 * 64
+        con.linger = 0.5
+        while not len(con.send_queue):
+            con.send_line(line)
+        t = time.time()
+        con.close()
+        assert(time.time() - t < 2)
+        assert(not con.connected)
+        peer.close()
+
+        # And doesn't wait at all by default.
+        con, peer = loopback_pair()
+        con.enable_send_queue = 1
+        con.max_send_queue = 1024 * 1024 * 64
+        while not len(con.send_queue):
+            con.send_line(line)
+        t = time.time()
+        con.close()
+        assert(time.time() - t < 0.1)
+        assert(not con.connected)
+        peer.close()
+
     def test_magic(self):
         sock = Sock()
         sock.replies = ["a", "b", "c"]